@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text resource accounting
+
+This module keeps track of what every session costs the server (the audio it sent, the cpu
+time its decoding took, the bytes it sent and received and the language models it loaded) and
+enforces the configured quotas per client address and per client token, so a single client
+can't take the capacity of a shared deployment away from everyone else.
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+from configs import Configs
+from threading import Lock
+from collections import deque
+from time import time
+from hashlib import sha1
+
+try:
+    from time import process_time as cpu_time
+except ImportError:
+    from time import clock as cpu_time # Python 2 (the process cpu time on unix)
+
+log = logger("ACCNTG")
+
+DEFAULT_QUOTAS = {
+    "use": False,
+    "action": "throttle",
+    "window": 60,
+    "per_ip": {},
+    "per_token": {}
+}
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+method: cpu_time - The cpu time of the current process in seconds (used by the workers around the decoding)
+dict: DEFAULT_QUOTAS - The default quota configurations (the per_ip and per_token sections can set max_sessions,
+    and the audio_seconds and cpu_seconds per window, a limit is only enforced once it's configured)
+"""
+
+
+class SessionUsage(object):
+    """The resources used by a single session
+
+    Attributes:
+        started (float): The time the session was opened
+        audio_seconds (float): The seconds of audio the worker decoded
+        cpu_seconds (float): The cpu seconds the decoding (and the rescoring) took
+        bytes_in (int): The bytes the client sent
+        bytes_out (int): The bytes that were sent to the client
+        model_loads (int): The amount of language models the client asked for
+        utterances (int): The amount of utterances the client started
+    """
+
+    __slots__ = ["started", "audio_seconds", "cpu_seconds", "bytes_in", "bytes_out", "model_loads", "utterances"]
+
+    def __init__(self):
+        self.started = time()
+        self.audio_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.model_loads = 0
+        self.utterances = 0
+
+    def record(self, meta):
+        """Method to add the measurement of the worker to the usage
+
+        Arguments:
+            meta (dict): The worker's measurement (audio_ms and cpu_ms)
+
+        Returns: (tuple)
+            The audio seconds and the cpu seconds of the measurement
+        """
+        audio_seconds = meta.get("audio_ms", 0) / 1000.0
+        cpu_seconds = meta.get("cpu_ms", 0) / 1000.0
+        self.audio_seconds += audio_seconds
+        self.cpu_seconds += cpu_seconds
+        return audio_seconds, cpu_seconds
+
+    def to_dict(self):
+        """Method to get the usage as a json serializable dictionary
+
+        Returns: (dict)
+            The usage counters and the duration of the session so far
+        """
+        return {
+            "seconds": round(time() - self.started, 3),
+            "audio_seconds": round(self.audio_seconds, 3),
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "model_loads": self.model_loads,
+            "utterances": self.utterances
+        }
+
+
+class QuotaManager(object):
+    """The windowed usage and the session counts of every client address and client token
+
+    Attributes:
+        _sessions (dict): The quota key to the amount of admitted sessions
+        _windows (dict): The quota key to a deque of (time, audio seconds, cpu seconds) within the window
+        _totals (dict): The quota key to the [audio seconds, cpu seconds] sum of its window
+
+    Note:
+        A quota key is "ip:<address>" or "token:<client token>", the limits of a key are
+        taken from the per_ip or the per_token section of the quota configurations
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._sessions = {}
+        self._windows = {}
+        self._totals = {}
+
+    @staticmethod
+    def get_quota_configs():
+        """Method to get the quotas section of the server configurations
+
+        Returns: (dict)
+            The quota configurations merged over the defaults
+        """
+        quotas = dict(DEFAULT_QUOTAS)
+        quotas.update(Configs.get_server().get("quotas", {}))
+        return quotas
+
+    @staticmethod
+    def redact_key(key):
+        """Method to hide the client token of a quota key, so it can be reported
+
+        Arguments:
+            key (str): The quota key
+
+        Returns: (str)
+            The key with the token replaced by the start of its hash (an address key is returned as is)
+        """
+        if not key.startswith("token:"):
+            return key
+        return "token:%s" % sha1(key[len("token:"):].encode("utf-8")).hexdigest()[:12]
+
+    @staticmethod
+    def get_limits(quotas, key):
+        """Method to get the limits of a quota key
+
+        Arguments:
+            quotas (dict): The quota configurations
+            key (str): The quota key
+
+        Returns: (dict)
+            The configured limits of the key's section
+        """
+        return quotas["per_ip"] if key.startswith("ip:") else quotas["per_token"]
+
+    @staticmethod
+    def get_kind(key):
+        """Method to get what a quota key stands for (for the messages sent to the clients)
+
+        Arguments:
+            key (str): The quota key
+
+        Returns: (str)
+            "address" or "token"
+        """
+        return "address" if key.startswith("ip:") else "token"
+
+    def admit(self, keys):
+        """Method to count a new session against its keys (if none of them is at its session limit)
+
+        Arguments:
+            keys (list): The quota keys of the session
+
+        Returns: (str)
+            None if the session was admitted, otherwise the reason it wasn't
+        """
+        quotas = QuotaManager.get_quota_configs()
+        with self._lock:
+            if quotas["use"]:
+                for key in keys:
+                    max_sessions = QuotaManager.get_limits(quotas, key).get("max_sessions")
+                    if max_sessions is not None and self._sessions.get(key, 0) >= max_sessions:
+                        return "Too many sessions for this client %s!" % QuotaManager.get_kind(key)
+            for key in keys:
+                self._sessions[key] = self._sessions.get(key, 0) + 1
+        return None
+
+    def release(self, keys):
+        """Method to stop counting an ended session against its keys
+
+        Arguments:
+            keys (list): The quota keys of the session
+        """
+        with self._lock:
+            for key in keys:
+                count = self._sessions.get(key, 0) - 1
+                if count > 0:
+                    self._sessions[key] = count
+                else:
+                    self._sessions.pop(key, None)
+
+    def record(self, keys, audio_seconds, cpu_seconds):
+        """Method to add the usage of a session to the windows of its keys
+
+        Note:
+            This is called from the STT subprocess handler threads
+
+        Arguments:
+            keys (list): The quota keys of the session
+            audio_seconds (float): The seconds of audio that were decoded
+            cpu_seconds (float): The cpu seconds the decoding took
+        """
+        if audio_seconds == 0 and cpu_seconds == 0:
+            return
+        window = QuotaManager.get_quota_configs()["window"]
+        now = time()
+        with self._lock:
+            for key in keys:
+                self.__expire(key, now - window) # Keep the windows bounded
+                self._windows.setdefault(key, deque()).append((now, audio_seconds, cpu_seconds))
+                totals = self._totals.setdefault(key, [0.0, 0.0])
+                totals[0] += audio_seconds
+                totals[1] += cpu_seconds
+
+    def check(self, keys):
+        """Method to check if the keys of a session have used up their windowed quotas
+
+        Arguments:
+            keys (list): The quota keys of the session
+
+        Returns: (tuple)
+            None if the session can continue, otherwise the reason and the seconds until it can try again
+        """
+        quotas = QuotaManager.get_quota_configs()
+        if not quotas["use"]:
+            return None
+        now = time()
+        with self._lock:
+            for key in keys:
+                self.__expire(key, now - quotas["window"])
+                totals = self._totals.get(key)
+                if totals is None:
+                    continue
+                limits = QuotaManager.get_limits(quotas, key)
+                for index, limit in ((0, "audio_seconds"), (1, "cpu_seconds")):
+                    if limits.get(limit) is not None and totals[index] >= limits[limit]:
+                        retry_after = self._windows[key][0][0] + quotas["window"] - now # Once the oldest usage leaves the window
+                        return "The %s quota of this client %s is used up!" % (limit, QuotaManager.get_kind(key)), max(retry_after, 0)
+        return None
+
+    def get_stats(self):
+        """Method to get the session counts and the windowed usage of every key
+
+        Returns: (dict)
+            The quota key (with its token redacted) to its sessions, audio seconds and cpu seconds
+        """
+        window = QuotaManager.get_quota_configs()["window"]
+        now = time()
+        stats = {}
+        with self._lock:
+            for key in set(self._sessions) | set(self._totals):
+                self.__expire(key, now - window)
+                totals = self._totals.get(key, [0.0, 0.0])
+                stats[QuotaManager.redact_key(key)] = {
+                    "sessions": self._sessions.get(key, 0),
+                    "audio_seconds": round(totals[0], 3),
+                    "cpu_seconds": round(totals[1], 3)
+                }
+        return stats
+
+    def __expire(self, key, oldest):
+        """Private method to drop the usage of a key that's older than the window (the lock must be held)"""
+        events = self._windows.get(key)
+        if events is None:
+            return
+        totals = self._totals[key]
+        while len(events) > 0 and events[0][0] < oldest:
+            _, audio_seconds, cpu_seconds = events.popleft()
+            totals[0] -= audio_seconds
+            totals[1] -= cpu_seconds
+        if len(events) == 0:
+            del self._windows[key]
+            del self._totals[key]
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text audio capture
+
+This module records the converted (16 kHz mono) audio of every session to disk, so
+it can later be used for model adaptation and debugging. All of the file I/O happens on
+a background writer thread, the decoding path only queues a reference to the chunk.
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+from configs import Configs
+from threading import Thread
+from os.path import join, isdir
+from os import makedirs, fsync, ftruncate, getpid
+from time import time, strftime
+from struct import pack
+
+import os
+
+try:
+    from Queue import Queue # Python 2
+except ImportError:
+    from queue import Queue
+
+log = logger("CAPTUR")
+
+WAV_HEADER_SIZE = 44
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+INDEX_FILE = "index.tsv"
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+int: WAV_HEADER_SIZE - The size of the canonical PCM wav header
+int: SAMPLE_RATE - The sample rate of the captured audio (The decoder's rate)
+int: SAMPLE_WIDTH - The amount of bytes per (mono) sample
+str: INDEX_FILE - The name of the session/utterance to offset index within the data directory
+"""
+
+
+def wav_header(data_size):
+    """Method to build a canonical 16 kHz 16 bit mono wav header
+
+    Arguments:
+        data_size (int): The size of the PCM data chunk in bytes
+
+    Returns: (bytes)
+        The 44 byte wav header
+    """
+    return pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16, 1, 1,
+                SAMPLE_RATE, SAMPLE_RATE * SAMPLE_WIDTH, SAMPLE_WIDTH, SAMPLE_WIDTH * 8, b"data", data_size)
+
+
+class AudioCapture(object):
+    """Per session audio capture to preallocated and rotated wav files
+
+    Attributes:
+        _data_dir (str): The absolute path of the directory the captures are written to
+        _preallocate (int): The amount of bytes to reserve for every new capture file
+        _max_size (int): The capture file size (in bytes) after which a new file is started
+        _max_age (float): The capture file age (in seconds) after which a new file is started
+        _fsync (bool): If the capture file should be fsynced after every utterance
+        _queue (Queue): The queue of pending operations for the writer thread
+
+    Note:
+        Rotation only ever happens between utterances, so an utterance never spans two files
+    """
+
+    def __init__(self, data_dir, preallocate=0, max_size=0, max_age=0, do_fsync=True):
+        self._data_dir = data_dir
+        self._preallocate = preallocate
+        self._max_size = max_size
+        self._max_age = max_age
+        self._fsync = do_fsync
+        self._queue = Queue()
+
+        # Writer thread state (only touched by the writer thread)
+        self._file = None
+        self._file_name = None
+        self._file_opened = 0
+        self._file_part = 0
+        self._data_size = 0
+        self._session = None
+        self._utterance = None
+        self._utterance_offset = 0
+
+        if not isdir(self._data_dir):
+            makedirs(self._data_dir)
+
+        self._writer_t = Thread(target=self.__writer)
+        self._writer_t.setName("AudioCapture")
+        self._writer_t.setDaemon(True)
+        self._writer_t.start()
+
+    @staticmethod
+    def from_configs():
+        """Method to create the audio capture described by the stt configurations
+
+        Returns: (AudioCapture)
+            The new audio capture or None if the capture is disabled
+        """
+        try:
+            stt = Configs.get_stt()
+            capture = stt.get("capture", {})
+            if not capture.get("use", False):
+                return None
+            return AudioCapture(Configs.parse_config_path(stt["data_dir"]),
+                                int(capture.get("preallocate_mb", 0) * 1024 * 1024),
+                                int(capture.get("max_file_mb", 0) * 1024 * 1024),
+                                capture.get("max_file_age", 0),
+                                capture.get("fsync", True))
+        except Exception as err:
+            log.error("Failed creating the audio capture! (err: %s)" % str(err))
+            return None
+
+    def start_utterance(self, session, utterance):
+        """Method to mark the beginning of a new utterance
+
+        Arguments:
+            session (str): The id of the session the audio belongs to
+            utterance (int): The utterance number within the session
+        """
+        self._queue.put(("start", session, utterance))
+
+    def write(self, pcm):
+        """Method to queue converted audio for capturing
+
+        Note:
+            This is called on the decoding path, it only queues a reference to the chunk
+
+        Arguments:
+            pcm (bytes): The 16 kHz 16 bit mono PCM data
+        """
+        self._queue.put(("data", pcm))
+
+    def end_utterance(self):
+        """Method to mark the end of the current utterance (patches the wav header and the index)"""
+        self._queue.put(("end",))
+
+    def close(self, timeout=None):
+        """Method to flush all pending audio and close the capture file
+
+        Arguments:
+            timeout (float): The maximum amount of seconds to wait on the writer thread
+        """
+        self._queue.put(("close",))
+        self._writer_t.join(timeout)
+
+    def __open_file(self):
+        """Private method to open (and preallocate) a new capture file for the current session"""
+        self._file_part += 1
+        self._file_name = "%s-%s-%d.wav" % (strftime("%Y%m%d-%H%M%S"), self._session, self._file_part)
+        self._file = open(join(self._data_dir, self._file_name), "wb+", 1024 * 1024)
+        if self._preallocate > 0:
+            try:
+                os.posix_fallocate(self._file.fileno(), 0, self._preallocate)
+            except (AttributeError, OSError):
+                ftruncate(self._file.fileno(), self._preallocate) # Fall back on a sparse reservation
+        self._file.write(wav_header(0))
+        self._file_opened = time()
+        self._data_size = 0
+
+    def __patch_header(self):
+        """Private method to write the current data size into the capture file's wav header"""
+        position = self._file.tell()
+        self._file.seek(0)
+        self._file.write(wav_header(self._data_size))
+        self._file.seek(position)
+        self._file.flush()
+
+    def __close_file(self):
+        """Private method to finalize the capture file and give back the unused preallocated space"""
+        if self._file is None:
+            return
+        self.__patch_header()
+        ftruncate(self._file.fileno(), WAV_HEADER_SIZE + self._data_size)
+        if self._fsync:
+            fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def __should_rotate(self):
+        """Private method to check if the current capture file is too large or too old
+
+        Returns: (bool)
+            True if a new capture file should be started
+        """
+        if self._max_size > 0 and self._data_size >= self._max_size:
+            return True
+        if self._max_age > 0 and (time() - self._file_opened) >= self._max_age:
+            return True
+        return False
+
+    def __append_index(self):
+        """Private method to add the finished utterance to the capture index"""
+        line = "%s\t%s\t%s\t%d\t%d\t%d\n" % (self._session, str(self._utterance), self._file_name,
+                                              WAV_HEADER_SIZE + self._utterance_offset,
+                                              self._data_size - self._utterance_offset, int(time()))
+        # A single O_APPEND write keeps the lines of every worker process intact
+        index_fd = os.open(join(self._data_dir, INDEX_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(index_fd, line.encode("utf-8"))
+        finally:
+            os.close(index_fd)
+
+    def __writer(self):
+        """Private method that runs the writer thread"""
+        while True:
+            operation = self._queue.get()
+            try:
+                if operation[0] == "data":
+                    if self._utterance is not None:
+                        self._file.write(operation[1])
+                        self._data_size += len(operation[1])
+                elif operation[0] == "start":
+                    if operation[1] != self._session:
+                        self.__close_file() # A new session always starts a new file
+                        self._session = operation[1]
+                        self._file_part = 0
+                    elif self._file is not None and self.__should_rotate():
+                        self.__close_file()
+                    if self._file is None:
+                        self.__open_file()
+                    self._utterance = operation[2]
+                    self._utterance_offset = self._data_size
+                elif operation[0] == "end":
+                    if self._utterance is not None:
+                        self.__patch_header()
+                        if self._fsync:
+                            fsync(self._file.fileno())
+                        self.__append_index()
+                        self._utterance = None
+                elif operation[0] == "close":
+                    if self._utterance is not None:
+                        self.__append_index()
+                        self._utterance = None
+                    self.__close_file()
+                    self._session = None
+                    return
+            except Exception as err:
+                log.error("Failed capturing audio in process %d! (err: %s)" % (getpid(), str(err)))
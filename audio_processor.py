@@ -10,35 +10,191 @@ Developed By: David Smerkous
 
 from logger import logger
 from configs import LanguageModel, Configs
-from text_processor import TextProcessor
-from pocketsphinx.pocketsphinx import Decoder
-from pyaudio import PyAudio, paInt16
-from base64 import b64decode
+from text_processor import TextProcessor, TextStage
+from audio_capture import AudioCapture
+from decoders import SearchCache, DictionaryCache, vocabulary_hash, build_decoder
+from accounting import cpu_time
+from isolation import isolate_worker
+from hashlib import sha1
+from base64 import b64encode
+from binascii import a2b_base64
 from multiprocessing import Process, Pipe, Lock, Event, current_process
 from threading import Thread
 from json import loads, dumps
-from time import sleep
+from time import sleep, time
+from itertools import islice
 
-import wave
 import audioop
-import io
+import struct
 import jsonpickle
 import re
 
 log = logger("AUDIOP")
 
-# py_audio = PyAudio()
-# audio_stream = py_audio.open(format=paInt16, frames_per_buffer=2048, channels=1, rate=16000, output=True) 
+SHUTDOWN_TIMEOUT = 2
+SUBPROCESS_POLL_INTERVAL = 0.25
+STT_RATE = 16000
+RIFF_HEADER = struct.Struct("<4sI4s")
+CHUNK_HEADER = struct.Struct("<4sI")
+FMT_CHUNK = struct.Struct("<HHIIHH")
+DEFAULT_SEGMENTATION = {
+    "use": True,
+    "max_seconds": 30,
+    "search_seconds": 5,
+    "window_ms": 20,
+    "silence_rms": 300
+}
 
 """Global module level definitions
 logger: log - The module log object so that printed calls can be backtraced to this file
-
---DEBUGGING FEATURES-- Uncomment the above lines to add realtime audio playback
-PyAudio: py_audio - The PyAudio parent object (This should only be used when debugging)
-PyAudioStream: audio_stream - The PyAudio sub-stream audio object
+float: SHUTDOWN_TIMEOUT - The amount of seconds a worker gets to exit before it's terminated
+float: SUBPROCESS_POLL_INTERVAL - The amount of seconds the response thread waits on the pipe before checking for a shutdown
+int: STT_RATE - The sample rate the decoders expect
+Struct: RIFF_HEADER, CHUNK_HEADER, FMT_CHUNK - The wav header layouts (little endian)
+dict: DEFAULT_SEGMENTATION - The default forced segmentation of long utterances (an utterance is split at the first
+    quiet window within the last search_seconds before max_seconds, or at the quietest one once max_seconds is reached)
+
+--DEBUGGING FEATURES-- Set "playback" in the stt configurations to add realtime audio playback
+(PyAudio is only imported by the workers when the playback is turned on)
 """
 
 
+def open_playback_stream():
+    """Method to open a realtime playback stream for the converted audio (This should only be used when debugging)
+
+    Note:
+        PyAudio is imported here so that it's never loaded unless the playback is turned on
+
+    Returns: (PyAudioStream)
+        The PyAudio output stream or None if PyAudio isn't available
+    """
+    try:
+        from pyaudio import PyAudio, paInt16
+        return PyAudio().open(format=paInt16, frames_per_buffer=2048, channels=1, rate=16000, output=True)
+    except Exception as err:
+        log.error("Failed opening the playback stream! (err: %s)" % str(err))
+        return None
+
+
+def sample_view(data, offset, size):
+    """Method to reference a part of a bytes object without copying it
+
+    Arguments:
+        data (bytes): The bytes object
+        offset (int): The start of the part
+        size (int): The size of the part
+
+    Returns: (memoryview)
+        The view of the part (a buffer on Python 2, since audioop doesn't take memoryviews there)
+    """
+    try:
+        return buffer(data, offset, size)
+    except NameError:
+        return memoryview(data)[offset:offset + size]
+
+
+def read_wave_header(data):
+    """Method to read the format of a wav file and find where its samples start
+
+    Arguments:
+        data (bytes): The wav file (or the start of it, while it's still being received)
+
+    Raises:
+        ValueError: If the data isn't a wav file
+
+    Returns: (tuple)
+        The offset and the size of the samples, the sample rate, the amount of channels and the sample
+        width in bytes, or None if the data ends before the samples start
+    """
+    if len(data) < RIFF_HEADER.size:
+        return None
+    riff, _, wave_id = RIFF_HEADER.unpack_from(data, 0)
+    if riff != b"RIFF" or wave_id != b"WAVE":
+        raise ValueError("The audio isn't a wav file!")
+
+    offset, rate, channels, width = RIFF_HEADER.size, None, 1, 2
+    while offset + CHUNK_HEADER.size <= len(data):
+        chunk_id, size = CHUNK_HEADER.unpack_from(data, offset)
+        offset += CHUNK_HEADER.size
+        if chunk_id == b"fmt ":
+            if offset + FMT_CHUNK.size > len(data):
+                return None
+            _, channels, rate, _, _, bits = FMT_CHUNK.unpack_from(data, offset)
+            width = bits // 8
+        elif chunk_id == b"data":
+            if rate is None:
+                raise ValueError("The wav file doesn't have a format chunk!")
+            return offset, size, rate, channels, width
+        offset += size + (size & 1) # Chunks are padded to an even size
+    return None
+
+
+def make_wave_header(size, rate, channels=1, width=2):
+    """Method to create the header of a wav file
+
+    Arguments:
+        size (int): The size of the samples in bytes
+        rate (int): The sample rate
+        channels (int): The amount of channels
+        width (int): The sample width in bytes
+
+    Returns: (bytes)
+        The RIFF, format and data chunk headers
+    """
+    return b"".join([
+        RIFF_HEADER.pack(b"RIFF", 36 + size, b"WAVE"),
+        CHUNK_HEADER.pack(b"fmt ", FMT_CHUNK.size),
+        FMT_CHUNK.pack(1, channels, rate, rate * channels * width, channels * width, width * 8),
+        CHUNK_HEADER.pack(b"data", size)
+    ])
+
+
+def parse_wave(data):
+    """Method to read the format of a wav file and find its samples without copying them
+
+    Note:
+        This replaces wave.open on a BytesIO, which created a reader, a file object
+        and a copy of the samples for every chunk
+
+    Arguments:
+        data (bytes): The complete wav file
+
+    Raises:
+        ValueError: If the data isn't a wav file
+
+    Returns: (tuple)
+        The samples (a view of the data), the sample rate, the amount of channels and the sample width in bytes
+    """
+    header = read_wave_header(data)
+    if header is None:
+        raise ValueError("The wav file doesn't have a format and a data chunk!")
+    offset, size, rate, channels, width = header
+    if size == 0 or offset + size > len(data): # Streaming encoders don't always know the size up front
+        size = len(data) - offset
+    size -= size % (width * channels) # Only whole frames
+    return sample_view(data, offset, size), rate, channels, width
+
+
+def find_quiet_split(samples, window_bytes):
+    """Method to find the quietest point of a chunk of converted (16 bit mono) audio
+
+    Arguments:
+        samples (bytes): The converted audio
+        window_bytes (int): The size of the windows the energy is compared over
+
+    Returns: (tuple)
+        The byte offset of the middle of the quietest window and the rms energy of that window
+    """
+    window_bytes = max(window_bytes - window_bytes % 2, 2)
+    best_offset, best_rms = 0, None
+    for offset in range(0, max(len(samples) - window_bytes, 0) + 1, window_bytes):
+        rms = audioop.rms(samples[offset:offset + window_bytes], 2)
+        if best_rms is None or rms < best_rms:
+            best_offset, best_rms = offset, rms
+    split = min(best_offset + window_bytes // 2, len(samples))
+    return split - split % 2, best_rms if best_rms is not None else 0
+
+
 class STT(object):
     """Speech To Text processing class
         
@@ -46,15 +202,49 @@ class STT(object):
         Create a new STT object for every client that connects to the websocket
 
         Attributes:
+            language_model (LanguageModel): The language model the worker was asked to load
+            nltk_model (NLTKModel): The nltk model the worker was asked to load
+            model_fingerprint (str): The fingerprint of the language model files at load time
+            model_key (str): The pool key of the language model (set by the STTPool)
+            vocabulary (dict): The custom words (word to pronunciation) the session added on top of the model
+            vocabulary_key (str): The hash of the custom words (None without any)
+            flags (dict): The keyphrase, detail and search settings the session sent (see result_context)
+            utterances (int): The amount of utterances the worker has processed
+
+        Note:
+            The worker's lifecycle is driven by messages over the pipe: "reset" ends any running
+            utterance and restores the default flags (so the worker can be handed to a new session)
+            and "shutdown" makes the worker exit on its own, which the parent then joins. The worker
+            acknowledges a reset with {"reset": generation}, every response before the acknowledgement
+            belongs to the previous session and is dropped (instead of reaching the next session's callback)
+
+            An utterance that's never stopped is split once it reaches the segmentation's max_seconds
+            (at a quiet point). A final marked "segmented" is sent for every split off segment and the
+            decoding carries on with a fresh utterance, so the search (and its lattice) stays bounded.
+            The finals of a split utterance carry its "segment" number and the "offset_ms" it starts at
+
+            The hypotheses are processed (keyphrases) and sent by a TextStage thread, so the decoding never
+            waits on the text processing. Every hypothesis is tagged with the "utterance" number of the
+            session and its "seq" number within the utterance, a stale partial can be dropped (a gap in seq)
             
     """
 
     def __init__(self):
-        self._is_ready = None
+        self._is_ready = Event() # Set by the parent process once the worker has loaded its models
         self._subprocess_callback = None
         self._loaded_model = False
+        self._generation = 0 # The latest reset that was sent to the worker
+        self._acknowledged = 0 # The latest reset the worker has acknowledged
+        self.language_model = None
+        self.nltk_model = None
+        self.model_fingerprint = None
+        self.model_key = None
+        self.vocabulary = {}
+        self.vocabulary_key = None
+        self.flags = {}
+        self.utterances = 0
+        self._closed = False # Set once the parent has asked the worker to shutdown
         self._p_out, self._p_in = Pipe() # Create a new multiprocessing Pipe pair
-        self._shutdown_event = Event() # Create an event to handle the STT shutdown
         self._process = Process(target=self.__worker, args=((self._p_out, self._p_in), log)) # Create the subprocess fork
         self._process.start() # Start the subprocess fork
 
@@ -72,14 +262,26 @@ class STT(object):
         """
 
         l_log.debug("STT worker started")
+        isolate_worker("stt") # Move off of the front end's cpus (if configured)
 
-        audio_processor = AudioProcessor() # Create a new audio processing object
+        audio_processor = AudioProcessor(AudioCapture.from_configs()) # Create a new audio processing object (with the optional capture stage)
+        search_cache = SearchCache.from_configs() # The keyword and grammar searches compiled by any of the workers
+        rescoring = Configs.get_stt().get("rescoring", {}) # With rescoring this decoder only does the fast first pass
+        rescoring = rescoring if rescoring.get("use", False) else None
+        dict_cache = DictionaryCache.from_configs() # The dictionaries merged with custom vocabularies by any of the workers
         text_processor = TextProcessor() # Remember that we can't load the text processor nltk model until the nltk model is set from the client language
-        config = Decoder.default_config() # Create a new pocketsphinx decoder with the default configuration, which is English
         decoder = None
         nltk_model = None
-        mutex_flags = { "keyphrases": { "use": False } }
-        shutdown_flags = { "shutdown": False, "decoder": None }
+        default_flags = { "keyphrases": { "use": False }, "detail": { "words": False, "nbest": 0 } }
+        mutex_flags = dict(default_flags)
+        utterance_flags = { "active": False, "pcm": bytearray(), "segment": 0, "segment_bytes": 0, "offset_bytes": 0, "utterance": 0, "seq": 0 } # The utterance audio is only kept for the rescoring
+        send_lock = Lock() # The decoding and the text stage both send to the parent
+        segmentation = dict(DEFAULT_SEGMENTATION)
+        segmentation.update(Configs.get_stt().get("segmentation", {}))
+        partial_results = {} # Reused for every chunk (the text stage takes a copy)
+        chunk_meta = {"decode_ms": 0.0, "audio_ms": 0.0, "cpu_ms": 0.0, "chunks": 1} # The chunks add up when a stale partial is dropped
+        search_flags = { "lm": None, "current": None, "pending": None, "registered": {} }
+        vocabulary_flags = { "words": {}, "pending": {} }
 
         def send_json(pipe, to_send):
             """Internal worker method to send a json through the parent socket
@@ -90,7 +292,8 @@ class STT(object):
 
             """
             try:
-                ret = self.__send_buffered(pipe, to_send) # Send the message passed by argument back to the parent process
+                with send_lock: # Keep the chunks of the buffered messages from interleaving
+                    ret = self.__send_buffered(pipe, to_send) # Send the message passed by argument back to the parent process
                 if not ret[0]:
                     l_log.error("Failed to send buffered message to the parent process! (err: %s)" % ret[1])
             except Exception as err:
@@ -106,7 +309,7 @@ class STT(object):
             """
             send_json(pipe, {"error": error}) 
 
-        def load_models(pipe, config, models):
+        def load_models(pipe, models):
             """Internal worker method to load the language model
 
             Note:
@@ -128,30 +331,41 @@ class STT(object):
             if False in [language_model.is_valid_model(), nltk_model.is_valid_model()]:
                 l_log.error("The language model %s is invalid!" % str(language_model.name))
                 send_error(pipe, "Failed loading language model!")
-                return
+                return None, None
 
-            # Load the model configurations into pocketsphinx
-            config.set_string('-hmm', str(language_model.hmm))
-            config.set_string('-lm', str(language_model.lm))
-            config.set_string('-dict', str(language_model.dict))
-            decoder = Decoder(config)
+            # Load the models into pocketsphinx, with the model's and the session's custom words merged into the dictionary
+            decoder, vocabulary = build_decoder(language_model, models.get("vocabulary"), dict_cache, None if rescoring is None else rescoring.get("first_pass"))
+            vocabulary_flags["words"] = vocabulary
+            vocabulary_flags["pending"] = {}
+
+            # A new decoder starts out with only the language model search
+            search_flags["lm"] = search_flags["current"] = decoder.get_search()
+            search_flags["pending"] = None
+            search_flags["registered"] = {}
 
             send_json(pipe, {"success": True}) # Send a success message to the client
 
-            l_log.debug("Set the language model to %s" % str(language_model.name))
+            l_log.debug("Set the language model to %s", language_model.name)
             
             return decoder, nltk_model # Return the new decoder and nltk model
 
         def process_text(pipe, text, is_final, args):
             """Internal worker method to process the Speech To Text phrase
 
+            Note:
+                This runs on the text stage thread
+
             Arguments:
                 pipe (:obj: socket): The response pipe to send to the parent process
-                text (str): The spoken text to further process
+                text (str): The spoken text to further process (None for silence, the results are sent as is)
                 is_final (boo): If the text being processed is the final text else it's a partial result
                 args (dict): Any other flags specifically required for a final or partial speech result
             """
 
+            if text is None:
+                send_json(pipe, args)
+                return
+
             generate_keyphrases = mutex_flags["keyphrases"]["use"]
             keyphrases = []
 
@@ -176,11 +390,45 @@ class STT(object):
             else:
                 hypothesis_results["partial_hypothesis"] = keyphrases
 
-            print(hypothesis_results)
-
             # Send the results back to the client
             send_json(pipe, hypothesis_results)
 
+        def submit_text(text, is_final, args):
+            """Internal worker method to hand a hypothesis over to the text stage
+
+            Arguments:
+                text (str): The spoken text (None for silence)
+                is_final (bool): If the text is the final text else it's a partial result
+                args (dict): The results of the hypothesis (copied by the text stage)
+            """
+            utterance_flags["seq"] += 1
+            args["utterance"] = utterance_flags["utterance"]
+            args["seq"] = utterance_flags["seq"]
+            text_stage.submit(text, is_final, args)
+
+        def get_details(decoder, logmath):
+            """Internal worker method to build the requested result details of the final hypothesis
+
+            Note:
+                Nothing is computed unless the client asked for it with set_detail. The details
+                are packed into lists to keep the serialized results small
+
+            Arguments:
+                decoder (Decoder): The pocketsphinx decoder that just finished the utterance
+                logmath (LogMath): The decoder's logmath object to convert the log probabilities
+
+            Returns: (dict)
+                The word segments ([word, start_frame, end_frame, confidence]) and the n-best ([hypothesis, score]) lists
+            """
+
+            detail = mutex_flags["detail"]
+            details = {}
+            if detail.get("words", False):
+                details["words"] = [[seg.word, seg.start_frame, seg.end_frame, round(logmath.exp(seg.prob), 4)] for seg in decoder.seg()]
+            if detail.get("nbest", 0) > 0:
+                details["nbest"] = [[best.hypstr, best.score] for best in islice(decoder.nbest(), int(detail["nbest"]))]
+            return details
+
         def start_audio(pipe, decoder, args):
             """Internal worker method to start the audio processing chunk sequence
 
@@ -202,7 +450,19 @@ class STT(object):
            
             l_log.debug("Starting the audio processing...")
 
+            if len(vocabulary_flags["pending"]) > 0: # The client added words during the last utterance
+                apply_words(pipe, decoder, vocabulary_flags["pending"])
+                vocabulary_flags["pending"] = {}
+
+            if search_flags["pending"] is not None: # The client switched searches during the last utterance
+                switch_search(decoder, search_flags["pending"])
+
             decoder.start_utt() # Start the pocketsphinx listener
+            utterance_flags["active"] = True
+            utterance_flags["segment"] = utterance_flags["segment_bytes"] = utterance_flags["offset_bytes"] = utterance_flags["seq"] = 0
+            utterance_flags["utterance"] = args.get("utterance") or utterance_flags["utterance"] + 1 # The session's numbering (if it sent one)
+            del utterance_flags["pcm"][:] # Keep the allocated buffer for the next utterance
+            audio_processor.start_utterance(args.get("session")) # Start capturing the utterance (if enabled)
 
             # Tell the client that the decoder has successfully been loaded
             send_json(pipe, {"decoder": True})
@@ -231,24 +491,125 @@ class STT(object):
            
             l_log.debug("Recognizing speech...")
 
-            decoder.process_raw(processed_wav, False, False) # Process the audio chunk through the STT engine
+            started, started_cpu = time(), cpu_time()
+            split = find_segment_split(processed_wav) if utterance_flags["active"] else None
+            if split is not None: # The utterance is too long, finish the segment and carry on with a fresh utterance
+                decode_samples(decoder, processed_wav[:split])
+                decoder.end_utt()
+                send_final(pipe, decoder, None, True)
+                decoder.start_utt()
+                processed_wav = processed_wav[split:]
+            decode_samples(decoder, processed_wav) # Process the audio chunk through the STT engine
 
             hypothesis = decoder.hyp() # Get pocketshpinx's hypothesis
 
+            # The decode cost of the chunk (the parent strips this before the results reach the client)
+            chunk_meta["decode_ms"] = (time() - started) * 1000
+            chunk_meta["cpu_ms"] = (cpu_time() - started_cpu) * 1000
+            chunk_meta["audio_ms"] = (len(processed_wav) + (split or 0)) / 32.0
+
             # Send back the results of the decoding
+            partial_results.clear()
+            partial_results["_meta"] = chunk_meta
             if hypothesis is None:
                 l_log.debug("Silence detected")
-                send_json(pipe, {"partial_silence": True, "partial_hypothesis": None})
+                partial_results["partial_silence"] = True
+                partial_results["partial_hypothesis"] = None
+                submit_text(None, False, partial_results)
             else:
-                hypothesis_results = {
-                    "partial_silence": False if len(hypothesis.hypstr) > 0 else True,
-                }
+                partial_results["partial_silence"] = False if len(hypothesis.hypstr) > 0 else True
 
-                l_log.debug("Partial speech detected: %s" % str(hypothesis.hypstr))
-                process_text(pipe, hypothesis.hypstr, False, hypothesis_results)
+                l_log.debug("Partial speech detected: %s", hypothesis.hypstr)
+                submit_text(hypothesis.hypstr, False, partial_results)
 
             l_log.debug("Done decoding speech from audio chunk!")
 
+        def decode_samples(decoder, samples):
+            """Internal worker method to pass converted audio to the running utterance
+
+            Arguments:
+                decoder (Decoder): The pocketsphinx decoder to control the STT engine
+                samples (bytes): The converted audio
+            """
+            if len(samples) == 0:
+                return
+            decoder.process_raw(samples, False, False)
+            utterance_flags["segment_bytes"] += len(samples)
+            if rescoring is not None:
+                utterance_flags["pcm"] += samples # Keep the utterance for the second pass
+
+        def find_segment_split(samples):
+            """Internal worker method to check if the running utterance has to be split within a chunk
+
+            Note:
+                Within the last search_seconds before max_seconds, the utterance is split at the first
+                chunk with a quiet window. Once max_seconds is reached, it's split at the quietest point
+                of the chunk regardless of its energy
+
+            Arguments:
+                samples (bytes): The converted audio of the chunk
+
+            Returns: (int)
+                The byte offset to split the chunk at or None if the utterance can keep growing
+            """
+            if not segmentation["use"] or segmentation["max_seconds"] <= 0:
+                return None
+            length = utterance_flags["segment_bytes"] + len(samples)
+            max_bytes = int(segmentation["max_seconds"] * STT_RATE) * 2
+            if length < max_bytes - int(segmentation["search_seconds"] * STT_RATE) * 2:
+                return None
+            split, rms = find_quiet_split(samples, int(segmentation["window_ms"] * STT_RATE / 1000) * 2)
+            if rms <= segmentation["silence_rms"] or length >= max_bytes:
+                return split
+            return None
+
+        def send_final(pipe, decoder, meta, segmented):
+            """Internal worker method to send the final hypothesis of the utterance (or of a segment of it)
+
+            Arguments:
+                pipe (:obj: socket): The response pipe to send to the parent process
+                decoder (Decoder): The pocketsphinx decoder that just finished the utterance
+                meta (dict): The cost of finishing the search (None if it's counted with the chunk)
+                segmented (bool): If the utterance was split and carries on after this final
+            """
+            hypothesis = decoder.hyp() # Get pocketshpinx's hypothesis
+            logmath = decoder.get_logmath()
+
+            # Send back the results of the decoding
+            if hypothesis is None:
+                l_log.debug("Silence detected")
+                hypothesis_results = {"silence": True, "hypothesis": None}
+            else:
+                hypothesis_results = {
+                    "silence": False if len(hypothesis.hypstr) > 0 else True,
+                    "score": hypothesis.best_score,
+                    "confidence": logmath.exp(hypothesis.prob)
+                }
+                hypothesis_results.update(get_details(decoder, logmath)) # Add the word segments and alternatives (if requested)
+                if rescoring is not None and len(hypothesis.hypstr) > 0:
+                    pcm = utterance_flags["pcm"]
+                    if len(pcm) <= rescoring.get("max_seconds", 30) * 32000: # The parent hands this to the rescoring pool
+                        hypothesis_results["_rescore"] = b64encode(pcm).decode("ascii")
+            del utterance_flags["pcm"][:]
+
+            if meta is not None:
+                hypothesis_results["_meta"] = meta
+            if segmented or utterance_flags["segment"] > 0:
+                hypothesis_results["segment"] = utterance_flags["segment"]
+                hypothesis_results["offset_ms"] = utterance_flags["offset_bytes"] / 32.0
+            if segmented:
+                hypothesis_results["segmented"] = True
+                utterance_flags["segment"] += 1
+                utterance_flags["offset_bytes"] += utterance_flags["segment_bytes"]
+                utterance_flags["segment_bytes"] = 0
+                l_log.debug("Split the utterance into segment %d", utterance_flags["segment"])
+
+            if hypothesis is None:
+                submit_text(None, True, hypothesis_results)
+            else:
+                l_log.debug("Speech detected: %s", hypothesis.hypstr)
+                submit_text(hypothesis.hypstr, True, hypothesis_results)
+
         def stop_audio(pipe, decoder, args):
             """Internal worker method to stop the audio processing chunk sequence
 
@@ -270,65 +631,177 @@ class STT(object):
 
             l_log.debug("Stopping the audio processing...")
 
+            started_cpu = cpu_time()
             decoder.end_utt() # Stop the pocketsphinx listener
+            utterance_flags["active"] = False
+            audio_processor.end_utterance() # Finish capturing the utterance (if enabled)
 
             l_log.debug("Done recognizing speech!")
 
-            hypothesis = decoder.hyp() # Get pocketshpinx's hypothesis
-            logmath = decoder.get_logmath()
+            send_final(pipe, decoder, {"cpu_ms": (cpu_time() - started_cpu) * 1000}, False) # With the cost of finishing the search (for the session accounting)
 
-            # Send back the results of the decoding
-            if hypothesis is None:
-                l_log.debug("Silence detected")
-                send_json(pipe, {"silence": True, "hypothesis": None})
+        def switch_search(decoder, name):
+            """Internal worker method to make the decoder use another (already registered) search
+
+            Arguments:
+                decoder (Decoder): The pocketsphinx decoder to control the STT engine
+                name (str): The name of the search
+            """
+            search_flags["pending"] = None
+            if search_flags["current"] != name:
+                decoder.set_search(name)
+                search_flags["current"] = name
+                l_log.debug("Switched to the %s search", name)
+
+        def set_search(pipe, decoder, args):
+            """Internal worker method to add a keyword or grammar search to the decoder
+
+            Note:
+                The search is compiled by the search cache (once for every worker) and
+                re-registering an unchanged search doesn't touch the decoder at all
+
+            Arguments:
+                pipe (:obj: socket): The response pipe to send to the parent process
+                decoder (Decoder): The pocketsphinx decoder to control the STT engine
+                args (dict): The normalized search
+            """
+            if decoder is None:
+                send_error(pipe, "Language model not loaded!")
+                return
+            if args["name"] == search_flags["lm"]:
+                send_error(pipe, "Can't replace the language model search!")
+                return
+            if args["name"] == search_flags["current"] and utterance_flags["active"]:
+                send_error(pipe, "Can't replace a search while it's being used!")
+                return
+            try:
+                search_cache.register(decoder, args, search_flags["registered"])
+                send_json(pipe, {"search_ready": args["name"]})
+            except Exception as err:
+                l_log.error("Failed registering the search %s (err: %s)" % (args["name"], str(err)))
+                send_error(pipe, "Failed loading search!")
+
+        def use_search(pipe, decoder, args):
+            """Internal worker method to select the search of the next utterances
+
+            Note:
+                The decoder can't change its search within an utterance, so a switch
+                requested while the client is speaking is applied at the next start_audio
+
+            Arguments:
+                pipe (:obj: socket): The response pipe to send to the parent process
+                decoder (Decoder): The pocketsphinx decoder to control the STT engine
+                args (dict): The search name ("lm" for the language model)
+            """
+            if decoder is None:
+                send_error(pipe, "Language model not loaded!")
+                return
+            name = search_flags["lm"] if args["name"] == "lm" else args["name"]
+            if name != search_flags["lm"] and name not in search_flags["registered"]:
+                send_error(pipe, "Unknown search!")
+                return
+            if utterance_flags["active"]:
+                search_flags["pending"] = name
             else:
-                hypothesis_results = {
-                    "silence": False if len(hypothesis.hypstr) > 0 else True,
-                    "score": hypothesis.best_score,
-                    "confidence": logmath.exp(hypothesis.prob)
-                }
+                switch_search(decoder, name)
+            send_json(pipe, {"search": args["name"]})
 
-                l_log.debug("Speech detected: %s" % str(hypothesis.hypstr))
-                process_text(pipe, hypothesis.hypstr, True, hypothesis_results)
+        def apply_words(pipe, decoder, words):
+            """Internal worker method to add custom words to the loaded decoder
 
-        def shutdown_thread(self, l_log):
-            """Worker method to handle the checking of a shutdown call
+            Note:
+                Only the last word updates the active search, so the search is rebuilt once per call
+
+            Arguments:
+                pipe (:obj: socket): The response pipe to send to the parent process
+                decoder (Decoder): The pocketsphinx decoder to control the STT engine
+                words (dict): The word to pronunciation dictionary of the new words
+            """
+            failed = []
+            items = sorted(words.items())
+            for index, (word, phones) in enumerate(items):
+                if decoder.add_word(str(word), str(phones), index == len(items) - 1) < 0:
+                    failed.append(word)
+                else:
+                    vocabulary_flags["words"][word] = phones
+            if len(failed) > 0:
+                l_log.warning("Failed adding the words %s", ", ".join(failed))
+            send_json(pipe, {"vocabulary": len(vocabulary_flags["words"]), "failed_words": failed})
+
+        def add_words(pipe, decoder, args):
+            """Internal worker method to add custom words without reloading the language model
 
             Note:
-                To reduce overhead, this thread will only be called every 100 milliseconds
+                Words can't be added within an utterance, so they're applied at the next start_audio
 
+            Arguments:
+                pipe (:obj: socket): The response pipe to send to the parent process
+                decoder (Decoder): The pocketsphinx decoder to control the STT engine
+                args (dict): The normalized word to pronunciation dictionary
             """
-            while not shutdown_flags["shutdown"]:
-                try:
-                    if self._shutdown_event.is_set():
-                        l_log.debug("Shutting down worker thread!")
-                        shutdown_flags["shutdown"] = True # Exit the main loop
-                        if shutdown_flags["decoder"] is not None:
-                            try:
-                                shutdown_flags["decoder"].end_utt()
-                            except Exception as err:
-                                l_log.debug("STT decoder object returned a non-zero status")
-                        else:
-                            l_log.warning("The decoder object is already None!")
+            if decoder is None:
+                send_error(pipe, "Language model not loaded!")
+                return
+            words = dict([(word, phones) for word, phones in args.items() if vocabulary_flags["words"].get(word) != phones])
+            if len(words) == 0:
+                send_json(pipe, {"vocabulary": len(vocabulary_flags["words"]), "failed_words": []}) # The decoder already knows all of them
+            elif utterance_flags["active"]:
+                vocabulary_flags["pending"].update(words)
+            else:
+                apply_words(pipe, decoder, words)
 
-                        break
-                    sleep(0.1)
-                except Exception as err:
-                    l_log.error("Failed shutting down worker thread! (err: %s)" % str(err))
+        def end_running_utterance(decoder):
+            """Internal worker method to end an utterance that the client never stopped
+
+            Arguments:
+                decoder (Decoder): The pocketsphinx decoder to control the STT engine
+            """
+            if decoder is None or not utterance_flags["active"]:
+                return
+            try:
+                decoder.end_utt()
+            except Exception as err:
+                l_log.debug("STT decoder object returned a non-zero status")
+            utterance_flags["active"] = False
+            del utterance_flags["pcm"][:]
+            audio_processor.end_utterance()
+
+        def reset(decoder):
+            """Internal worker method to make the worker ready for a new session
+
+            Note:
+                The decoder (and the loaded models) are kept, only the session state is cleared
 
-        shutdown_t = Thread(target=shutdown_thread, args=(self, l_log,))
-        shutdown_t.setDaemon(True)
-        shutdown_t.start()
+            Arguments:
+                decoder (Decoder): The pocketsphinx decoder to control the STT engine
+            """
+            end_running_utterance(decoder)
+            text_stage.clear() # The hypotheses of the previous session are no longer wanted
+            utterance_flags["utterance"] = 0
+            mutex_flags.clear()
+            mutex_flags.update(default_flags)
+            if decoder is not None:
+                switch_search(decoder, search_flags["lm"])
+                search_cache.unregister(decoder, search_flags["registered"]) # The next session can't use this client's searches (their compiled files stay cached until they're pruned)
+            l_log.debug("STT worker reset")
 
         p_out, p_in = pipe
-        while not shutdown_flags["shutdown"]:
+        text_stage = TextStage(lambda text, is_final, args: process_text(p_out, text, is_final, args))
+        while True:
             try:
                 try:
                     command = self.__get_buffered(p_out) # Wait for a command from the parent process
                     if "set_models" in command["exec"]: # Check to see if our command is to 
-                        decoder, nltk_model = load_models(p_out, config, command["args"])
-                        text_processor.set_nltk_model(nltk_model) # Set the text processor nltk model
-                        shutdown_flags["decoder"] = decoder
+                        decoder, nltk_model = load_models(p_out, command["args"])
+                        if nltk_model is not None:
+                            text_processor.set_nltk_model(nltk_model) # Set the text processor nltk model
+                    elif "shutdown" in command["exec"]:
+                        l_log.debug("Shutting down the STT worker!")
+                        end_running_utterance(decoder)
+                        break
+                    elif "reset" in command["exec"]:
+                        reset(decoder)
+                        send_json(p_out, {"reset": command["args"].get("generation", 0)}) # After anything of the previous session
                     elif "start_audio" in command["exec"]:
                         start_audio(p_out, decoder, command["args"])
                     elif "process_audio" in command["exec"]:
@@ -337,14 +810,25 @@ class STT(object):
                         stop_audio(p_out, decoder, command["args"])
                     elif "set_keyphrases" in command["exec"]:
                         mutex_flags["keyphrases"] = command["args"]
+                    elif "set_detail" in command["exec"]:
+                        mutex_flags["detail"] = command["args"]
+                    elif "set_search" in command["exec"]:
+                        set_search(p_out, decoder, command["args"])
+                    elif "use_search" in command["exec"]:
+                        use_search(p_out, decoder, command["args"])
+                    elif "add_words" in command["exec"]:
+                        add_words(p_out, decoder, command["args"])
                     else:
                         l_log.error("Invalid command %s" % str(command))
-                        send_error(socket, "Invalid command!")
+                        send_error(p_out, "Invalid command!")
                 except (EOFError, IOError) as err:
                     continue
             except Exception as err:
                 l_log.error("Failed recieving command from subprocess (id: %d) (err: %s)" % (current_process().pid, str(err)))
 
+        audio_processor.close() # Flush the captured audio before the worker exits
+
+
 
     def __send_to_worker(self, t_exec, to_send):
         """Private method to handle sending to the subprocess worker
@@ -426,18 +910,33 @@ class STT(object):
             This should run in its own thread
         """
         
-        while True:
+        while not self._closed:
             try:
                 try:
+                    if not self._p_in.poll(SUBPROCESS_POLL_INTERVAL): # Wake up now and then to notice a shutdown
+                        continue
                     command = self.__get_buffered(self._p_in)
+                    if "success" in command: # The worker has finished loading its models
+                        self._loaded_model = command["success"]
+                        self._is_ready.set()
+                    elif "error" in command and not self._is_ready.is_set():
+                        self._is_ready.set() # Wake up anyone waiting on a model that failed to load
+                    if "reset" in command:
+                        self._acknowledged = command["reset"]
+                        continue
+                    if self._acknowledged != self._generation:
+                        log.debug("Dropped a response of the previous session")
+                        continue
                     if self._subprocess_callback is not None:
                         self._subprocess_callback(command)
                     else:
-                        log.warning("Subprocess callback is None!")
+                        log.debug("Subprocess callback is None!")
                 except (EOFError, IOError) as err:
                     sleep(0.01) # Wait 10 milliseconds
                     continue
             except Exception as err:
+                if self._closed:
+                    break # The pipe was closed after the worker exited
                 log.error("Failed recieving command from parent process (err: %s)" % str(err))
 
 
@@ -453,7 +952,7 @@ class STT(object):
         """
         self._subprocess_callback = callback
 
-    def set_models(self, language_model, nltk_model):
+    def set_models(self, language_model, nltk_model, vocabulary=None):
         """Method to set the STT object's language model
 
         Note:
@@ -462,8 +961,54 @@ class STT(object):
         Arguments:
             language_model (LanguageModel): The loaded language model to be processed for the STT engine
             nltk_model (NLTKModel): The loaded nltk model to be processed for the text processing object
+            vocabulary (dict): The custom words (word to pronunciation) to merge into the model's dictionary
+        """
+        self.language_model = language_model
+        self.nltk_model = nltk_model
+        self.model_fingerprint = language_model.fingerprint()
+        self.vocabulary = dict(vocabulary or {})
+        self.vocabulary_key = vocabulary_hash(self.vocabulary)
+        self._loaded_model = False
+        self._is_ready.clear()
+        self.__send_to_worker("set_models", {"language_model": language_model, "nltk_model": nltk_model, "vocabulary": self.vocabulary})
+
+    def add_words(self, vocabulary):
+        """Method to add custom words to the loaded decoder (without reloading the language model)
+
+        Arguments:
+            vocabulary (dict): The normalized word to pronunciation dictionary (see decoders.validate_vocabulary)
         """
-        self.__send_to_worker("set_models", {"language_model": language_model, "nltk_model": nltk_model})
+        self.vocabulary.update(vocabulary)
+        self.vocabulary_key = vocabulary_hash(self.vocabulary)
+        self.__send_to_worker("add_words", vocabulary)
+
+    def wait_loaded(self, timeout=None):
+        """Method to block until the worker has finished loading its models
+
+        Arguments:
+            timeout (float): The maximum amount of seconds to wait for
+
+        Returns: (bool)
+            True if the models were successfully loaded, else, False
+        """
+        self._is_ready.wait(timeout)
+        return self._loaded_model
+
+    def is_loading(self):
+        """Method to check if the worker is still loading its models
+
+        Returns: (bool)
+            True if the worker is running and hasn't finished loading, else, False
+        """
+        return not self._is_ready.is_set() and self.is_alive()
+
+    def is_loaded(self):
+        """Method to check if the worker has successfully loaded its models
+
+        Returns: (bool)
+            True if the models are loaded, else, False
+        """
+        return self._is_ready.is_set() and self._loaded_model
 
     def process_audio_chunk(self, audio_chunk):
         """Method to process an audio chunk
@@ -476,14 +1021,19 @@ class STT(object):
         """
         self.__send_to_worker("process_audio", audio_chunk)
 
-    def start_audio_proc(self):
+    def start_audio_proc(self, session=None, utterance=None):
         """Method to start the audio processing
 
         Note:
             This must be called before the process_audio_chunk method
 
+        Arguments:
+            session (str): The id of the session the audio belongs to (used to capture the audio)
+            utterance (int): The number the results of the utterance are tagged with (None to count on the worker)
+
         """
-        self.__send_to_worker("start_audio", {})
+        self.utterances += 1
+        self.__send_to_worker("start_audio", {"session": session, "utterance": utterance})
 
     def stop_audio_proc(self):
         """Method to stop the audio processing
@@ -500,28 +1050,107 @@ class STT(object):
         Arguments:
             keyphrases (dict): The keyphraeses flags
         """
+        self.flags["keyphrases"] = keyphrases
         self.__send_to_worker("set_keyphrases", keyphrases)
 
-    def shutdown(self):
+    def set_detail(self, detail):
+        """Method to set the detail level of the final results
+
+        Arguments:
+            detail (dict): The detail flags (words: include the word segments, nbest: the amount of alternatives)
+        """
+        self.flags["detail"] = detail
+        self.__send_to_worker("set_detail", detail)
+
+    def set_search(self, search):
+        """Method to add a keyword spotting or grammar search to the worker's decoder
+
+        Arguments:
+            search (dict): The normalized search (see decoders.validate_search)
+        """
+        self.flags["search:%s" % search["name"]] = search
+        self.__send_to_worker("set_search", search)
+
+    def use_search(self, name):
+        """Method to select the search used by the next utterances
+
+        Arguments:
+            name (str): The name of a registered search or "lm" for the language model
+        """
+        self.flags["search"] = name
+        self.__send_to_worker("use_search", {"name": name})
+
+    def result_context(self):
+        """Method to describe everything (besides the audio) that the results of an utterance depend on
+
+        Returns: (str)
+            The hex digest of the models, the custom words and the session's flags
+        """
+        digest = sha1(("%s;%s;%s;" % (self.model_key, self.model_fingerprint, self.vocabulary_key)).encode("utf-8"))
+        search = self.flags.get("search", "lm")
+        for flag in ["keyphrases", "detail", "search:%s" % search]:
+            digest.update(("%s=%s;" % (flag, dumps(self.flags.get(flag), sort_keys=True))).encode("utf-8"))
+        return digest.hexdigest()
+
+    def reset(self):
+        """Method to clear the session state of the worker so it can be reused
+
+        Note:
+            Any running utterance is ended, the loaded models (and the decoder) are kept
+        """
+        self._subprocess_callback = None
+        self.flags = {}
+        self._generation += 1
+        self.__send_to_worker("reset", {"generation": self._generation})
+
+    def is_alive(self):
+        """Method to check if the worker subprocess is still running
+
+        Returns: (bool)
+            True if the worker can still process commands
+        """
+        return not self._closed and self._process.is_alive()
+
+    def get_pid(self):
+        """Method to get the process id of the worker subprocess
+
+        Returns: (int)
+            The pid of the worker
+        """
+        return self._process.pid
+
+    def shutdown(self, timeout=SHUTDOWN_TIMEOUT):
         """Method to shutdown and cleanup the STT engine object
 
         Note:
-            The shutdown will not happen immediately, and this function might lag the entire
-            process out for a few hundred milliseconds
+            The worker is told to exit over the pipe and then joined in the background.
+            It's only terminated if it doesn't exit within the timeout
+
+        Arguments:
+            timeout (float): The amount of seconds to wait on the worker to exit by itself
         """
-        self._shutdown_event.set() # Set the multiprocessing shutdown_event to set
+        if self._closed:
+            return
+        self._subprocess_callback = None
+        self.__send_to_worker("shutdown", {})
 
-        def terminate_soon(self):
+        def join_worker(self):
             try:
-                sleep(1) # Wait a second for the subprocess to clean itself
-                self._process.terminate() # Destroy the entire subprocess
+                self._process.join(timeout) # Wait for the worker to exit by itself
+                if self._process.is_alive():
+                    log.warning("STT worker %d didn't exit in time, terminating it", self._process.pid)
+                    self._process.terminate() # Destroy the entire subprocess
+                    self._process.join(timeout)
             except Exception as err:
-                log.error("Failed terminating worker subprocess! (err: %s)" % str(err)) 
+                log.error("Failed terminating worker subprocess! (err: %s)" % str(err))
+            finally:
+                self._closed = True
+                self._p_in.close()
+                self._p_out.close()
 
-        # Wait for the subprocess to retrieve the shutdown event and then destroy the subprocess
-        terminate_soon_t = Thread(target=terminate_soon, args=(self,))
-        terminate_soon_t.setDaemon(True)
-        terminate_soon_t.start()
+        join_worker_t = Thread(target=join_worker, args=(self,))
+        join_worker_t.setDaemon(True)
+        join_worker_t.start()
 
 class AudioProcessor(object):
     """General audio processing utilities class
@@ -529,13 +1158,51 @@ class AudioProcessor(object):
     This class, is just a wrapper for all clients to do generic processing.
     Some handling of 
 
+    Note:
+        This runs for every chunk, so the WAV header is parsed in place (the samples are
+        only referenced, not copied) and the resampler state is carried between the
+        chunks of an utterance instead of starting over for every chunk
+
     Attributes:
-        _io (BytesIO): Generic BytesIO object to memory map the wav file
+        _capture (AudioCapture): The optional capture stage that records the converted audio
+        _playback (PyAudioStream): The optional (debugging) realtime playback of the converted audio
+        _utterance (int): The number of utterances started within this processor
+        _audio_prefix (str): The blob prefix that's removed from the base64 audio
+        _rate (int): The sample rate of the current utterance's audio
+        _rate_state (tuple): The resampler state of the current utterance
 
     """
 
-    def __init__(self):
-        self._io = None
+    __slots__ = ["_capture", "_playback", "_utterance", "_audio_prefix", "_rate", "_rate_state"]
+
+    def __init__(self, capture=None):
+        self._capture = capture
+        self._utterance = 0
+        self._playback = open_playback_stream() if Configs.get_stt().get("playback", False) else None
+        self._audio_prefix = Configs.get_stt()["audio_prefix"]
+        self._rate = None
+        self._rate_state = None
+
+    def start_utterance(self, session):
+        """Method to mark the start of an utterance for the capture stage
+
+        Arguments:
+            session (str): The id of the session the audio belongs to
+        """
+        self._utterance += 1
+        self._rate, self._rate_state = None, None # A new utterance isn't a continuation of the last one
+        if self._capture is not None:
+            self._capture.start_utterance(session, self._utterance)
+
+    def end_utterance(self):
+        """Method to mark the end of an utterance for the capture stage"""
+        if self._capture is not None:
+            self._capture.end_utterance()
+
+    def close(self):
+        """Method to flush and close the capture stage"""
+        if self._capture is not None:
+            self._capture.close(0.5)
 
     def process_chunk(self, audio_chunk):
         """P0ublic method to process an audio chunk received by the server
@@ -551,30 +1218,13 @@ class AudioProcessor(object):
         """
 
         raw_wav = self.__process_base64(audio_chunk) # Unwrap the raw audio data
-        processed_wav = self.__process_wave(raw_wav) # Process the wav data to retrieve some basic information
-        converted_wav = self.__convert_rate(processed_wav) # Convert the processed wav into a usable format for the STT engine
+        converted_wav = self.__convert_rate(*parse_wave(raw_wav)) # Convert the samples into a usable format for the STT engine
+        if self._capture is not None:
+            self._capture.write(converted_wav) # Only queues the chunk, the writing happens in the background
+        if self._playback is not None:
+            self._playback.write(converted_wav) # Debugging only, this blocks until the chunk is played
         return converted_wav
 
-    def __process_wave(self, wav_packet):
-        """Private method to load the raw wave data to memory map and get basic data from the raw data
-
-        Arguments:
-            wav_packet (bytes): The raw wave data to be loaded into the temporary memory mapped file
-
-        Returns: (dict)
-            The the parsed wave data from the temporary mapped file
-        """
-        
-        self._io = io.BytesIO(wav_packet) # Create a memory byte buffer
-        w_file = wave.open(self._io) # Open the memory buffer to create a memory mapped file
-        w_frames = w_file.getnframes() # Get total wav frame count
-        to_ret = {
-            "frames": w_frames,
-            "data": w_file.readframes(w_frames),
-            "rate": w_file.getframerate()
-        }
-        return to_ret
-
     def __process_base64(self, base_64):
         """Private method to decode and return the auto data wrapped in the base64 message
 
@@ -589,26 +1239,40 @@ class AudioProcessor(object):
         """
         
         try:
-            # Web blob prefix to detect and remove
-            audio_prefix = Configs.get_stt()["audio_prefix"]
-
-            if audio_prefix is None:
+            if self._audio_prefix is None:
                 raise TypeError("AudioPrefix cannot be none")
-        
-            return b64decode(base_64.replace(Configs.get_stt()["audio_prefix"], ""))
+
+            if base_64.startswith(self._audio_prefix): # The prefix is only ever at the start
+                return a2b_base64(base_64[len(self._audio_prefix):])
+            return a2b_base64(base_64)
         except Exception as err:
             log.error("Error processing base64 audio packet: (err: %s)" % str(err))
 
-    def __convert_rate(self, wav_parsed):
+    def __convert_rate(self, samples, rate, channels, width):
         """Private method to handle the processed wav data and convert it into a usuable rate for the STT engine
 
         Note:
             CMU Sphinx 'highly' recommends that the input sample rate is 16Khz. For the best, and the most accurate, STT results 
 
         Arguments:
-            wav_parsed (dict): The returned dictionary from the process_wav method
+            samples (memoryview): The samples of the wav data (a view of the decoded chunk)
+            rate (int): The sample rate
+            channels (int): The amount of channels
+            width (int): The sample width in bytes
 
         Returns: (bytes)
             The raw, converted, wav data to then be processed through the STT engine
         """
-        return audioop.ratecv(wav_parsed["data"], 2, 1, wav_parsed["rate"], 16000, None)[0]
+        if width == 1:
+            samples = audioop.bias(samples, 1, -128) # 8 bit wav samples are unsigned
+        if width != 2:
+            samples = audioop.lin2lin(samples, width, 2)
+        if channels == 2:
+            samples = audioop.tomono(samples, 2, 0.5, 0.5)
+        if rate == STT_RATE:
+            return bytes(samples) # The only copy of the samples when no conversion is needed
+
+        if rate != self._rate: # The resampler state only carries over within the same rate
+            self._rate, self._rate_state = rate, None
+        converted, self._rate_state = audioop.ratecv(samples, 2, 1, rate, STT_RATE, self._rate_state)
+        return converted
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx audio chunk allocation benchmark
+
+This script measures the memory that converting a single audio chunk allocates, using the
+previous wave.open based conversion and the current AudioProcessor. It reports the peak of
+the transient allocations per chunk, the memory that's still held after all of the chunks
+and the time per chunk.
+
+Usage:
+    python3 benchmarks/bench_chunk_alloc.py [chunks] [rate]
+
+Developed by: David Smerkous
+"""
+
+from os.path import dirname, abspath
+from base64 import b64encode, b64decode
+from math import sin
+from time import time
+import audioop
+import struct
+import wave
+import io
+import sys
+import tracemalloc
+
+sys.path.insert(0, dirname(dirname(abspath(__file__)))) # Run from the repository root or the benchmarks directory
+
+from configs import Configs
+from audio_processor import AudioProcessor
+
+DEFAULT_CHUNKS = 200
+DEFAULT_RATE = 44100
+CHUNK_SECONDS = 0.5
+"""Global module level definitions
+int: DEFAULT_CHUNKS - The default amount of chunks every path converts
+int: DEFAULT_RATE - The default sample rate of the synthesized chunks (browsers usually record 44.1 or 48 KHz)
+float: CHUNK_SECONDS - The duration of a synthesized chunk
+"""
+
+
+def make_chunk(rate):
+    """Method to synthesize a base64 wrapped wav chunk the way the browser client sends it
+
+    Arguments:
+        rate (int): The sample rate of the chunk
+
+    Returns: (str)
+        The prefixed base64 wav chunk
+    """
+    frames = struct.pack("<%dh" % int(rate * CHUNK_SECONDS), *[int(8000 * sin(i / 20.0)) for i in range(int(rate * CHUNK_SECONDS))])
+    w_io = io.BytesIO()
+    w_file = wave.open(w_io, "wb")
+    w_file.setnchannels(1)
+    w_file.setsampwidth(2)
+    w_file.setframerate(rate)
+    w_file.writeframes(frames)
+    w_file.close()
+    return Configs.get_stt()["audio_prefix"] + b64encode(w_io.getvalue()).decode("ascii")
+
+
+class LegacyProcessor(object):
+    """The chunk conversion before the header was parsed in place (kept for the comparison)"""
+
+    def __init__(self):
+        self._io = None
+
+    def process_chunk(self, audio_chunk):
+        raw_wav = b64decode(audio_chunk.replace(Configs.get_stt()["audio_prefix"], ""))
+        self._io = io.BytesIO(raw_wav)
+        w_file = wave.open(self._io)
+        w_frames = w_file.getnframes()
+        parsed = {"frames": w_frames, "data": w_file.readframes(w_frames), "rate": w_file.getframerate()}
+        return audioop.ratecv(parsed["data"], 2, 1, parsed["rate"], 16000, None)[0]
+
+
+def measure(processor, chunk, chunks):
+    """Method to convert the same chunk repeatedly while tracing the allocations
+
+    Arguments:
+        processor (object): The processor with a process_chunk method
+        chunk (str): The base64 wav chunk
+        chunks (int): The amount of chunks to convert
+
+    Returns: (dict)
+        The average peak allocation per chunk, the retained memory and the time per chunk
+    """
+    processor.process_chunk(chunk) # Warm up (imports, caches and the first resampler state)
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    peaks = 0
+    for _ in range(chunks):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        processor.process_chunk(chunk)
+        peaks += tracemalloc.get_traced_memory()[1] - before
+    retained = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    started = time()
+    for _ in range(chunks):
+        processor.process_chunk(chunk)
+    return {
+        "peak_kb": peaks / float(chunks) / 1024,
+        "retained_kb": retained / 1024.0,
+        "chunk_ms": (time() - started) * 1000 / chunks
+    }
+
+
+def main():
+    chunks = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_CHUNKS
+    rate = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_RATE
+    if not hasattr(tracemalloc, "reset_peak"):
+        print("This benchmark needs Python 3.9 or newer (tracemalloc.reset_peak)")
+        return
+
+    Configs()
+    chunk = make_chunk(rate)
+    print("%d chunks of %.0f ms at %d Hz (%d base64 bytes each)" % (chunks, CHUNK_SECONDS * 1000, rate, len(chunk)))
+    print("%-10s %14s %14s %10s" % ("path", "peak KB/chunk", "retained KB", "ms/chunk"))
+    for name, processor in (("legacy", LegacyProcessor()), ("current", AudioProcessor())):
+        result = measure(processor, chunk, chunks)
+        print("%-10s %14.1f %14.1f %10.3f" % (name, result["peak_kb"], result["retained_kb"], result["chunk_ms"]))
+
+
+if __name__ == "__main__":
+    main()
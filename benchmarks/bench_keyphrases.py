@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx keyphrase extraction benchmark
+
+This script measures the keyphrase extraction latency per hypothesis on the full nltk path
+(punkt sentence tokenizer and wordpunct tokenizer) and on the fast path the decoder hypotheses
+take. The hypotheses are synthesized the way the decoder outputs them (lower case and space
+separated words without punctuation) and both paths are checked to rank the same keyphrases.
+
+Usage:
+    python3 benchmarks/bench_keyphrases.py [hypotheses] [words]
+
+    The nltk punkt and stopwords data have to be installed (see install_nltk.py)
+
+Developed by: David Smerkous
+"""
+
+from os.path import dirname, abspath
+from random import Random
+from time import time
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__)))) # Run from the repository root or the benchmarks directory
+
+from configs import Configs
+from text_processor import TextProcessor
+
+DEFAULT_HYPOTHESES = 2000
+DEFAULT_WORDS = 16
+VOCABULARY = ("the a of to and in is it that for on with as was at be this have from or by not but what all were we when "
+              "your can said there use an each which she do how their if will up other about out many then them these so "
+              "speech recognition server decoder language model audio session worker client stream keyphrase result "
+              "latency memory process chunk utterance hypothesis final partial search grammar vocabulary word phrase").split()
+"""Global module level definitions
+int: DEFAULT_HYPOTHESES - The default amount of hypotheses every path processes
+int: DEFAULT_WORDS - The default amount of words per hypothesis
+list: VOCABULARY - The words the hypotheses are drawn from (stopwords and content words, so phrases get split)
+"""
+
+
+def make_hypotheses(count, words):
+    """Method to synthesize decoder hypotheses
+
+    Arguments:
+        count (int): The amount of hypotheses
+        words (int): The amount of words per hypothesis
+
+    Returns: (list)
+        The hypotheses
+    """
+    random = Random(0)
+    return [" ".join([random.choice(VOCABULARY) for _ in range(words)]) for _ in range(count)]
+
+
+def full_path(text_processor, hypothesis):
+    """The tokenization every text took before the fast path"""
+    text_processor.generate_keyphrases_from_sentences(text_processor.get_sentences(hypothesis))
+
+
+def fast_path(text_processor, hypothesis):
+    """The tokenization the decoder hypotheses take now"""
+    text_processor.generate_keyphrases(hypothesis)
+
+
+def measure(text_processor, path, hypotheses):
+    """Method to extract the keyphrases of every hypothesis and time each of them
+
+    Arguments:
+        text_processor (TextProcessor): The text processor with the nltk model loaded
+        path (method): The keyphrase extraction path
+        hypotheses (list): The hypotheses
+
+    Returns: (tuple)
+        The mean and the 95th percentile latency in microseconds and the ranked keyphrases of every hypothesis
+    """
+    path(text_processor, hypotheses[0]) # Warm up (loads the punkt model)
+    latencies, rankings = [], []
+    for hypothesis in hypotheses:
+        started = time()
+        path(text_processor, hypothesis)
+        latencies.append((time() - started) * 1000000)
+        rankings.append(sorted(text_processor.get_keyphrases()))
+    latencies.sort()
+    return sum(latencies) / len(latencies), latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)], rankings
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_HYPOTHESES
+    words = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_WORDS
+
+    configs = Configs()
+    text_processor = TextProcessor()
+    try:
+        text_processor.set_nltk_model(configs.get_nltk_data(0))
+        text_processor.get_sentences("Load the tokenizer.")
+    except LookupError as err:
+        print("The nltk data isn't installed! (err: %s)" % str(err).strip())
+        return
+
+    hypotheses = make_hypotheses(count, words)
+    print("%d hypotheses of %d words" % (count, words))
+    print("%-6s %12s %12s %10s" % ("path", "mean us", "p95 us", "speedup"))
+    full_mean, full_p95, full_rankings = measure(text_processor, full_path, hypotheses)
+    fast_mean, fast_p95, fast_rankings = measure(text_processor, fast_path, hypotheses)
+    print("%-6s %12.1f %12.1f %10s" % ("full", full_mean, full_p95, "1.00x"))
+    print("%-6s %12.1f %12.1f %9.2fx" % ("fast", fast_mean, fast_p95, full_mean / fast_mean))
+    print("Identical keyphrases: %s" % ("yes" if full_rankings == fast_rankings else "no"))
+
+
+if __name__ == "__main__":
+    main()
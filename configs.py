@@ -10,10 +10,11 @@ Developed by: David Smerkous
 
 from json import loads, dumps
 from sys import exit
-from os.path import dirname, realpath, join, exists
-from os import sep
-from logger import logger
-from threading import Thread
+from os.path import dirname, realpath, join, exists, isdir
+from os import sep, stat, listdir
+from logger import logger, set_levels
+from threading import Thread, Lock
+from hashlib import sha1
 
 import re
 import pyinotify
@@ -21,14 +22,41 @@ import pyinotify
 log = logger("CONFIGS")
 
 CONFIG_FILE = "configs/config.json"
+CONFIG_ROOT = dirname(realpath(__file__))
 CONFIGS = {}
+REQUIRED_CONFIGS = {
+    "language_codes": [],
+    "stt": ["model_dir", "audio_prefix", "hmm", "lm", "dict"],
+    "nltk": ["stopwords"],
+    "server": ["port", "ssl"]
+}
 """Global module level definitions
 logger: log - The module log object so that printed calls can be backtraced to this file
 str: CONFIG_FILE - The relative path and filename of the configs json
+str: CONFIG_ROOT - The absolute path of the application (what (!cwd!) gets replaced with)
 dict: CONFIGS - The global configurations for all other modules
+dict: REQUIRED_CONFIGS - The top level sections (and their required keys) that every config snapshot must have
 """
 
-class LanguageModel(object):
+class SlottedModel(object):
+    """Base class of the model objects, which use __slots__ to keep every session's copies small
+
+    Note:
+        Objects with __slots__ have no __dict__, so the state is given to pickle
+        and jsonpickle (the worker pipes) explicitly
+    """
+
+    __slots__ = []
+
+    def __getstate__(self):
+        return dict([(slot, getattr(self, slot, None)) for slot in self.__slots__])
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+
+class LanguageModel(SlottedModel):
     """Language model to handle language enum types
 
     Attributes:
@@ -36,10 +64,15 @@ class LanguageModel(object):
        _model_hmm (str): The absolute path to the Hidden Markov Models (Language statistical analysis)
        _model_lm (str): The absolute path to the language model bin (The core processor to capture the phonetics)
        _model_dict (str): The absolute path to the language N-Gram dictionary (The table lookup for the phonetics to words)
+       vocabulary (dict): The custom words (word to pronunciation) that are added to the dictionary of this model
+       profile (str): The name of the decoder profile (the speed and accuracy trade off) of this model
+       parameters (dict): The decoder parameters of the profile (ex: {"-beam": 1e-48})
 
     """
 
-    def __init__(self, m_name = None, m_hmm = None, m_lm = None, m_dict = None):
+    __slots__ = ["_model_name", "_model_hmm", "_model_lm", "_model_dict", "vocabulary", "profile", "parameters"]
+
+    def __init__(self, m_name = None, m_hmm = None, m_lm = None, m_dict = None, m_vocabulary = None, m_profile = None, m_parameters = None):
         """LanguageModel constructor
 
         Args:
@@ -47,8 +80,15 @@ class LanguageModel(object):
             m_hmm (str): The absolute path to the Hidden Markov Models (Language statistical analysis)
             m_lm (str): The absolute path to the language model bin (The core processor to capture the phonetics)
             m_dict (str): The absolute path to the language N-Gram dictionary (The table lookup for the phonetics to words)
+            m_vocabulary (dict): The custom words (word to pronunciation) of the model
+            m_profile (str): The name of the decoder profile
+            m_parameters (dict): The decoder parameters of the profile
         """
 
+        self.vocabulary = {} if m_vocabulary is None else m_vocabulary
+        self.profile = m_profile
+        self.parameters = {} if m_parameters is None else m_parameters
+
         # Check for nulls before passing through the property functions
         if m_name is None:
             self._model_name = None
@@ -85,6 +125,36 @@ class LanguageModel(object):
             return False
         return True
 
+    def fingerprint(self):
+        """Method to create a unique fingerprint of the model files on disk
+
+        Note:
+            The fingerprint changes whenever any of the model paths change or a model
+            file is rewritten (size or modification time), so it can be used to detect stale decoders
+
+        Returns: (str)
+            The hex digest of the model fingerprint or None if the model is invalid
+        """
+
+        if not self.is_valid_model():
+            return None
+
+        digest = sha1()
+        for path in [self.hmm, self.lm, self.dict]:
+            paths = [path]
+            if isdir(path): # The hmm is a directory of model files
+                paths += [join(path, f_name) for f_name in sorted(listdir(path))]
+            for f_path in paths:
+                try:
+                    f_stat = stat(f_path)
+                    digest.update(("%s:%d:%d;" % (f_path, f_stat.st_size, int(f_stat.st_mtime))).encode("utf-8"))
+                except OSError:
+                    digest.update(("%s:missing;" % f_path).encode("utf-8"))
+        for word in sorted(self.vocabulary.keys()): # Adding model words also needs new decoders
+            digest.update(("%s %s;" % (word, self.vocabulary[word])).encode("utf-8"))
+        digest.update(dumps(self.parameters, sort_keys=True).encode("utf-8")) # And so does retuning the profile
+        return digest.hexdigest()
+
 
     @property
     def name(self):
@@ -162,7 +232,7 @@ class LanguageModel(object):
         self._model_dict = ngrams
 
 
-class NLTKModel(object):
+class NLTKModel(SlottedModel):
     """NLTK model to handle NLTK language specific enums
 
     Attributes:
@@ -170,6 +240,8 @@ class NLTKModel(object):
        _model_stop_words (str): The generic stop words required for the language model 
     """
 
+    __slots__ = ["_model_name", "_stop_words"]
+
     def __init__(self, m_name = None, m_stop_words = None):
         """NLTKModel constructor
 
@@ -274,12 +346,24 @@ class Configs(object):
             if self._config_file in event.pathname: # Make sure we are only checking for the loaded configuration file and not some other file
                 log.info("The config file %s has been modified!" % event.pathname)
                 log.info("Reloading configurations!")
-                self._config_reload() # Reload the configuration files
-                log.info("Reloading complete!")
+                if self._config_reload(): # Reload the configuration files
+                    log.info("Reloading complete!")
+                else:
+                    log.warning("Reloading failed, keeping the previous configurations!")
+
+        def process_IN_MOVED_TO(self, event):
+            """Pyinotify's method of handling a file being moved into the watched folder
+
+            Note:
+                Most editors save by writing a temporary file and renaming it over the original
+            """
+            self.process_IN_CLOSE_WRITE(event)
 
     def __init__(self):
-        self._current_dir = dirname(realpath(__file__)) 
+        self._current_dir = CONFIG_ROOT
         self._json_config = self.get_full_path(CONFIG_FILE)
+        self._reload_lock = Lock()
+        self._reload_listeners = []
         if not self.__load_configs(): # Attempt to read from the configuration file
             exit(0) # Exit the program on the first configuration error
         log.info("Succesfully loaded initial configs from %s" % self._json_config)
@@ -288,7 +372,7 @@ class Configs(object):
         self._wm = pyinotify.WatchManager()
         self._handler = Configs.__ConfigFileEventHandler(self._json_config, self.__load_configs)
         self._notifier = pyinotify.Notifier(self._wm, self._handler)
-        self._wdd = self._wm.add_watch(dirname(self._json_config), pyinotify.IN_CLOSE_WRITE)
+        self._wdd = self._wm.add_watch(dirname(self._json_config), pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
 
         # Create and start the config file event loop
         self._event_thread = Thread(target=self._notifier.loop)
@@ -296,33 +380,63 @@ class Configs(object):
         self._event_thread.setDaemon(True)
         self._event_thread.start()
 
+    def add_reload_listener(self, listener):
+        """Method to attach a listener that's called after every successful configuration reload
+
+        Note:
+            The listener is called from the pyinotify thread with the old and the new
+            configuration snapshots, so it should not block for long
+
+        Arguments:
+            listener (:obj: method): The method to call with the (old_configs, new_configs) snapshots
+        """
+        self._reload_listeners.append(listener)
+
+    @staticmethod
+    def get_snapshot():
+        global CONFIGS
+        """Method to return the current configuration snapshot
+
+        Note:
+            A reload replaces the whole snapshot instead of modifying it, so holding
+            on to the returned dictionary gives a consistent view of the configurations
+
+        Returns: (dict)
+            The current configuration snapshot
+        """
+        return CONFIGS
+
     @staticmethod
-    def get_available_languages():
+    def get_available_languages(snapshot=None):
         global CONFIGS
         """Method to return all language codes from the configuration file
 
+        Arguments:
+            snapshot (dict): The configuration snapshot to read from (defaults to the current one)
+
         Returns: (:obj: dict - string pairs)
             Pairs of language names and id's
         """
         try:
-            return CONFIGS["language_codes"]
+            return (CONFIGS if snapshot is None else snapshot)["language_codes"]
         except Exception as err:
             log.error("Failed loading available languages! (err: %s)" % str(err))
             return None
 
     @staticmethod
-    def get_language_name_by_id(l_id):
+    def get_language_name_by_id(l_id, snapshot=None):
         """Method to return the language model name based on the id
 
         Arguments:
             l_id (int): The language model id to get the language model name
+            snapshot (dict): The configuration snapshot to read from (defaults to the current one)
 
         Returns (str):
             The language model name
         """
 
         try:
-            a_l = Configs.get_available_languages()
+            a_l = Configs.get_available_languages(snapshot)
             if a_l is None:
                 return None
 
@@ -409,35 +523,45 @@ class Configs(object):
             return None
 
     @staticmethod
-    def get_stt():
+    def get_stt(snapshot=None):
         global CONFIGS
         """Public method to get the current stt configurations
 
+        Arguments:
+            snapshot (dict): The configuration snapshot to read from (defaults to the current one)
+
         Returns: (dict)
             The STT configuration object
         """
-        return CONFIGS["stt"]
+        return (CONFIGS if snapshot is None else snapshot)["stt"]
 
-    def get_stt_data(self, l_id, accent):
+    def get_stt_data(self, l_id, accent, snapshot=None, profile=None):
         """Method to return all speech to text configuration data
 
         Arguments:
             l_id (int): The language model id to get speech to text data from
+            accent (str): The language model accent
+            snapshot (dict): The configuration snapshot to read from (defaults to the current one)
+            profile (str): The name of the decoder profile (defaults to the default_profile)
         
         Returns (LanguageModel):
             The populated LanguageModel
         """
 
         try:
+            snapshot = Configs.get_snapshot() if snapshot is None else snapshot # Read everything from a single snapshot
             n_id = str(l_id) # Turn the id into a str because the json only accepts str keys
-            name = Configs.get_language_name_by_id(l_id)
-            stt = Configs.get_stt() # Get the speech to text sub object
+            name = Configs.get_language_name_by_id(l_id, snapshot)
+            stt = Configs.get_stt(snapshot) # Get the speech to text sub object
             model_data = self.parse_config_path(stt["model_dir"]) # Parse the model directory from the configuration file
             # Get the current language's model data
             m_hmm = join(model_data, self.get_accent_path(stt["hmm"][n_id], accent))
             m_lm = join(model_data, self.get_accent_path(stt["lm"][n_id], accent))
             m_dict = join(model_data, self.get_accent_path(stt["dict"][n_id], accent))
-            return LanguageModel(name, m_hmm, m_lm, m_dict) # Create the new language model object
+            from decoders import validate_vocabulary, get_profile # Imported here since the decoders module depends on this one
+            m_vocabulary = validate_vocabulary(stt.get("vocabulary", {}).get(n_id, [])) # The custom words of the model (added without restarting)
+            m_profile, m_parameters = get_profile(profile, snapshot) # The beams and the other speed and accuracy trade offs
+            return LanguageModel(name, m_hmm, m_lm, m_dict, m_vocabulary, m_profile, m_parameters) # Create the new language model object
         except Exception as err:
             log.error("Failed loading language model! (id: %s) (err: %s)" % (str(l_id), str(err)))
             return None
@@ -458,41 +582,82 @@ class Configs(object):
         except Exception as err:
             log.error("Failed to dump json! (err: %s)" % str(err))
 
+    @staticmethod
+    def validate_configs(configs):
+        """Method to validate a configuration snapshot before it replaces the current one
+
+        Arguments:
+            configs (dict): The freshly parsed configuration snapshot
+
+        Raises:
+            ValueError: If the snapshot is missing a required section or key
+        """
+
+        if not isinstance(configs, dict):
+            raise ValueError("The configurations must be a json object!")
+
+        for section, keys in REQUIRED_CONFIGS.items():
+            if section not in configs:
+                raise ValueError("Missing the %s section!" % section)
+            for key in keys:
+                if key not in configs[section]:
+                    raise ValueError("Missing %s in the %s section!" % (key, section))
+
+        # Every language must have a complete set of models
+        for language in configs["language_codes"]:
+            n_id = str(language["id"])
+            for key in ["hmm", "lm", "dict"]:
+                if n_id not in configs["stt"][key]:
+                    raise ValueError("Missing the stt %s entry for language %s!" % (key, n_id))
+            if n_id not in configs["nltk"]["stopwords"]:
+                raise ValueError("Missing the nltk stopwords entry for language %s!" % n_id)
+
     def __load_configs(self):
         global CONFIGS
         """Private method to reload the configuration file
 
             Note:
-                This should really only be called on configs creation and on the file change listener
+                This should really only be called on configs creation and on the file change listener.
+                The new snapshot is validated first and only then swapped in, so a half written
+                file will never replace a working configuration
 
             Returns: (bool)
-                True on success or False on failure to load configurations:we
+                True on success or False on failure to load configurations
         """
 
-        try:
-            c_f = open(self._json_config, 'r') # Open the config file for reading
-            c_f_data = c_f.read()
-            CONFIGS = loads(c_f_data)
-            c_f.close()
+        with self._reload_lock:
+            try:
+                with open(self._json_config, 'r') as c_f: # Open the config file for reading
+                    new_configs = loads(c_f.read())
+                Configs.validate_configs(new_configs)
+            except Exception as err:
+                log.error("Failed to load configuration file! (err: %s)" % str(err))
+                return False
+
+            old_configs = CONFIGS
+            CONFIGS = new_configs # Atomically swap the snapshot
+            set_levels(new_configs.get("logging", {}).get("levels", {})) # Apply the per namespace logging levels
 
             # Log the new configurations
             log.info("Dumping configs")
             Configs.dump_configs(CONFIGS)
+
+            for listener in self._reload_listeners:
+                try:
+                    listener(old_configs, new_configs)
+                except Exception as err:
+                    log.error("Failed calling a config reload listener! (err: %s)" % str(err))
             return True
-        except Exception as err:
-            log.error("Failed to load configuration file! (err: %s)" % str(err))
-            if c_f is not None:
-                c_f.close()
-        return False
 
-    def get_cwd(self):
+    @staticmethod
+    def get_cwd():
         """Return the absolute path of the current working directory
 
         Returns: (str)
             The absolute path of the current working directory
         """
 
-        return self._current_dir
+        return CONFIG_ROOT
 
     def get_full_path(self, relative_path):
         """Return the absolute path of a file that's located relative to the absolute path
@@ -525,7 +690,8 @@ class Configs(object):
             log.error("Failed parsing accent config path! (path: %s) (err: %s)" % (path_parse, str(err)))
             return None
 
-    def parse_config_path(self, path_parse):
+    @staticmethod
+    def parse_config_path(path_parse):
         """Method to replace common path symbols in the configuration files
 
         Note:
@@ -539,7 +705,7 @@ class Configs(object):
         """
 
         try:
-            cwd = self.get_cwd()
+            cwd = Configs.get_cwd()
             if cwd[-1] == sep:
                 cwd = cwd[:len(cwd) - 2]
             path_parse = re.sub(r'\(!cwd!\)', cwd, path_parse)
@@ -0,0 +1,544 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text decoder searches and vocabularies
+
+This module handles the cheaper pocketsphinx searches that clients can use instead of the
+full language model: keyword spotting (a list of keyphrases) and JSGF grammars, and the custom
+vocabularies (extra words with their pronunciations) added to a language model. Every search
+and merged dictionary is compiled once into a file named by the hash of its content, so
+identical ones are shared by every worker process (and survive restarts).
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+from configs import Configs
+from hashlib import sha1
+from os.path import join, exists, isdir
+from os import makedirs, rename, getpid, stat, listdir, remove, utime
+from time import time
+
+import re
+
+log = logger("DECODR")
+
+SEARCH_TYPES = ["kws", "jsgf"]
+RESERVED_SEARCH = "lm"
+RESERVED_SEARCH_PREFIX = "_"
+KWS_DEFAULT_THRESHOLD = 1e-20
+FSG_LANGUAGE_WEIGHT = 7.5
+MAX_KEYPHRASES = 512
+MAX_GRAMMAR_SIZE = 64 * 1024
+MAX_VOCABULARY = 2048
+DEFAULT_SEARCH_CACHE = "(!cwd!)/cache/searches"
+DEFAULT_SEARCH_CACHE_MB = 64
+CACHE_MIN_AGE = 60
+DEFAULT_DICT_CACHE = "(!cwd!)/cache/dicts"
+DEFAULT_DICT_CACHE_MB = 256
+PHONES_RE = re.compile(r"^[A-Za-z][A-Za-z0-9+_]*( [A-Za-z][A-Za-z0-9+_]*)*$")
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+list: SEARCH_TYPES - The search types a client can register
+str: RESERVED_SEARCH - The name clients use to switch back to the language model search
+str: RESERVED_SEARCH_PREFIX - The prefix of the searches pocketsphinx creates itself (ex: _default, the language model search)
+float: KWS_DEFAULT_THRESHOLD - The detection threshold of a keyphrase that doesn't have one
+float: FSG_LANGUAGE_WEIGHT - The language weight used when compiling a grammar
+int: MAX_KEYPHRASES - The maximum amount of keyphrases within a single search
+int: MAX_GRAMMAR_SIZE - The maximum size (in characters) of a single grammar
+int: MAX_VOCABULARY - The maximum amount of custom words of a single vocabulary
+str: DEFAULT_SEARCH_CACHE - The default directory of the compiled searches
+int: DEFAULT_SEARCH_CACHE_MB - The default size (in megabytes) the compiled searches are pruned to
+int: CACHE_MIN_AGE - The amount of seconds a cache file is kept after it was last used (another worker might be loading it)
+str: DEFAULT_DICT_CACHE - The default directory of the merged dictionaries
+int: DEFAULT_DICT_CACHE_MB - The default size (in megabytes) the merged dictionaries are pruned to
+re: PHONES_RE - The format of a pronunciation (space separated phones)
+"""
+
+
+def make_cache_dir(cache_dir):
+    """Method to create a cache directory if it doesn't exist yet
+
+    Arguments:
+        cache_dir (str): The cache directory
+    """
+    if not isdir(cache_dir):
+        try:
+            makedirs(cache_dir)
+        except OSError:
+            pass # Another worker created it first
+
+
+def write_atomic(path, data):
+    """Method to write a cache file atomically, so other workers never see half of it
+
+    Arguments:
+        path (str): The path of the cache file
+        data (str): The content of the cache file
+    """
+    temp_path = "%s.%d.tmp" % (path, getpid())
+    with open(temp_path, "wb") as c_f:
+        c_f.write(data.encode("utf-8"))
+    rename(temp_path, path)
+
+
+def touch_cache_file(path):
+    """Method to mark a cache file as used, so it's evicted after the files that weren't used since
+
+    Arguments:
+        path (str): The path of the cache file
+    """
+    try:
+        utime(path, None)
+    except OSError:
+        pass # Another worker just evicted it
+
+
+def prune_cache_dir(cache_dir, max_bytes):
+    """Method to evict the least recently used files of a cache directory until it fits its size
+
+    Note:
+        The files used within the last CACHE_MIN_AGE seconds are never evicted
+
+    Arguments:
+        cache_dir (str): The cache directory
+        max_bytes (int): The maximum size of the cache files
+
+    Returns: (int)
+        The amount of files that were evicted
+    """
+    files = []
+    try:
+        for f_name in listdir(cache_dir):
+            if f_name.endswith(".tmp"):
+                continue # Still being written
+            path = join(cache_dir, f_name)
+            f_stat = stat(path)
+            files.append((f_stat.st_mtime, f_stat.st_size, path))
+    except OSError as err:
+        log.debug("Failed listing the cache %s (err: %s)" % (cache_dir, str(err)))
+        return 0
+
+    total = sum([size for _, size, _ in files])
+    files.sort() # The least recently used first
+    now, evicted = time(), 0
+    for mtime, size, path in files:
+        if total <= max_bytes or now - mtime < CACHE_MIN_AGE:
+            break
+        try:
+            remove(path)
+            total -= size
+            evicted += 1
+        except OSError:
+            pass # Another worker evicted it first
+    if evicted > 0:
+        log.debug("Evicted %d files from the cache %s" % (evicted, cache_dir))
+    return evicted
+
+
+def validate_vocabulary(words):
+    """Method to validate and normalize the custom words sent by a client (or the configurations)
+
+    Arguments:
+        words (list): The [word, pronunciation] pairs (a {word: pronunciation} dict is also accepted)
+
+    Raises:
+        ValueError: If a word or pronunciation is invalid
+
+    Returns: (dict)
+        The word to pronunciation (upper case phones) dictionary
+    """
+    if isinstance(words, dict):
+        words = list(words.items())
+    if not isinstance(words, (list, tuple)) or len(words) > MAX_VOCABULARY:
+        raise ValueError("The vocabulary must be a list of at most %d words!" % MAX_VOCABULARY)
+
+    vocabulary = {}
+    for pair in words:
+        if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+            raise ValueError("Every word must be a [word, pronunciation] pair!")
+        word, phones = ("%s" % pair[0]).strip().lower(), " ".join(("%s" % pair[1]).split()).upper()
+        if len(word) == 0 or len(word.split()) != 1:
+            raise ValueError("Invalid word %s!" % word)
+        if PHONES_RE.match(phones) is None:
+            raise ValueError("Invalid pronunciation of %s!" % word)
+        vocabulary[word] = phones
+    return vocabulary
+
+
+def vocabulary_hash(vocabulary):
+    """Method to hash a normalized vocabulary
+
+    Arguments:
+        vocabulary (dict): The word to pronunciation dictionary
+
+    Returns: (str)
+        The hex digest of the vocabulary or None if it's empty
+    """
+    if vocabulary is None or len(vocabulary) == 0:
+        return None
+    content = "\n".join(["%s %s" % (word, vocabulary[word]) for word in sorted(vocabulary.keys())])
+    return sha1(content.encode("utf-8")).hexdigest()
+
+
+def set_parameter(config, name, value):
+    """Method to set a pocketsphinx parameter by the type of its value
+
+    Arguments:
+        config (Config): The pocketsphinx decoder configuration
+        name (str): The parameter name (ex: -beam)
+        value (obj): The parameter value (bool, int, float or str)
+    """
+    if isinstance(value, bool):
+        config.set_boolean(str(name), value)
+    elif isinstance(value, int):
+        config.set_int(str(name), value)
+    elif isinstance(value, float):
+        config.set_float(str(name), value)
+    else:
+        config.set_string(str(name), str(value))
+
+
+def get_profile(name=None, snapshot=None):
+    """Method to get the decoder parameters of a profile from the stt configurations
+
+    Arguments:
+        name (str): The profile name (defaults to the default_profile)
+        snapshot (dict): The configuration snapshot to read from (defaults to the current one)
+
+    Raises:
+        ValueError: If there's no profile with that name
+
+    Returns: (tuple)
+        The profile name and its decoder parameters (None and {} if no profiles are configured)
+    """
+    stt = Configs.get_stt(snapshot)
+    name = stt.get("default_profile") if name is None else name
+    if name is None:
+        return None, {}
+    profiles = stt.get("profiles", {})
+    if name not in profiles:
+        raise ValueError("Unknown decoder profile %s!" % name)
+    return name, dict(profiles[name])
+
+
+def build_decoder(language_model, vocabulary=None, dict_cache=None, parameters=None, use_profile=True):
+    """Method to create a pocketsphinx decoder for a language model
+
+    Note:
+        Some lanaguages take a long time to load. The custom vocabulary is merged into the
+        dictionary through the dictionary cache, so the words don't have to be added afterwards
+
+    Arguments:
+        language_model (LanguageModel): The language model to load
+        vocabulary (dict): The custom words (merged over the model's own vocabulary)
+        dict_cache (DictionaryCache): The cache of merged dictionaries (the custom words are ignored without one)
+        parameters (dict): Any extra decoder parameters, set over the ones of the model's profile (ex: {"-beam": 1e-60})
+        use_profile (bool): If the parameters of the model's profile are used at all (the parameters are complete otherwise)
+
+    Returns: (tuple)
+        The decoder and the custom words it was loaded with
+    """
+    from pocketsphinx.pocketsphinx import Decoder # Only the processes that decode need pocketsphinx
+
+    merged = dict(language_model.vocabulary)
+    merged.update(vocabulary or {})
+    dict_path = language_model.dict
+    if dict_cache is not None and len(merged) > 0:
+        try:
+            dict_path = dict_cache.get_dict_file(language_model.dict, merged)
+        except Exception as err:
+            log.error("Failed merging the custom vocabulary of %s (err: %s)" % (str(language_model.name), str(err)))
+            merged = {}
+    else:
+        merged = {}
+
+    config = Decoder.default_config()
+    config.set_string('-hmm', str(language_model.hmm))
+    config.set_string('-lm', str(language_model.lm))
+    config.set_string('-dict', str(dict_path))
+    merged_parameters = dict(language_model.parameters) if use_profile else {}
+    merged_parameters.update(parameters or {})
+    for name, value in merged_parameters.items():
+        set_parameter(config, name, value)
+    return Decoder(config), merged
+
+
+def validate_search(definition):
+    """Method to validate and normalize a search sent by a client
+
+    Arguments:
+        definition (dict): The search (name, type and either keyphrases or grammar)
+
+    Raises:
+        ValueError: If the search is invalid
+
+    Returns: (dict)
+        The normalized search, keyphrases are always [phrase, threshold] pairs
+    """
+    if not isinstance(definition, dict):
+        raise ValueError("The search must be an object!")
+
+    name = definition.get("name")
+    if not isinstance(name, basestring) or len(name) == 0 or len(name) > 64:
+        raise ValueError("The search needs a name!")
+    if name == RESERVED_SEARCH or name.startswith(RESERVED_SEARCH_PREFIX):
+        raise ValueError("The search name %s is reserved!" % name) # Would replace the language model search
+
+    search_type = definition.get("type")
+    if search_type not in SEARCH_TYPES:
+        raise ValueError("The search type must be one of %s!" % ", ".join(SEARCH_TYPES))
+
+    if search_type == "kws":
+        keyphrases = []
+        for keyphrase in definition.get("keyphrases", [])[:MAX_KEYPHRASES]:
+            if isinstance(keyphrase, (list, tuple)):
+                phrase, threshold = keyphrase[0], float(keyphrase[1])
+            else:
+                phrase, threshold = keyphrase, KWS_DEFAULT_THRESHOLD
+            phrase = " ".join(("%s" % phrase).lower().split()) # Normalize so equal lists hash equally
+            if len(phrase) > 0:
+                keyphrases.append([phrase, threshold])
+        if len(keyphrases) == 0:
+            raise ValueError("The keyword search needs at least one keyphrase!")
+        return {"name": str(name), "type": search_type, "keyphrases": keyphrases}
+
+    grammar = definition.get("grammar")
+    if not isinstance(grammar, basestring) or len(grammar) == 0 or len(grammar) > MAX_GRAMMAR_SIZE:
+        raise ValueError("The grammar search needs a JSGF grammar!")
+    return {"name": str(name), "type": search_type, "grammar": grammar, "rule": definition.get("rule")}
+
+
+class SearchCache(object):
+    """Cache of compiled searches that's shared between the worker processes through the disk
+
+    Note:
+        The directory is pruned to its size (least recently used first) whenever a new search is compiled
+
+    Attributes:
+        _cache_dir (str): The directory the compiled searches are written to
+        _max_bytes (int): The size the directory is pruned to
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_SEARCH_CACHE_MB * 1024 * 1024):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        make_cache_dir(cache_dir)
+
+    @staticmethod
+    def from_configs():
+        """Method to create the search cache in the directory described by the stt configurations
+
+        Returns: (SearchCache)
+            The search cache
+        """
+        stt = Configs.get_stt()
+        return SearchCache(Configs.parse_config_path(stt.get("search_cache_dir", DEFAULT_SEARCH_CACHE)),
+                           int(stt.get("search_cache_max_mb", DEFAULT_SEARCH_CACHE_MB) * 1024 * 1024))
+
+    @staticmethod
+    def content_hash(definition):
+        """Method to hash the content (not the name) of a normalized search
+
+        Arguments:
+            definition (dict): The normalized search
+
+        Returns: (str)
+            The hex digest of the search content
+        """
+        if definition["type"] == "kws":
+            content = "kws\n" + "\n".join(["%s/%s/" % (phrase, repr(threshold)) for phrase, threshold in definition["keyphrases"]])
+        else:
+            content = "jsgf\n%s\n%s" % (str(definition.get("rule")), definition["grammar"])
+        return sha1(content.encode("utf-8")).hexdigest()
+
+    def get_kws_file(self, definition, digest):
+        """Method to get the keyphrase file of a keyword search
+
+        Arguments:
+            definition (dict): The normalized keyword search
+            digest (str): The content hash of the search
+
+        Returns: (str)
+            The path of the keyphrase file
+        """
+        path = join(self._cache_dir, "%s.kws" % digest)
+        if exists(path):
+            touch_cache_file(path)
+            return path
+        write_atomic(path, "".join(["%s /%s/\n" % (phrase, repr(threshold)) for phrase, threshold in definition["keyphrases"]]))
+        prune_cache_dir(self._cache_dir, self._max_bytes)
+        return path
+
+    def get_fsg_file(self, definition, digest, logmath):
+        """Method to get the compiled finite state grammar of a JSGF search
+
+        Note:
+            Compiling the grammar is the expensive part, so it's only done
+            by the first worker that ever sees the grammar
+
+        Arguments:
+            definition (dict): The normalized grammar search
+            digest (str): The content hash of the search
+            logmath (LogMath): The decoder's logmath object
+
+        Returns: (str)
+            The path of the compiled grammar
+        """
+        path = join(self._cache_dir, "%s.fsg" % digest)
+        if exists(path):
+            touch_cache_file(path)
+            return path
+
+        try:
+            from sphinxbase.sphinxbase import Jsgf
+        except ImportError:
+            from pocketsphinx.pocketsphinx import Jsgf
+
+        gram_path = join(self._cache_dir, "%s.gram" % digest)
+        if not exists(gram_path):
+            write_atomic(gram_path, definition["grammar"])
+
+        jsgf = Jsgf(gram_path)
+        rule = None
+        if definition.get("rule") is not None:
+            rule = jsgf.get_rule("%s.%s" % (jsgf.get_name(), definition["rule"]))
+        else:
+            for jsgf_rule in jsgf: # Use the first public rule
+                if jsgf_rule.is_public():
+                    rule = jsgf_rule
+                    break
+        if rule is None:
+            raise ValueError("The grammar doesn't have a matching public rule!")
+
+        temp_path = "%s.%d.tmp" % (path, getpid())
+        jsgf.build_fsg(rule, logmath, FSG_LANGUAGE_WEIGHT).writefile(temp_path)
+        rename(temp_path, path)
+        prune_cache_dir(self._cache_dir, self._max_bytes)
+        return path
+
+    def register(self, decoder, definition, registered):
+        """Method to add a search to a decoder (compiling it only if it hasn't been already)
+
+        Arguments:
+            decoder (Decoder): The pocketsphinx decoder
+            definition (dict): The normalized search
+            registered (dict): The search name to content hash of the searches the decoder already has
+
+        Returns: (bool)
+            True if the search had to be (re)loaded into the decoder
+        """
+        digest = SearchCache.content_hash(definition)
+        if registered.get(definition["name"]) == digest:
+            return False # The decoder already has this exact search
+
+        if definition["type"] == "kws":
+            decoder.set_kws(definition["name"], self.get_kws_file(definition, digest))
+        else:
+            try:
+                from sphinxbase.sphinxbase import FsgModel
+            except ImportError:
+                from pocketsphinx.pocketsphinx import FsgModel
+            logmath = decoder.get_logmath()
+            fsg_path = self.get_fsg_file(definition, digest, logmath)
+            decoder.set_fsg(definition["name"], FsgModel(fsg_path, logmath, FSG_LANGUAGE_WEIGHT))
+
+        registered[definition["name"]] = digest
+        log.debug("Registered the %s search %s (%s)", definition["type"], definition["name"], digest)
+        return True
+
+    def unregister(self, decoder, registered):
+        """Method to remove every registered search from a decoder (the compiled files stay cached until they're pruned)
+
+        Arguments:
+            decoder (Decoder): The pocketsphinx decoder (that isn't using any of the searches)
+            registered (dict): The search name to content hash of the searches the decoder has
+        """
+        for name in list(registered.keys()):
+            try:
+                decoder.unset_search(name)
+            except Exception as err: # Older bindings can't unset, the search is unreachable once it's forgotten
+                log.debug("Failed unsetting the search %s (err: %s)" % (name, str(err)))
+        registered.clear()
+
+
+class DictionaryCache(object):
+    """Cache of pronunciation dictionaries merged with custom vocabularies
+
+    Note:
+        A worker that's created for a custom vocabulary loads the merged dictionary
+        directly, so it doesn't pay for adding the words one by one after the load
+
+        The directory is pruned to its size (least recently used first) whenever a new dictionary is merged
+
+    Attributes:
+        _cache_dir (str): The directory the merged dictionaries are written to
+        _max_bytes (int): The size the directory is pruned to
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_DICT_CACHE_MB * 1024 * 1024):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        make_cache_dir(cache_dir)
+
+    @staticmethod
+    def from_configs():
+        """Method to create the dictionary cache in the directory described by the stt configurations
+
+        Returns: (DictionaryCache)
+            The dictionary cache
+        """
+        stt = Configs.get_stt()
+        return DictionaryCache(Configs.parse_config_path(stt.get("dict_cache_dir", DEFAULT_DICT_CACHE)),
+                               int(stt.get("dict_cache_max_mb", DEFAULT_DICT_CACHE_MB) * 1024 * 1024))
+
+    def get_dict_file(self, dict_path, vocabulary):
+        """Method to get the dictionary file that has the custom vocabulary merged into it
+
+        Note:
+            A custom word that's already in the dictionary is added as an alternative pronunciation
+
+        Arguments:
+            dict_path (str): The path of the language model's dictionary
+            vocabulary (dict): The normalized word to pronunciation dictionary
+
+        Returns: (str)
+            The path of the merged dictionary (the original one if the vocabulary is empty)
+        """
+        digest = vocabulary_hash(vocabulary)
+        if digest is None:
+            return dict_path
+
+        d_stat = stat(dict_path) # A rewritten dictionary has to be merged again
+        digest = sha1(("%s:%d:%d:%s" % (dict_path, d_stat.st_size, int(d_stat.st_mtime), digest)).encode("utf-8")).hexdigest()
+        path = join(self._cache_dir, "%s.dict" % digest)
+        if exists(path):
+            touch_cache_file(path)
+            return path
+
+        lines = []
+        variants = {}
+        known = set() # The custom words that the dictionary already pronounces the same way
+        with open(dict_path, "rb") as d_f:
+            for line in d_f:
+                line = line.decode("utf-8").rstrip()
+                if len(line) == 0:
+                    continue
+                lines.append(line)
+                entry = line.split(None, 1)
+                word = entry[0].split("(", 1)[0]
+                if word in vocabulary:
+                    variants[word] = variants.get(word, 0) + 1
+                    if len(entry) > 1 and " ".join(entry[1].split()) == vocabulary[word]:
+                        known.add(word)
+
+        for word in sorted(vocabulary.keys()):
+            if word in known:
+                continue
+            elif word in variants:
+                lines.append("%s(%d) %s" % (word, variants[word] + 1, vocabulary[word]))
+            else:
+                lines.append("%s %s" % (word, vocabulary[word]))
+
+        write_atomic(path, "\n".join(lines) + "\n")
+        log.debug("Merged %d custom words into %s (%s)", len(vocabulary), dict_path, digest)
+        prune_cache_dir(self._cache_dir, self._max_bytes)
+        return path
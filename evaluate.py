@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text offline evaluation
+
+This module runs a labeled corpus through the same audio processing and decoders the server
+uses and reports what a decoder configuration costs: the word error rate, the real time
+factor, the latency of the final hypothesis after the last chunk and the peak memory. A grid
+of decoder parameters can be swept (every point in its own process, spread over the cores)
+to get a Pareto table of the accuracy and speed trade offs for picking the profiles.
+
+Usage:
+    python evaluate.py corpus_dir --model 0 --accent us [--profile fast] [--sweep sweep.json] [--workers 4]
+
+    The corpus directory holds name.wav files with a name.txt reference transcript next to
+    each of them. A sweep file maps decoder parameters to the values to try, for example:
+    {"-beam": [1e-48, 1e-30], "-ds": [1, 2]}
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+from configs import Configs
+from decoders import DictionaryCache, build_decoder
+from audio_processor import AudioProcessor, parse_wave, make_wave_header
+from multiprocessing import Pool, cpu_count
+from itertools import product
+from base64 import b64encode
+from json import dumps, loads
+from os.path import join, splitext, isdir
+from os import listdir
+from time import time
+from sys import exit
+
+import argparse
+import resource
+import re
+
+log = logger("EVALTE")
+
+DEFAULT_CHUNK_MS = 500
+FILLER_RE = re.compile(r"^(<.*>|\[.*\]|\+\+.*\+\+)$")
+ALTERNATE_RE = re.compile(r"\(\d+\)$")
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+int: DEFAULT_CHUNK_MS - The default duration of the chunks the utterances are fed in (like a client would send them)
+re: FILLER_RE - The filler words of the decoder (silences and noises) that aren't scored
+re: ALTERNATE_RE - The alternate pronunciation suffix of a dictionary word (ex: read(2))
+"""
+
+
+def normalize_words(text):
+    """Method to split a transcript into the words that are scored
+
+    Arguments:
+        text (str): The reference or the hypothesis
+
+    Returns: (list)
+        The lower case words without punctuation, fillers and pronunciation suffixes
+    """
+    words = []
+    for word in text.lower().split():
+        if FILLER_RE.match(word):
+            continue
+        word = ALTERNATE_RE.sub("", word).strip(".,!?;:\"")
+        if len(word) > 0:
+            words.append(word)
+    return words
+
+
+def word_errors(reference, hypothesis):
+    """Method to count the word errors (substitutions, deletions and insertions) of a hypothesis
+
+    Arguments:
+        reference (list): The reference words
+        hypothesis (list): The hypothesis words
+
+    Returns: (int)
+        The word level edit distance
+    """
+    previous = list(range(len(hypothesis) + 1))
+    for r_index, r_word in enumerate(reference, 1):
+        current = [r_index]
+        for h_index, h_word in enumerate(hypothesis, 1):
+            current.append(min(previous[h_index] + 1, current[h_index - 1] + 1, previous[h_index - 1] + (r_word != h_word)))
+        previous = current
+    return previous[-1]
+
+
+def load_corpus(corpus_dir):
+    """Method to read a labeled corpus
+
+    Arguments:
+        corpus_dir (str): The directory of name.wav and name.txt pairs
+
+    Returns: (list)
+        The [name, wav path, reference words] of every utterance (sorted by name)
+    """
+    corpus = []
+    for f_name in sorted(listdir(corpus_dir)):
+        name, extension = splitext(f_name)
+        if extension.lower() != ".wav":
+            continue
+        try:
+            with open(join(corpus_dir, name + ".txt"), "r") as t_f:
+                corpus.append([name, join(corpus_dir, f_name), normalize_words(t_f.read())])
+        except IOError:
+            log.warning("Skipping %s, it doesn't have a reference transcript" % f_name)
+    return corpus
+
+
+def make_chunks(wav_path, chunk_ms):
+    """Method to cut a wav file into base64 wrapped wav chunks, the way the clients send them
+
+    Arguments:
+        wav_path (str): The wav file of the utterance
+        chunk_ms (int): The duration of every chunk
+
+    Returns: (tuple)
+        The chunks and the duration of the utterance in seconds
+    """
+    with open(wav_path, "rb") as w_f:
+        samples, rate, channels, width = parse_wave(w_f.read())
+    samples = bytes(samples)
+    frame = channels * width
+    chunk_bytes = max(int(rate * chunk_ms / 1000.0), 1) * frame
+    chunks = []
+    for offset in range(0, len(samples), chunk_bytes):
+        pcm = samples[offset:offset + chunk_bytes]
+        chunks.append(b64encode(make_wave_header(len(pcm), rate, channels, width) + pcm).decode("ascii"))
+    return chunks, len(samples) / float(rate * frame)
+
+
+def percentile(values, share):
+    """Method to get a percentile of a list of values (nearest rank)
+
+    Arguments:
+        values (list): The values
+        share (float): The percentile between 0 and 1
+
+    Returns: (float)
+        The value at the percentile (0 if there are no values)
+    """
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(share * len(ordered)), len(ordered) - 1)]
+
+
+def evaluate_point(task):
+    """Method that decodes the whole corpus with a single set of decoder parameters
+
+    Note:
+        Every point runs in its own process, so the peak memory is the one of that decoder
+
+    Arguments:
+        task (dict): The language model, the decoder parameters, the corpus and the chunk duration
+
+    Returns: (dict)
+        The parameters, word error rate, real time factor, latencies and the peak memory
+    """
+    decoder = build_decoder(task["language_model"], None, DictionaryCache.from_configs(), task["parameters"])[0]
+    audio_processor = AudioProcessor()
+    errors, words, audio_seconds, decode_seconds, latencies, utterances = 0, 0, 0.0, 0.0, [], []
+
+    for name, wav_path, reference in task["corpus"]:
+        chunks, duration = make_chunks(wav_path, task["chunk_ms"])
+        audio_processor.start_utterance(name)
+        started = time()
+        decoder.start_utt()
+        for chunk in chunks:
+            decoder.process_raw(audio_processor.process_chunk(chunk), False, False)
+        final_started = time()
+        decoder.end_utt()
+        hypothesis = decoder.hyp()
+        finished = time()
+        audio_processor.end_utterance()
+
+        hypothesis = normalize_words("" if hypothesis is None else hypothesis.hypstr)
+        utterance_errors = word_errors(reference, hypothesis)
+        errors += utterance_errors
+        words += len(reference)
+        audio_seconds += duration
+        decode_seconds += finished - started
+        latencies.append((finished - final_started) * 1000)
+        utterances.append({"name": name, "errors": utterance_errors, "words": len(reference), "hypothesis": " ".join(hypothesis)})
+
+    return {
+        "parameters": task["parameters"],
+        "wer": float(errors) / words if words > 0 else 0.0,
+        "rtf": decode_seconds / audio_seconds if audio_seconds > 0 else 0.0,
+        "latency_p50_ms": percentile(latencies, 0.5),
+        "latency_p95_ms": percentile(latencies, 0.95),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, # Kilobytes on linux
+        "utterances": utterances
+    }
+
+
+def sweep_grid(base, sweep):
+    """Method to create every combination of the swept decoder parameters
+
+    Arguments:
+        base (dict): The parameters of the profile that's swept over
+        sweep (dict): The parameter name to the list of values to try
+
+    Returns: (list)
+        The parameters of every point of the grid
+    """
+    names = sorted(sweep.keys())
+    points = []
+    for values in product(*[sweep[name] for name in names]):
+        parameters = dict(base)
+        parameters.update(dict(zip(names, values)))
+        points.append(parameters)
+    return points
+
+
+def mark_pareto(results):
+    """Method to mark the points that no other point beats on both the word error rate and the speed
+
+    Arguments:
+        results (list): The results of every point (sorted by the real time factor)
+    """
+    best_wer = None
+    for result in results:
+        result["pareto"] = best_wer is None or result["wer"] < best_wer
+        if result["pareto"]:
+            best_wer = result["wer"]
+
+
+def print_table(results, swept):
+    """Method to print the results of the points as a table
+
+    Arguments:
+        results (list): The results of every point
+        swept (list): The names of the swept parameters (the columns that tell the points apart)
+    """
+    columns = ["%-12s" % name for name in swept] + ["%8s" % "WER", "%8s" % "RTF", "%10s" % "p50 ms", "%10s" % "p95 ms", "%10s" % "RSS MB", " pareto"]
+    print("".join(columns))
+    for result in results:
+        row = ["%-12s" % str(result["parameters"].get(name)) for name in swept]
+        row += ["%7.2f%%" % (result["wer"] * 100), "%8.3f" % result["rtf"], "%10.1f" % result["latency_p50_ms"],
+                "%10.1f" % result["latency_p95_ms"], "%10.1f" % result["peak_rss_mb"], " *" if result["pareto"] else ""]
+        print("".join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the accuracy and the speed of the RemSphinx decoders on a labeled corpus")
+    parser.add_argument("corpus", help="The directory of name.wav files and their name.txt reference transcripts")
+    parser.add_argument("--model", type=int, default=0, help="The language model id")
+    parser.add_argument("--accent", default="us", help="The language model accent")
+    parser.add_argument("--profile", default=None, help="The decoder profile to start from (defaults to the default_profile)")
+    parser.add_argument("--sweep", default=None, help="A json file of decoder parameters to the list of values to try")
+    parser.add_argument("--workers", type=int, default=cpu_count(), help="The amount of points decoded in parallel")
+    parser.add_argument("--chunk-ms", type=int, default=DEFAULT_CHUNK_MS, help="The duration of the chunks the audio is fed in")
+    parser.add_argument("--output", default=None, help="A json file to write every result (with the per utterance hypotheses) to")
+    args = parser.parse_args()
+
+    configs = Configs()
+    language_model = configs.get_stt_data(args.model, args.accent, profile=args.profile)
+    if language_model is None or not isdir(args.corpus):
+        print("The language model or the corpus directory is invalid!")
+        return 1
+
+    corpus = load_corpus(args.corpus)
+    sweep = {}
+    if args.sweep is not None:
+        with open(args.sweep, "r") as s_f:
+            sweep = loads(s_f.read())
+    parameters = language_model.parameters
+    language_model.parameters = {} # The points carry the complete parameters
+    tasks = [{"language_model": language_model, "parameters": point, "corpus": corpus, "chunk_ms": args.chunk_ms}
+             for point in sweep_grid(parameters, sweep)]
+    print("Decoding %d utterances with %d parameter sets on %d processes..." % (len(corpus), len(tasks), args.workers))
+
+    pool = Pool(processes=max(min(args.workers, len(tasks)), 1), maxtasksperchild=1) # A fresh process (and peak memory) per point
+    try:
+        results = pool.map(evaluate_point, tasks, chunksize=1)
+    finally:
+        pool.terminate()
+
+    results.sort(key=lambda result: (result["rtf"], result["wer"]))
+    mark_pareto(results)
+    print_table(results, sorted(sweep.keys()))
+    if args.output is not None:
+        with open(args.output, "w") as o_f:
+            o_f.write(dumps(results, indent=4, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
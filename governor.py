@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text memory governor
+
+This module keeps a burst of connections from pushing the server into swap (or the OOM killer).
+Every session that asks for a language model can fork a worker that loads a full model, so
+the governor watches the resident memory of the workers and the memory the system still has
+available. Above the watermark, the idle warm workers are shutdown first and then the parked
+sessions, the pool stops refilling its spares, and new sessions wait in a bounded queue for
+room (or are refused with a clear error once the queue is full).
+
+Note:
+    The memory is read from /proc (Linux), elsewhere the governor turns itself off
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+from configs import Configs
+from tornado.ioloop import PeriodicCallback
+from collections import deque
+
+log = logger("GOVRNR")
+
+DEFAULT_GOVERNOR = {
+    "use": False,
+    "interval": 1,
+    "min_available_mb": 512,
+    "max_workers_mb": 0,
+    "worker_mb": 256,
+    "max_queued": 16,
+    "queue_timeout": 15
+}
+MEMINFO_FILE = "/proc/meminfo"
+STATUS_FILE = "/proc/%d/status"
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+dict: DEFAULT_GOVERNOR - The default governor configurations (0 max_workers_mb doesn't cap the workers, worker_mb is
+    the estimated size of a worker until one has been measured)
+str: MEMINFO_FILE - The file the available memory of the system is read from
+str: STATUS_FILE - The file the resident memory of a worker is read from (formatted with its pid)
+"""
+
+
+def read_meminfo():
+    """Method to read the total and the available memory of the system
+
+    Returns: (tuple)
+        The total and the available megabytes, or None if they can't be read
+    """
+    values = {}
+    try:
+        with open(MEMINFO_FILE, "r") as m_f:
+            for line in m_f:
+                name, _, value = line.partition(":")
+                if name in ("MemTotal", "MemAvailable"):
+                    values[name] = int(value.split()[0]) / 1024.0 # The values are in kilobytes
+    except (IOError, OSError, ValueError):
+        return None
+    if len(values) < 2:
+        return None
+    return values["MemTotal"], values["MemAvailable"]
+
+
+def read_rss(pid):
+    """Method to read the resident memory of a process
+
+    Arguments:
+        pid (int): The process id
+
+    Returns: (float)
+        The resident megabytes or None if the process is gone
+    """
+    try:
+        with open(STATUS_FILE % pid, "r") as s_f:
+            for line in s_f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class MemoryGovernor(object):
+    """The admission control of new workers based on the memory headroom
+
+    Attributes:
+        _io_loop (IOLoop): The tornado IOLoop that runs the checks and the queued admissions
+        _pool (STTPool): The pool whose idle spares are evicted first
+        _registry (SessionRegistry): The registry whose parked sessions are evicted next
+        _queue (deque): The [admit callback, refuse callback, timeout handle] of every waiting session
+        _checker (PeriodicCallback): The periodic memory check (None while the governor is off)
+        _last (dict): The latest measurement
+        _admitting (int): The amount of admitted sessions that haven't taken their worker yet (see settle)
+        _evicted (int): The amount of workers that were shutdown to make room
+        _refused (int): The amount of sessions that were refused (or timed out in the queue)
+
+    Note:
+        All of the methods must be called on the IOLoop thread
+    """
+
+    def __init__(self, io_loop, pool, registry):
+        self._io_loop = io_loop
+        self._pool = pool
+        self._registry = registry
+        self._queue = deque()
+        self._checker = None
+        self._last = None
+        self._admitting = 0
+        self._evicted = 0
+        self._refused = 0
+
+    @staticmethod
+    def get_governor_configs():
+        """Method to get the governor section of the server configurations
+
+        Returns: (dict)
+            The governor configurations merged over the defaults
+        """
+        governor = dict(DEFAULT_GOVERNOR)
+        governor.update(Configs.get_server().get("governor", {}))
+        return governor
+
+    def start(self):
+        """Method to start the periodic memory checks (if the governor is turned on and /proc can be read)"""
+        governor = MemoryGovernor.get_governor_configs()
+        if not governor["use"]:
+            return
+        if read_meminfo() is None:
+            log.warning("Can't read %s, the memory governor is turned off" % MEMINFO_FILE)
+            return
+        self._checker = PeriodicCallback(self.__check, governor["interval"] * 1000)
+        self._checker.start()
+        log.info("Governing the workers (%d MB minimum available memory, %d MB maximum worker memory)",
+                 governor["min_available_mb"], governor["max_workers_mb"])
+
+    def is_active(self):
+        """Method to check if the governor is watching the memory
+
+        Returns: (bool)
+            True if the admissions are governed
+        """
+        return self._checker is not None
+
+    def measure(self):
+        """Method to measure the memory of the workers and the system
+
+        Note:
+            A worker that's still loading its models barely shows up in the memory yet, so it's
+            counted separately and reserved at the size of an average worker (see __has_room)
+
+        Returns: (dict)
+            The total and available system memory, the worker count and memory, the average loaded worker,
+            the amount of loading workers and the headroom (the megabytes that can still be used before reaching the watermark)
+        """
+        governor = MemoryGovernor.get_governor_configs()
+        meminfo = read_meminfo()
+        total_mb, available_mb = meminfo if meminfo is not None else (0.0, 0.0)
+
+        workers = self._pool.get_spares() + [session.stt for session in self._registry.get_sessions() if session.stt is not None]
+        loading = [stt for stt in workers if stt.is_loading()]
+        sizes = [size for size in [read_rss(stt.get_pid()) for stt in workers if stt not in loading] if size is not None]
+        loading_mb = sum([size for size in [read_rss(stt.get_pid()) for stt in loading] if size is not None])
+        workers_mb = sum(sizes) + loading_mb
+        worker_mb = sum(sizes) / len(sizes) if len(sizes) > 0 else float(governor["worker_mb"])
+
+        headroom_mb = available_mb - governor["min_available_mb"]
+        if governor["max_workers_mb"] > 0:
+            headroom_mb = min(headroom_mb, governor["max_workers_mb"] - workers_mb)
+
+        self._last = {
+            "total_mb": round(total_mb, 1),
+            "available_mb": round(available_mb, 1),
+            "workers": len(sizes) + len(loading),
+            "loading": len(loading),
+            "workers_mb": round(workers_mb, 1),
+            "worker_mb": round(worker_mb, 1),
+            "headroom_mb": round(headroom_mb, 1)
+        }
+        return self._last
+
+    def admit(self, admit, refuse):
+        """Method to let a session load a worker once there's room for it
+
+        Note:
+            The session is admitted right away if nobody is waiting and a worker fits within the
+            headroom, otherwise it's queued (in order) until the periodic check finds room or the
+            queue timeout passes. The refuse callback is called with the reason if it's not admitted
+
+        Arguments:
+            admit (method): The callback that loads the session's worker
+            refuse (method): The callback that tells the session why it didn't get a worker
+
+        Returns: (list)
+            The queue entry (to cancel it when the client leaves) or None if it was handled right away
+        """
+        if not self.is_active() or (len(self._queue) == 0 and self.__has_room(self.measure(), self._admitting)):
+            self._admitting += 1
+            admit()
+            return None
+
+        governor = MemoryGovernor.get_governor_configs()
+        if len(self._queue) >= governor["max_queued"]:
+            self._refused += 1
+            refuse("The server is out of memory, try again later!")
+            return None
+        entry = [admit, refuse, None]
+        entry[2] = self._io_loop.call_later(governor["queue_timeout"], self.__expire, entry)
+        self._queue.append(entry)
+        log.info("Queued a session until there's room for its worker (%d waiting)", len(self._queue))
+        self.__relieve(self._last)
+        return entry
+
+    def settle(self):
+        """Method to tell the governor that an admitted session took its worker (or won't take one)
+
+        Note:
+            Must be called once for every admission, right after the worker was acquired. Until then
+            the admission holds a worker's worth of headroom, so a burst of requests within the same
+            tick isn't admitted against the same headroom. A worker that's still loading is counted by
+            the measurement from there on
+        """
+        self._admitting = max(self._admitting - 1, 0)
+
+    def cancel(self, entry):
+        """Method to take a session out of the queue (when its client disconnected)
+
+        Arguments:
+            entry (list): The queue entry that admit returned
+        """
+        try:
+            self._queue.remove(entry)
+        except ValueError:
+            return
+        self._io_loop.remove_timeout(entry[2])
+
+    def is_saturated(self):
+        """Method to check if new connections should be refused outright
+
+        Returns: (bool)
+            True if the queue is full and there's no room for another worker
+        """
+        if not self.is_active():
+            return False
+        return len(self._queue) >= MemoryGovernor.get_governor_configs()["max_queued"] and not self.__has_room(self._last, self._admitting)
+
+    def get_position(self, entry):
+        """Method to get the place of a session in the queue
+
+        Arguments:
+            entry (list): The queue entry that admit returned
+
+        Returns: (int)
+            The 1 based position (0 if it's not queued)
+        """
+        for position, queued in enumerate(self._queue, 1):
+            if queued is entry:
+                return position
+        return 0
+
+    def get_stats(self):
+        """Method to get the latest measurement and the governor counters
+
+        Returns: (dict)
+            The memory measurement, the waiting sessions and the evicted and refused counts
+        """
+        stats = dict(self._last if self._last is not None else {})
+        stats.update({"active": self.is_active(), "queued": len(self._queue), "admitting": self._admitting, "evicted": self._evicted, "refused": self._refused})
+        return stats
+
+    def __has_room(self, measurement, pending=0):
+        """Private method to check if another worker fits within the headroom
+
+        Arguments:
+            measurement (dict): The memory measurement
+            pending (int): The amount of workers that were admitted and haven't been acquired yet
+
+        Returns: (bool)
+            True if a new worker can be loaded
+        """
+        if measurement is None:
+            return True
+        reserved = (pending + measurement["loading"]) * measurement["worker_mb"] # The loading workers' memory is mostly still to come
+        return measurement["headroom_mb"] - reserved >= measurement["worker_mb"]
+
+    def __relieve(self, measurement):
+        """Private method to shutdown an idle worker while above the watermark
+
+        Note:
+            An idle warm worker is evicted first, and only then the oldest parked session
+
+        Arguments:
+            measurement (dict): The memory measurement
+
+        Returns: (bool)
+            True if a worker was shutdown
+        """
+        if self._pool.evict_spare() or self._registry.evict_parked():
+            self._evicted += 1
+            log.info("Evicted an idle worker (%.1f MB headroom)", measurement["headroom_mb"])
+            return True
+        return False
+
+    def __check(self):
+        """Private method that periodically measures the memory and admits the queued sessions"""
+        try:
+            measurement = self.measure()
+            room = self.__has_room(measurement, self._admitting)
+            self._pool.pause_refills(not room) # Don't fork new spares into the pressure
+            if measurement["headroom_mb"] < 0 or (not room and len(self._queue) > 0):
+                self.__relieve(measurement)
+
+            while len(self._queue) > 0 and self.__has_room(measurement, self._admitting):
+                admit, _, timeout = self._queue.popleft()
+                self._io_loop.remove_timeout(timeout)
+                self._admitting += 1
+                admit()
+        except Exception as err:
+            log.error("Failed checking the memory! (err: %s)" % str(err))
+
+    def __expire(self, entry):
+        """Private method that refuses a session that waited in the queue for too long"""
+        try:
+            self._queue.remove(entry)
+        except ValueError:
+            return
+        self._refused += 1
+        entry[1]("The server is out of memory, try again later!")
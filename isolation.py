@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text process isolation
+
+This module keeps the decoding from starving the front end. Some of the cores can be reserved
+for the Tornado IOLoop process while the STT workers (and the rescoring processes) are pinned
+to the remaining ones, the workers can run at a lower priority, and the thread pools of the
+native libraries within the workers can be capped, so a busy server still answers its
+websockets right away.
+
+Note:
+    The cpu affinity needs os.sched_setaffinity (Linux, Python 3.3+), elsewhere only
+    the priorities and the thread caps are applied
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+from configs import Configs
+from multiprocessing import cpu_count
+
+import os
+
+log = logger("ISOLTN")
+
+DEFAULT_ISOLATION = {
+    "use": False,
+    "frontend_cores": 1,
+    "worker_nice": 5,
+    "rescoring_nice": 10,
+    "native_threads": 1
+}
+NATIVE_THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS"]
+AVAILABLE_CPUS = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+dict: DEFAULT_ISOLATION - The default isolation configurations (the nice levels are added to the front end's, 0 disables the thread cap)
+list: NATIVE_THREAD_VARIABLES - The environment variables the native thread pools (OpenMP, BLAS) read their size from
+list: AVAILABLE_CPUS - The cpus the server was allowed to use when it started (before any pinning, None if it can't be read)
+"""
+
+
+def get_isolation_configs():
+    """Method to get the isolation section of the server configurations
+
+    Returns: (dict)
+        The isolation configurations merged over the defaults
+    """
+    isolation = dict(DEFAULT_ISOLATION)
+    isolation.update(Configs.get_server().get("isolation", {}))
+    return isolation
+
+
+def split_cpus(frontend_cores):
+    """Method to split the available cpus between the front end and the workers
+
+    Note:
+        If there aren't more cpus than reserved ones, nothing is reserved
+
+    Arguments:
+        frontend_cores (int): The amount of cpus reserved for the front end
+
+    Returns: (tuple)
+        The front end cpus and the worker cpus (None if the affinity isn't supported)
+    """
+    if AVAILABLE_CPUS is None:
+        return None, None
+    if frontend_cores <= 0 or frontend_cores >= len(AVAILABLE_CPUS):
+        return AVAILABLE_CPUS, AVAILABLE_CPUS
+    return AVAILABLE_CPUS[:frontend_cores], AVAILABLE_CPUS[frontend_cores:]
+
+
+def count_worker_cpus():
+    """Method to count the cpus the workers decode on
+
+    Returns: (int)
+        The amount of worker cpus (all of the available ones without the isolation)
+    """
+    isolation = get_isolation_configs()
+    worker_cpus = split_cpus(isolation["frontend_cores"] if isolation["use"] else 0)[1]
+    if worker_cpus is None: # The affinity can't be read here
+        return max(cpu_count(), 1)
+    return max(len(worker_cpus), 1)
+
+
+def set_affinity(cpus):
+    """Method to pin the current process to a set of cpus
+
+    Arguments:
+        cpus (list): The cpus to run on
+
+    Returns: (bool)
+        True if the process was pinned
+    """
+    if cpus is None or not hasattr(os, "sched_setaffinity"):
+        return False
+    try:
+        os.sched_setaffinity(0, cpus)
+        return True
+    except OSError as err:
+        log.error("Failed pinning process %d to the cpus %s (err: %s)" % (os.getpid(), str(cpus), str(err)))
+        return False
+
+
+def limit_native_threads(count):
+    """Method to cap the thread pools of the native libraries in the current process
+
+    Note:
+        The environment variables only reach the libraries that are loaded afterwards (pocketsphinx
+        is imported once the worker loads its decoder), threadpoolctl (if it's installed) also
+        caps the ones that are already loaded
+
+    Arguments:
+        count (int): The maximum amount of threads (0 leaves them alone)
+    """
+    if count <= 0:
+        return
+    for variable in NATIVE_THREAD_VARIABLES:
+        os.environ[variable] = str(count)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(count)
+    except ImportError:
+        pass
+
+
+def isolate_frontend():
+    """Method to pin the front end (the IOLoop process) to its reserved cpus
+
+    Note:
+        This must be called before the workers are started, they inherit the affinity
+        and then move themselves over to the worker cpus
+    """
+    isolation = get_isolation_configs()
+    if not isolation["use"]:
+        return
+    frontend_cpus, worker_cpus = split_cpus(isolation["frontend_cores"])
+    if set_affinity(frontend_cpus):
+        log.info("Pinned the front end to the cpus %s (the workers get %s)", str(frontend_cpus), str(worker_cpus))
+    else:
+        log.info("The cpu affinity isn't supported here, only the worker priorities and thread caps are applied")
+
+
+def isolate_worker(kind="stt"):
+    """Method to move a freshly started worker process onto the worker cpus with its priority
+
+    Arguments:
+        kind (str): The kind of worker ("stt" or "rescoring", which picks the nice level)
+    """
+    isolation = get_isolation_configs()
+    if not isolation["use"]:
+        return
+    set_affinity(split_cpus(isolation["frontend_cores"])[1])
+    nice = isolation["rescoring_nice" if kind == "rescoring" else "worker_nice"]
+    if nice > 0:
+        try:
+            os.nice(nice)
+        except OSError as err:
+            log.error("Failed lowering the priority of the %s worker %d (err: %s)" % (kind, os.getpid(), str(err)))
+    limit_native_threads(isolation["native_threads"])
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text load monitor
+
+This module keeps track of how long the workers take to decode the audio they're sent and
+turns that (together with the amount of active sessions) into the chunk duration that the
+clients are asked to send. Small chunks keep the partial results snappy while the server is
+idle, larger chunks amortize the per chunk overhead (encoding, base64, json and the pipe
+round trip) once the server gets busy.
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+from configs import Configs
+from threading import Lock
+from isolation import count_worker_cpus
+
+log = logger("LOADMN")
+
+DEFAULT_CHUNKING = {
+    "adaptive": True,
+    "default_ms": 500,
+    "min_ms": 250,
+    "max_ms": 1000,
+    "step_ms": 50,
+    "low_load": 0.5,
+    "high_load": 0.9
+}
+DEFAULT_AUTO_PROFILE = {
+    "use": False,
+    "high_load": 0.9,
+    "downgrade": {}
+}
+SMOOTHING = 0.1
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+dict: DEFAULT_CHUNKING - The default chunking configurations (the load is the estimated share of the cpus used by decoding)
+dict: DEFAULT_AUTO_PROFILE - The default automatic decoder profile configurations (downgrade maps a profile to its faster one)
+float: SMOOTHING - The weight of a new measurement in the moving averages
+"""
+
+
+class LoadMonitor(object):
+    """Moving averages of the decoding cost and the chunk duration recommendations based on them
+
+    Attributes:
+        _active_sessions (:obj: method): The method that returns the amount of sessions with a worker
+        _real_time_factor (float): The average decode time per second of audio (None until measured)
+        _decode_ms (float): The average decode time of a single chunk (None until measured)
+    """
+
+    def __init__(self, active_sessions):
+        self._active_sessions = active_sessions
+        self._lock = Lock()
+        self._real_time_factor = None
+        self._decode_ms = None
+
+    @staticmethod
+    def get_chunking_configs():
+        """Method to get the chunking section of the server configurations
+
+        Returns: (dict)
+            The chunking configurations merged over the defaults
+        """
+        chunking = dict(DEFAULT_CHUNKING)
+        chunking.update(Configs.get_server().get("chunking", {}))
+        return chunking
+
+    def record(self, meta):
+        """Method to record the decode measurement of a chunk
+
+        Note:
+            This is called from the STT subprocess handler threads
+
+        Arguments:
+            meta (dict): The worker's measurement (decode_ms and audio_ms of the chunk)
+        """
+        decode_ms, audio_ms = meta.get("decode_ms"), meta.get("audio_ms")
+        if decode_ms is None or not audio_ms:
+            return
+        real_time_factor = float(decode_ms) / audio_ms
+        with self._lock:
+            if self._real_time_factor is None:
+                self._real_time_factor, self._decode_ms = real_time_factor, float(decode_ms)
+            else:
+                self._real_time_factor += SMOOTHING * (real_time_factor - self._real_time_factor)
+                self._decode_ms += SMOOTHING * (decode_ms - self._decode_ms)
+
+    def get_load(self):
+        """Method to estimate the share of the cpus that the active sessions keep busy with decoding
+
+        Note:
+            With the isolation, only the cpus the workers are pinned to are counted
+
+        Returns: (float)
+            The estimated load (1.0 means every worker cpu is busy) or None until the first chunk was measured
+        """
+        if self._real_time_factor is None:
+            return None
+        return self._active_sessions() * self._real_time_factor / count_worker_cpus()
+
+    def recommend_chunk_ms(self):
+        """Method to get the chunk duration the clients should use right now
+
+        Returns: (int)
+            The recommended chunk duration in milliseconds
+        """
+        chunking = LoadMonitor.get_chunking_configs()
+        load = self.get_load()
+        if not chunking["adaptive"] or load is None:
+            return int(chunking["default_ms"])
+
+        if load <= chunking["low_load"]:
+            chunk_ms = chunking["min_ms"]
+        elif load >= chunking["high_load"]:
+            chunk_ms = chunking["max_ms"]
+        else: # Scale linearly between the low and the high load
+            scale = (load - chunking["low_load"]) / float(chunking["high_load"] - chunking["low_load"])
+            chunk_ms = chunking["min_ms"] + scale * (chunking["max_ms"] - chunking["min_ms"])
+
+        # A chunk can't be decoded faster than the fixed cost of a single chunk
+        if self._decode_ms is not None:
+            chunk_ms = max(chunk_ms, self._decode_ms)
+        chunk_ms = min(chunk_ms, chunking["max_ms"])
+        return int(round(chunk_ms / float(chunking["step_ms"])) * chunking["step_ms"])
+
+    def recommend_profile(self, profile):
+        """Method to get the decoder profile a new session should use right now
+
+        Note:
+            Once the decoding saturates the cpus, new sessions are downgraded to a faster
+            profile. The sessions that are already running keep their decoders
+
+        Arguments:
+            profile (str): The profile the session asked for (None for the default profile)
+
+        Returns: (str)
+            The profile to load (None for the default profile)
+        """
+        auto_profile = dict(DEFAULT_AUTO_PROFILE)
+        auto_profile.update(Configs.get_stt().get("auto_profile", {}))
+        load = self.get_load()
+        if not auto_profile["use"] or load is None or load < auto_profile["high_load"]:
+            return profile
+
+        requested = Configs.get_stt().get("default_profile") if profile is None else profile
+        downgraded = auto_profile["downgrade"].get(requested)
+        if downgraded is None:
+            return profile
+        log.debug("Downgrading a new session from the %s to the %s profile (load: %.2f)", requested, downgraded, load)
+        return downgraded
+
+    def get_stats(self):
+        """Method to get the load statistics
+
+        Returns: (dict)
+            The real time factor, the average chunk decode time, the load and the current recommendation
+        """
+        load = self.get_load()
+        return {
+            "real_time_factor": None if self._real_time_factor is None else round(self._real_time_factor, 4),
+            "decode_ms": None if self._decode_ms is None else round(self._decode_ms, 2),
+            "load": None if load is None else round(load, 4),
+            "chunk_ms": self.recommend_chunk_ms()
+        }
@@ -4,22 +4,32 @@
 This module is designed to just handle logging. There's nothing more to it
 Just printing and logging to files
 
+Note:
+    When LOGGER_ASYNC is set, every process (including the forked STT workers) only puts
+    records on a shared queue and a single writer thread in the main process does the file I/O
+
 Developed By: David Smerkous
 """
 
-from logging import getLogger, INFO, Formatter, FileHandler, StreamHandler
+from logging import getLogger, DEBUG, INFO, WARNING, ERROR, Formatter, FileHandler, StreamHandler, Handler
 from os.path import dirname, realpath, isdir, exists
-from os import makedirs
+from os import makedirs, getpid
+from multiprocessing import Queue
+from threading import Thread
 from time import strftime
-from sys import stdout
+from sys import stdout, stderr
+
+import atexit
 
 # Define logging characteristics
 LOGGER_NAME = "RemSphinx"
 LOGGER_LEVEL = INFO
+LOGGER_ASYNC = True
+LOGGER_LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
 
 LOGGER_FORMAT = Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
 LOGGER_FILE_PATH = "%s/logs" % dirname(realpath(__file__))
-LOGGER_FILE_DATE = strftime("%d-%m-%y--%H-%M-%S") 
+LOGGER_FILE_DATE = strftime("%d-%m-%y--%H-%M-%S")
 LOGGER_FILE_FORMAT = "%s/%s.log" % (LOGGER_FILE_PATH, LOGGER_FILE_DATE)
 
 if not isdir(LOGGER_FILE_PATH):
@@ -37,29 +47,149 @@ LOGGER_FILE_HANDLER.setFormatter(LOGGER_FORMAT)
 LOGGER_CONSOLE_HANDLER = StreamHandler(stdout)
 LOGGER_CONSOLE_HANDLER.setFormatter(LOGGER_FORMAT)
 LOGGER = getLogger(LOGGER_NAME)
-LOGGER.addHandler(LOGGER_FILE_HANDLER)
+LOGGER.setLevel(DEBUG) # The namespace levels do the filtering before anything gets formatted
+LOGGER.propagate = not LOGGER_ASYNC # The writer thread prints to the console itself (instead of tornado's handler on the caller's thread)
 
 # Uncomment when not using tornado, which already has a console handler
-# LOGGER.addHandler(LOGGER_CONSOLE_HANDLER)
+# if not LOGGER_ASYNC: LOGGER.addHandler(LOGGER_CONSOLE_HANDLER)
+
+NAMESPACE_LEVELS = {}
+"""Global module level definitions
+dict: NAMESPACE_LEVELS - The per namespace level overrides (ex: {"AUDIOP": DEBUG})
+"""
+
+
+class QueueHandler(Handler):
+    """Logging handler that only puts the records onto a multiprocessing queue
+
+    Note:
+        The message is merged with its arguments before it's queued, so the
+        record can always be pickled across the process boundary
+    """
+
+    def __init__(self, queue):
+        Handler.__init__(self)
+        self._queue = queue
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            record.exc_info = None
+            self._queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """The single writer that takes queued records and hands them to the real handlers
+
+    Attributes:
+        _queue (Queue): The multiprocessing queue the records are read from
+        _handlers (list): The handlers that do the actual (blocking) I/O
+        _pid (int): The id of the process that owns the writer thread
+    """
+
+    _SENTINEL = None
+
+    def __init__(self, queue, *handlers):
+        self._queue = queue
+        self._handlers = handlers
+        self._pid = getpid()
+        self._thread = Thread(target=self.__run)
+        self._thread.setName("LogWriter")
+        self._thread.setDaemon(True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Method to flush the queue and stop the writer thread
+
+        Note:
+            Only the process that started the writer can stop it; forked workers skip this
+        """
+        if getpid() != self._pid or not self._thread.is_alive():
+            return
+        self._queue.put_nowait(QueueListener._SENTINEL)
+        self._thread.join(2)
+
+    def __run(self):
+        while True:
+            try:
+                record = self._queue.get()
+                if record is QueueListener._SENTINEL:
+                    break
+                for handler in self._handlers:
+                    if record.levelno >= handler.level:
+                        try:
+                            handler.handle(record)
+                        except Exception:
+                            handler.handleError(record) # Reports the lost record on stderr
+            except (EOFError, IOError):
+                break
+            except Exception as err:
+                stderr.write("Failed writing a log record! (err: %s)\n" % str(err))
+
+
+if LOGGER_ASYNC:
+    LOGGER_QUEUE = Queue(-1)
+    LOGGER.addHandler(QueueHandler(LOGGER_QUEUE))
+    LOGGER_LISTENER = QueueListener(LOGGER_QUEUE, LOGGER_FILE_HANDLER, LOGGER_CONSOLE_HANDLER)
+    LOGGER_LISTENER.start()
+    atexit.register(LOGGER_LISTENER.stop)
+else:
+    LOGGER.addHandler(LOGGER_FILE_HANDLER)
+
+
+def set_levels(levels):
+    """Method to set the per namespace logging levels
+
+    Note:
+        Workers that have already been forked keep the levels they were forked with
+
+    Arguments:
+        levels (dict): The namespace to level name pairs (ex: {"AUDIOP": "DEBUG"})
+    """
+    NAMESPACE_LEVELS.clear()
+    for name_space, level in levels.items():
+        NAMESPACE_LEVELS[name_space] = LOGGER_LEVELS.get(str(level).upper(), LOGGER_LEVEL)
+
+
+class _LazyMessage(object):
+    """A log message that's only formatted once a handler actually needs it"""
+
+    __slots__ = ("_msg", "_args")
+
+    def __init__(self, msg, args):
+        self._msg = msg
+        self._args = args
+
+    def __str__(self):
+        return str(self._msg) % self._args
 
 
 class logger(object):
     def __init__(self, name_space, logger_level=LOGGER_LEVEL):
-        LOGGER.setLevel(logger_level)
-        LOGGER.debug("Starting logger!")
         self._name_space = name_space
+        self._level = logger_level
+
+    def is_enabled_for(self, level):
+        return level >= NAMESPACE_LEVELS.get(self._name_space, self._level)
 
-    def __base_log(self, to_log):
-        return "|%s|: %s" % (self._name_space, str(to_log))
+    def __base_log(self, level, to_log, args):
+        if not self.is_enabled_for(level): # Filter before any string formatting happens
+            return
+        LOGGER.log(level, "|%s|: %s", self._name_space, _LazyMessage(to_log, args) if args else to_log)
 
-    def info(self, to_log):
-        LOGGER.info(self.__base_log(to_log))
+    def info(self, to_log, *args):
+        self.__base_log(INFO, to_log, args)
 
-    def debug(self, to_log):
-        LOGGER.debug(self.__base_log(to_log))
+    def debug(self, to_log, *args):
+        self.__base_log(DEBUG, to_log, args)
 
-    def warning(self, to_log):
-        LOGGER.warning(self.__base_log(to_log))
+    def warning(self, to_log, *args):
+        self.__base_log(WARNING, to_log, args)
 
-    def error(self, to_log):
-        LOGGER.error(self.__base_log(to_log))
+    def error(self, to_log, *args):
+        self.__base_log(ERROR, to_log, args)
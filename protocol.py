@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text client protocol
+
+This module encodes the messages that are sent to the websocket clients. The results are
+serialized with the fastest json encoder that's installed (ujson, then simplejson, then the
+standard library json) and the messages a session produces within one IOLoop tick can be
+sent as a single batched frame.
+
+Json stays the default, but a client can ask for the compact binary protocol with the
+remsphinx.msgpack websocket subprotocol (if msgpack is installed). Every frame is then a
+msgpack array of messages and every message is an array that starts with an integer code:
+
+    Requests: [code] or [code, payload] (see REQUEST_CODES), the model request's payload is the
+              map of its arguments ({"model": 0, "accent": "us", ...}), every other payload is the
+              value of the json request's key (ex: [1, "<base64 wav>"] for {"audio": "<base64 wav>"})
+    Results:  [1, utterance, seq, partial_hypothesis, partial_silence, keyphrases(, extra map)]
+              [2, utterance, seq, hypothesis, silence, keyphrases(, extra map)]
+              [0, message map] for everything else (model loaded, errors, searches, ...)
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+
+try:
+    import ujson as fast_json
+    ENCODER = "ujson"
+except ImportError:
+    try:
+        import simplejson as fast_json
+        ENCODER = "simplejson"
+    except ImportError:
+        import json as fast_json
+        ENCODER = "json"
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None # Only the json protocol is offered
+
+log = logger("PROTCL")
+
+MSGPACK_SUBPROTOCOL = "remsphinx.msgpack"
+GENERIC_CODE = 0
+RESULT_SCHEMAS = [
+    (1, "partial_hypothesis", ("utterance", "seq", "partial_hypothesis", "partial_silence", "keyphrases")),
+    (2, "hypothesis", ("utterance", "seq", "hypothesis", "silence", "keyphrases"))
+]
+REQUEST_CODES = {
+    1: "audio",
+    2: "start_speech",
+    3: "end_speech",
+    4: "model",
+    5: "resume",
+    6: "set_keyphrases",
+    7: "set_detail",
+    8: "set_search",
+    9: "use_search",
+    10: "add_words"
+}
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+module: fast_json - The fastest json module that's installed (they all share the dumps and loads signatures)
+str: ENCODER - The name of the json module that's used
+module: msgpack - The msgpack module (None if it isn't installed)
+str: MSGPACK_SUBPROTOCOL - The websocket subprotocol of the binary protocol
+int: GENERIC_CODE - The code of the results that are sent as a plain map
+list: RESULT_SCHEMAS - The code, the key that identifies the result and the positional fields of the compact results
+dict: REQUEST_CODES - The request code to the key of the equivalent json request
+"""
+
+
+def encode_json(message):
+    """Method to serialize a message (or a batch of messages) as json
+
+    Arguments:
+        message (object): The dictionary (or the list of dictionaries) to serialize
+
+    Returns: (str)
+        The json text
+    """
+    return fast_json.dumps(message)
+
+
+def encode_batch(messages, batching):
+    """Method to serialize the messages of a tick into the frames to send
+
+    Arguments:
+        messages (list): The message dictionaries in the order they were produced
+        batching (bool): If the client accepts a json array of messages in a single frame
+
+    Returns: (list)
+        The json text of every frame
+    """
+    if batching and len(messages) > 1:
+        return [encode_json(messages)]
+    return [encode_json(message) for message in messages]
+
+
+def has_msgpack():
+    """Method to check if the binary protocol can be offered
+
+    Returns: (bool)
+        True if msgpack is installed
+    """
+    return msgpack is not None
+
+
+def pack_result(message):
+    """Method to turn a result into its compact (positional) form
+
+    Arguments:
+        message (dict): The result
+
+    Returns: (list)
+        The result code followed by its fields (the fields outside of the schema are added as a trailing map)
+    """
+    for code, key, fields in RESULT_SCHEMAS:
+        if key in message:
+            packed = [code] + [message.get(field) for field in fields]
+            extra = dict([(name, value) for name, value in message.items() if name not in fields])
+            if len(extra) > 0:
+                packed.append(extra)
+            return packed
+    return [GENERIC_CODE, message]
+
+
+def encode_msgpack(messages):
+    """Method to serialize the messages of a tick into a single binary frame
+
+    Arguments:
+        messages (list): The message dictionaries in the order they were produced
+
+    Returns: (bytes)
+        The msgpack array of the compact messages
+    """
+    return msgpack.packb([pack_result(message) for message in messages], use_bin_type=False)
+
+
+def decode_request(frame):
+    """Method to turn a binary request frame back into the equivalent json request
+
+    Arguments:
+        frame (bytes): The msgpack encoded request
+
+    Returns: (dict)
+        The request
+
+    Raises:
+        ValueError: If the frame isn't a valid request
+    """
+    try:
+        request = msgpack.unpackb(frame, raw=False)
+    except Exception as err:
+        raise ValueError("Invalid msgpack frame (%s)" % str(err))
+    if not isinstance(request, (list, tuple)) or len(request) == 0 or not isinstance(request[0], int) or request[0] not in REQUEST_CODES:
+        raise ValueError("Invalid request code!")
+    key = REQUEST_CODES[request[0]]
+    payload = request[1] if len(request) > 1 else True
+    if isinstance(payload, dict) and key in payload:
+        return payload # The model request carries all of its arguments
+    return {key: payload}
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text second pass rescoring
+
+This module runs the slow, wide beam second pass over whole utterances. The session workers
+stream the audio through a fast, narrow beam decoder (so the partial results stay quick) and
+hand the utterance audio of every final result to a separate pool of processes, which decodes
+it again with the accurate settings. The refined final replaces the first pass final.
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+from configs import Configs
+from decoders import DictionaryCache, build_decoder, get_profile
+from accounting import cpu_time
+from isolation import isolate_worker
+from threading import Lock, Timer
+from collections import OrderedDict
+from multiprocessing import Pool
+from base64 import b64decode
+from json import dumps
+from itertools import islice
+from sys import version_info
+
+log = logger("RESCOR")
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_QUEUE = 16
+DEFAULT_TIMEOUT = 10
+DEFAULT_MAX_MODELS = 2
+DECODERS = OrderedDict()
+TEXT_PROCESSORS = {}
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+int: DEFAULT_WORKERS - The default amount of rescoring processes
+int: DEFAULT_MAX_QUEUE - The default amount of utterances that can wait on (or be in) the second pass
+float: DEFAULT_TIMEOUT - The default amount of seconds after which the first pass final is sent instead
+int: DEFAULT_MAX_MODELS - The default amount of decoders every rescoring process keeps loaded
+OrderedDict: DECODERS - The decoders of a rescoring process by their model key (least recently used first)
+dict: TEXT_PROCESSORS - The text processors of a rescoring process by their nltk model name
+"""
+
+
+def get_decoder(task):
+    """Method to get (or load) the second pass decoder of a task within a rescoring process
+
+    Arguments:
+        task (dict): The rescoring task
+
+    Returns: (Decoder)
+        The second pass decoder of the task's language model
+    """
+    decoder = DECODERS.pop(task["key"], None)
+    if decoder is None:
+        decoder = build_decoder(task["language_model"], task["vocabulary"], DictionaryCache.from_configs(), task["parameters"], False)[0] # The session's profile isn't used
+        while len(DECODERS) >= task["max_models"]:
+            DECODERS.popitem(last=False)
+    DECODERS[task["key"]] = decoder # Move it to the most recently used end
+    return decoder
+
+
+def get_keyphrases(nltk_model, text):
+    """Method to generate the keyphrases of a refined hypothesis within a rescoring process
+
+    Arguments:
+        nltk_model (NLTKModel): The nltk model of the session
+        text (str): The refined hypothesis
+
+    Returns: (list)
+        The scored keyphrases (the same format the session workers send)
+    """
+    from text_processor import TextProcessor
+
+    text_processor = TEXT_PROCESSORS.get(nltk_model.name)
+    if text_processor is None:
+        text_processor = TEXT_PROCESSORS[nltk_model.name] = TextProcessor()
+        text_processor.set_nltk_model(nltk_model)
+    text_processor.generate_keyphrases(text)
+    return [{"score": keyphrase[0], "keyphrase": keyphrase[1]} for keyphrase in text_processor.get_keyphrases()]
+
+
+def rescore_utterance(task):
+    """Method that decodes a whole utterance again (this runs in a rescoring process)
+
+    Arguments:
+        task (dict): The language model, the custom words, the decoder parameters, the base64 wrapped audio and the session flags
+
+    Returns: (dict)
+        The refined result fields or {"error": message} if the second pass failed
+    """
+    try:
+        decoder = get_decoder(task)
+        started_cpu = cpu_time()
+        decoder.start_utt()
+        decoder.process_raw(b64decode(task["pcm"]), False, True) # The whole utterance at once
+        decoder.end_utt()
+
+        hypothesis = decoder.hyp()
+        if hypothesis is None or len(hypothesis.hypstr) == 0:
+            return {"error": "The second pass didn't find any speech"}
+
+        logmath = decoder.get_logmath()
+        result = {
+            "score": hypothesis.best_score,
+            "confidence": logmath.exp(hypothesis.prob),
+            "hypothesis": get_keyphrases(task["nltk_model"], hypothesis.hypstr) if task["keyphrases"] else hypothesis.hypstr
+        }
+        detail = task["detail"]
+        if detail.get("words", False):
+            result["words"] = [[seg.word, seg.start_frame, seg.end_frame, round(logmath.exp(seg.prob), 4)] for seg in decoder.seg()]
+        if detail.get("nbest", 0) > 0:
+            result["nbest"] = [[best.hypstr, best.score] for best in islice(decoder.nbest(), int(detail["nbest"]))]
+        result["_meta"] = {"cpu_ms": (cpu_time() - started_cpu) * 1000} # The second pass is accounted to the session as well
+        return result
+    except Exception as err:
+        return {"error": str(err)}
+
+
+class Rescorer(object):
+    """The pool of second pass processes and its capacity controls
+
+    Attributes:
+        _workers (int): The amount of rescoring processes
+        _max_queue (int): The amount of utterances that can be waiting on (or in) the second pass
+        _timeout (float): The amount of seconds to wait on the second pass before sending the first pass final
+        _parameters (dict): The complete decoder parameters of the second pass (its profile with the second_pass overrides, ex: the wide beams)
+        _max_models (int): The amount of decoders every rescoring process keeps loaded
+        _pool (Pool): The multiprocessing pool (created by start)
+        _pending (int): The amount of utterances currently queued or running in the pool (including the timed out ones)
+        _stats (dict): The rescored, fallback and skipped counters
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_queue=DEFAULT_MAX_QUEUE, timeout=DEFAULT_TIMEOUT, parameters=None, max_models=DEFAULT_MAX_MODELS):
+        self._workers = workers
+        self._max_queue = max_queue
+        self._timeout = timeout
+        self._parameters = parameters or {}
+        self._max_models = max_models
+        self._pool = None
+        self._lock = Lock()
+        self._pending = 0
+        self._stats = {"rescored": 0, "fallbacks": 0, "skipped": 0}
+
+    @staticmethod
+    def from_configs():
+        """Method to create the rescorer described by the stt configurations
+
+        Note:
+            The second pass is built from its own profile (the default profile unless the rescoring sets one),
+            so a fast first pass profile (ex: a low -topn) never leaks into the wide beam decoders
+
+        Returns: (Rescorer)
+            The rescorer or None if the two pass mode is turned off
+        """
+        rescoring = Configs.get_stt().get("rescoring", {})
+        if not rescoring.get("use", False):
+            return None
+        try:
+            parameters = get_profile(rescoring.get("profile"))[1]
+        except ValueError as err:
+            log.error("Rescoring without a profile (err: %s)" % str(err))
+            parameters = {}
+        parameters.update(rescoring.get("second_pass", {}))
+        return Rescorer(rescoring.get("workers", DEFAULT_WORKERS), rescoring.get("max_queue", DEFAULT_MAX_QUEUE),
+                        rescoring.get("timeout", DEFAULT_TIMEOUT), parameters, rescoring.get("max_models", DEFAULT_MAX_MODELS))
+
+    def start(self):
+        """Method to start the rescoring processes"""
+        if self._pool is None:
+            self._pool = Pool(processes=self._workers, initializer=isolate_worker, initargs=("rescoring",))
+            log.info("Started %d rescoring processes", self._workers)
+
+    def submit(self, stt, final, callback):
+        """Method to hand the utterance of a first pass final to the second pass
+
+        Note:
+            The callback is always called once, with the refined final (tagged "rescored") or,
+            if the pool is full, the second pass fails or it times out, with the first pass final
+
+        Arguments:
+            stt (STT): The STT worker that produced the first pass (for its models and flags)
+            final (dict): The first pass final result with the base64 wrapped utterance audio in "_rescore"
+            callback (:obj: method): The method that's called with the final result to send
+        """
+        pcm = final.pop("_rescore", None)
+        if pcm is None:
+            callback(final)
+            return
+        with self._lock:
+            full = self._pool is None or self._pending >= self._max_queue
+            if full:
+                self._stats["skipped"] += 1
+            else:
+                self._pending += 1
+        if full:
+            final["rescored"] = False
+            callback(final)
+            return
+
+        task = {
+            "key": "%s:%s:%s" % (stt.model_fingerprint, stt.vocabulary_key, dumps(self._parameters, sort_keys=True)),
+            "language_model": stt.language_model,
+            "vocabulary": stt.vocabulary,
+            "nltk_model": stt.nltk_model,
+            "parameters": self._parameters,
+            "max_models": self._max_models,
+            "pcm": pcm,
+            "keyphrases": bool(stt.flags.get("keyphrases", {}).get("use", False)),
+            "detail": stt.flags.get("detail", {})
+        }
+
+        sent = []
+        sent_lock = Lock()
+
+        def send(result):
+            with sent_lock:
+                if len(sent) > 0:
+                    return # The timeout (or the result) came first
+                sent.append(True)
+            timer.cancel()
+            with self._lock:
+                self._stats["fallbacks" if result is None or "error" in result else "rescored"] += 1
+
+            if result is None or "error" in result:
+                log.debug("Sending the first pass final (err: %s)", "timeout" if result is None else result["error"])
+                final["rescored"] = False
+                callback(final)
+                return
+            refined = dict(final)
+            refined.update(result)
+            refined["rescored"] = True
+            refined["first_pass"] = final["hypothesis"]
+            callback(refined)
+
+        def done(result):
+            with self._lock:
+                self._pending -= 1 # Only once the pool is done with it, a timed out task still takes up a slot
+            send(result)
+
+        timer = Timer(self._timeout, send, args=(None,))
+        timer.setDaemon(True)
+        timer.start()
+        async_args = {"callback": done}
+        if version_info[0] >= 3:
+            async_args["error_callback"] = lambda err: done({"error": str(err)})
+        try:
+            self._pool.apply_async(rescore_utterance, (task,), **async_args)
+        except Exception as err: # The pool was closed
+            done({"error": str(err)})
+
+    def get_stats(self):
+        """Method to get the rescoring statistics
+
+        Returns: (dict)
+            The rescored, fallback and skipped counters and the amount of pending utterances
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = self._pending
+        return stats
+
+    def close(self):
+        """Method to stop the rescoring processes"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text result cache
+
+This module remembers the results of whole utterances by the content of their audio, so an
+utterance that's sent again (prompts, replays, retries after a reconnect) is answered without
+decoding it. The audio chunks are chained into one hash per chunk boundary: while the chunks
+of an utterance still match a cached utterance they're held back from the STT worker, and once
+the utterance ends on a cached hash, the cached results are replayed instead.
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+from configs import Configs
+from threading import Thread, Lock
+from collections import OrderedDict
+from hashlib import sha1
+from json import dumps, loads
+from os.path import join, isdir, getmtime
+from os import makedirs, listdir, remove, rename, getpid
+
+log = logger("RCACHE")
+
+DEFAULT_MAX_MB = 32
+DEFAULT_DISK_MAX_MB = 256
+DEFAULT_DISK_DIR = "(!cwd!)/cache/results"
+PREFIX_SIZE = 64
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+int: DEFAULT_MAX_MB - The default size (in megabytes) of the in memory cache
+int: DEFAULT_DISK_MAX_MB - The default size (in megabytes) of the on disk cache
+str: DEFAULT_DISK_DIR - The default directory of the on disk cache
+int: PREFIX_SIZE - The approximate amount of bytes every indexed chunk hash costs
+"""
+
+
+def chain_hash(previous, chunk):
+    """Method to chain the hash of an audio chunk onto the hash of the chunks before it
+
+    Arguments:
+        previous (str): The hash of the previous chunks (the cache context for the first chunk)
+        chunk (str): The audio chunk
+
+    Returns: (str)
+        The hex digest of the chunks so far
+    """
+    digest = sha1(previous.encode("utf-8"))
+    digest.update(chunk.encode("utf-8") if not isinstance(chunk, bytes) else chunk)
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """Least recently used cache of utterance results with an optional on disk tier
+
+    Attributes:
+        _max_bytes (int): The maximum size of the in memory entries
+        _disk_dir (str): The directory of the on disk tier (None if it's disabled)
+        _max_disk_bytes (int): The maximum size of the on disk tier
+        _entries (OrderedDict): The final hash to an (entry, size) pair, least recently used first
+        _disk (OrderedDict): The final hash to the (prefixes, size) of the entries that were spilled to disk
+        _prefixes (dict): The chunk hash to the amount of cached utterances that start with those chunks
+        _stats (dict): The hit, miss, eviction and size counters
+
+    Note:
+        An entry is {"prefixes": [chunk hashes], "final": result}, the partial results aren't
+        kept since a replayed utterance is answered as soon as it ends
+    """
+
+    def __init__(self, max_bytes, disk_dir=None, max_disk_bytes=0):
+        self._max_bytes = max_bytes
+        self._disk_dir = disk_dir
+        self._max_disk_bytes = max_disk_bytes
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._disk = OrderedDict()
+        self._prefixes = {}
+        self._bytes = 0
+        self._disk_bytes = 0
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        if self._disk_dir is not None:
+            if not isdir(self._disk_dir):
+                makedirs(self._disk_dir)
+            index_t = Thread(target=self.__index_disk) # Don't hold up the startup on a large disk tier
+            index_t.setDaemon(True)
+            index_t.start()
+
+    @staticmethod
+    def from_configs():
+        """Method to create the result cache described by the stt configurations
+
+        Returns: (ResultCache)
+            The result cache or None if it's turned off
+        """
+        cache_configs = Configs.get_stt().get("result_cache", {})
+        if not cache_configs.get("use", False):
+            return None
+        disk_configs = cache_configs.get("disk", {})
+        disk_dir = Configs.parse_config_path(disk_configs.get("dir", DEFAULT_DISK_DIR)) if disk_configs.get("use", False) else None
+        return ResultCache(int(cache_configs.get("max_mb", DEFAULT_MAX_MB) * 1024 * 1024), disk_dir,
+                           int(disk_configs.get("max_mb", DEFAULT_DISK_MAX_MB) * 1024 * 1024))
+
+    def is_prefix(self, chain):
+        """Method to check if any cached utterance starts with the chunks so far
+
+        Arguments:
+            chain (str): The chained hash of the chunks so far
+
+        Returns: (bool)
+            True if the chunks are (the start of) a cached utterance
+        """
+        return chain in self._prefixes
+
+    def get(self, chain):
+        """Method to get the cached results of a whole utterance
+
+        Arguments:
+            chain (str): The chained hash of all of the chunks of the utterance
+
+        Returns: (dict)
+            The cached entry or None on a miss
+        """
+        with self._lock:
+            cached = self._entries.pop(chain, None)
+            if cached is not None:
+                self._entries[chain] = cached # Move it to the most recently used end
+                self._stats["hits"] += 1
+                return cached[0]
+            on_disk = chain in self._disk
+
+        if on_disk:
+            entry = self.__read_disk(chain)
+            if entry is not None:
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+                self.put(entry) # Promote it back into memory
+                return entry
+
+        self.count_miss()
+        return None
+
+    def count_miss(self):
+        """Method to count an utterance that didn't match any cached utterance"""
+        with self._lock:
+            self._stats["misses"] += 1
+
+    def put(self, entry):
+        """Method to cache the results of a whole utterance
+
+        Arguments:
+            entry (dict): The chunk hashes (the last one is the key) and the final result
+        """
+        chain = entry["prefixes"][-1]
+        size = len(dumps(entry)) + len(entry["prefixes"]) * PREFIX_SIZE
+        if size > self._max_bytes:
+            return
+
+        spilled = []
+        with self._lock:
+            if chain in self._entries:
+                return
+            if chain in self._disk: # It's being promoted, so it only lives in memory again
+                self.__forget_disk(chain)
+            self._entries[chain] = (entry, size)
+            self._bytes += size
+            self.__index(entry["prefixes"], 1)
+            while self._bytes > self._max_bytes:
+                old_chain, (old_entry, old_size) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                self._stats["evictions"] += 1
+                if self._disk_dir is None:
+                    self.__index(old_entry["prefixes"], -1)
+                else:
+                    spilled.append(old_entry) # Keep its prefixes indexed, it's still cached on disk
+
+        for old_entry in spilled:
+            self.__write_disk(old_entry)
+
+    def get_stats(self):
+        """Method to get the cache statistics
+
+        Returns: (dict)
+            The hits, misses, evictions, entry counts, sizes and the hit ratio
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes
+            })
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_ratio"] = round(float(stats["hits"] + stats["disk_hits"]) / lookups, 4) if lookups > 0 else 0.0
+        return stats
+
+    def __index(self, prefixes, change):
+        """Private method to add (or remove) the chunk hashes of an utterance from the prefix index"""
+        for prefix in prefixes:
+            count = self._prefixes.get(prefix, 0) + change
+            if count > 0:
+                self._prefixes[prefix] = count
+            else:
+                self._prefixes.pop(prefix, None)
+
+    def __forget_disk(self, chain):
+        """Private method to remove an entry from the disk tier (the lock must be held)"""
+        prefixes, size = self._disk.pop(chain)
+        self._disk_bytes -= size
+        self.__index(prefixes, -1)
+        try:
+            remove(join(self._disk_dir, "%s.json" % chain))
+        except OSError:
+            pass
+
+    def __write_disk(self, entry):
+        """Private method to spill an evicted entry to the disk tier"""
+        chain = entry["prefixes"][-1]
+        data = dumps(entry)
+        try:
+            temp_path = join(self._disk_dir, "%s.%d.tmp" % (chain, getpid()))
+            with open(temp_path, "w") as e_f:
+                e_f.write(data)
+            rename(temp_path, join(self._disk_dir, "%s.json" % chain))
+        except (IOError, OSError) as err:
+            log.error("Failed writing a cached result to disk (err: %s)" % str(err))
+            with self._lock:
+                self.__index(entry["prefixes"], -1)
+            return
+
+        with self._lock:
+            self._disk[chain] = (entry["prefixes"], len(data))
+            self._disk_bytes += len(data)
+            while self._disk_bytes > self._max_disk_bytes and len(self._disk) > 0:
+                self.__forget_disk(next(iter(self._disk)))
+
+    def __read_disk(self, chain):
+        """Private method to read an entry from the disk tier"""
+        try:
+            with open(join(self._disk_dir, "%s.json" % chain), "r") as e_f:
+                return loads(e_f.read())
+        except (IOError, OSError, ValueError) as err:
+            log.debug("Failed reading the cached result %s (err: %s)", chain, err)
+            with self._lock:
+                if chain in self._disk:
+                    self.__forget_disk(chain)
+            return None
+
+    def __index_disk(self):
+        """Private method to index the entries left on disk by previous runs (oldest first)"""
+        try:
+            names = [f_name for f_name in listdir(self._disk_dir) if f_name.endswith(".json")]
+            names.sort(key=lambda f_name: getmtime(join(self._disk_dir, f_name)))
+        except OSError as err:
+            log.error("Failed listing the on disk result cache (err: %s)" % str(err))
+            return
+
+        for f_name in names:
+            chain = f_name[:-len(".json")]
+            entry = self.__read_disk(chain)
+            if entry is None:
+                continue
+            with self._lock:
+                if chain in self._entries or chain in self._disk:
+                    continue
+                size = len(dumps(entry))
+                self._disk[chain] = (entry["prefixes"], size)
+                self._disk_bytes += size
+                self.__index(entry["prefixes"], 1)
+                while self._disk_bytes > self._max_disk_bytes and len(self._disk) > 0:
+                    self.__forget_disk(next(iter(self._disk)))
+        log.debug("Indexed %d cached results on disk", len(self._disk))
+
+
+class CachedUtterance(object):
+    """The cache state of a single utterance of a session
+
+    Attributes:
+        chain (str): The chained hash of the chunks so far
+        prefixes (list): The chained hash after each chunk
+        held (list): The chunks that were held back from the worker while they matched a cached utterance
+        holding (bool): If the chunks still match a cached utterance (and the worker hasn't started yet)
+    """
+
+    __slots__ = ["chain", "prefixes", "held", "holding"]
+
+    def __init__(self, context):
+        self.chain = context
+        self.prefixes = []
+        self.held = []
+        self.holding = True
+
+    def feed(self, cache, chunk):
+        """Method to add a chunk to the utterance
+
+        Arguments:
+            cache (ResultCache): The result cache
+            chunk (str): The audio chunk
+
+        Returns: (bool)
+            True if the chunk is held back (it still matches a cached utterance)
+        """
+        self.chain = chain_hash(self.chain, chunk)
+        self.prefixes.append(self.chain)
+        if self.holding and cache.is_prefix(self.chain):
+            self.held.append(chunk)
+            return True
+        return False
+
+    def release(self):
+        """Method to stop holding back the chunks
+
+        Returns: (list)
+            The chunks that have been held back so far
+        """
+        self.holding = False
+        held, self.held = self.held, []
+        return held
+
+    def to_entry(self, final):
+        """Method to create the cache entry of the finished utterance
+
+        Arguments:
+            final (dict): The final result of the utterance
+
+        Returns: (dict)
+            The cache entry or None if the utterance had no audio
+        """
+        if len(self.prefixes) == 0:
+            return None
+        return {"prefixes": self.prefixes, "final": final}
@@ -8,22 +8,46 @@ No audio processing is done on the main thread/process
 Developed by: David Smerkous
 """
 
+from startup import ImportProfiler, elapsed_since_start; import_profiler = ImportProfiler(); import_profiler.start()
 from gevent import monkey; monkey.patch_all()
 from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.httpserver import HTTPServer
 from tornado.websocket import WebSocketHandler
-from tornado.web import Application, RequestHandler, StaticFileHandler
-from tornado import options
-from json import dumps, loads
+from tornado.web import Application, RequestHandler, StaticFileHandler, stream_request_body
+from tornado.concurrent import Future
+from tornado import options, gen
+from json import loads
 from logger import logger
 from configs import LanguageModel, Configs
-from audio_processor import STT
+from worker_pool import STTPool, DEFAULT_LOAD_TIMEOUT
+from audio_processor import read_wave_header, make_wave_header
+from session_hub import SessionHub, Subscriber, DEFAULT_MAX_BUFFER, DEFAULT_MAX_SUBSCRIBERS
+from sessions import SessionRegistry, DEFAULT_RESUME_GRACE, DEFAULT_MAX_PARKED
+from decoders import validate_search, validate_vocabulary, get_profile
+from result_cache import ResultCache
+from rescoring import Rescorer
+from accounting import QuotaManager
+from isolation import isolate_frontend
+from governor import MemoryGovernor
+from protocol import encode_json, encode_batch, encode_msgpack, decode_request, has_msgpack, MSGPACK_SUBPROTOCOL
+from text_processor import TextProcessor
+from base64 import b64encode
+from datetime import timedelta
+from time import time
 
 import ssl
 
+import_profiler.stop()
+
 log = logger("SERVER")
 
 configs = Configs()
+stt_pool = STTPool(configs)
+session_hub = SessionHub(IOLoop.instance())
+result_cache = ResultCache.from_configs()
+rescorer = Rescorer.from_configs()
+session_registry = SessionRegistry(IOLoop.instance(), stt_pool, session_hub, result_cache, rescorer)
+memory_governor = MemoryGovernor(IOLoop.instance(), stt_pool, session_registry)
 
 templates_dir = "%s/templates" % configs.get_cwd()
 js_dir = "%s/js" % templates_dir
@@ -31,11 +55,33 @@ css_dir = "%s/css" % templates_dir
 fonts_dir = "%s/fonts" % templates_dir
 less_dir  = "%s/less" % templates_dir
 
+MAX_NBEST = 20
+DEFAULT_STREAM_MAX_MB = 64
+DEFAULT_STREAM_CHUNK_MS = 500
+DEFAULT_FINAL_TIMEOUT = 30
+DEFAULT_STREAM_IN_FLIGHT = 4
+MAX_WAV_HEADER = 65536
+WAV_TYPES = ["audio/wav", "audio/x-wav", "audio/wave"]
+
 ssl_configs = configs.get_ssl()
 ssl_configs["ssl_version"] = ssl.PROTOCOL_TLSv1 # Add the ssl version to the options
 """Global module level definitions
+ImportProfiler: import_profiler - Times the imports of the server (it's started before any other import)
 logger: log - The module log object so that printed calls can be backtraced to this file
 Configs: configs - The globally loaded configuration object that handles the reloading of the json files
+STTPool: stt_pool - The pool of preloaded STT workers that new sessions get their worker from
+SessionHub: session_hub - The registry of read-only subscribers that watch the live sessions
+ResultCache: result_cache - The cache of utterance results for replayed audio (None if it's turned off)
+Rescorer: rescorer - The pool of second pass processes that refine the finals (None if the two pass mode is off)
+SessionRegistry: session_registry - The registry of the attached and parked client sessions
+MemoryGovernor: memory_governor - The admission control that keeps the workers within the memory watermark
+int: MAX_NBEST - The maximum amount of n-best alternatives a client can ask for
+int: DEFAULT_STREAM_MAX_MB - The default maximum size (in megabytes) of a streamed upload
+int: DEFAULT_STREAM_CHUNK_MS - The default duration of the chunks a streamed upload is cut into (without a load monitor recommendation)
+float: DEFAULT_FINAL_TIMEOUT - The default amount of seconds a streamed upload waits on its final hypothesis
+int: DEFAULT_STREAM_IN_FLIGHT - The default amount of chunks of a streamed upload the worker can be behind before the upload stops being read
+int: MAX_WAV_HEADER - The maximum amount of bytes a streamed wav file can have before its samples start
+list: WAV_TYPES - The content types of a streamed upload that are read as a wav file
 str: (-*-)_dir - The server 
 
 """
@@ -44,13 +90,33 @@ class ClientHandler(WebSocketHandler):
     """Websocket client handler for the RemSphinx backend
 
     Attributes:
-        _model (LanguageModel): The currently loaded language model
-        _state (int): The current state of the websocket (sequence insurance)
-        _stt (STT): The multiprocessed Speech To Text processor
+        _session (Session): The client's session (the state, the models and the multiprocessed STT processor)
+        _queued (list): The memory governor queue entry while the session waits on room for its worker (None otherwise)
+        _outbox (list): The messages produced within the current IOLoop tick (sent together once the tick is over)
+        _batching (bool): If the client accepts the messages of a tick as a json array in a single frame
+        _binary (bool): If the client speaks the compact msgpack protocol instead of json (set by select_subprotocol)
 
     Note:
         Each STT object runs as a seperate entity of this thread. So all communication
-        is done through a local socket: Pipe.
+        is done through a local socket: Pipe. The STT object is taken from the stt_pool
+        once the client selects a language model.
+
+        When the websocket drops, the session is parked for a grace period. A reconnecting
+        client sends {"resume": token} to take it back, without reloading the language model.
+
+        A client can identify itself with a token query argument (/ws?token=...), its usage is then
+        also counted against the per token quotas (and not only against the ones of its address)
+
+        The messages are only written on the IOLoop thread. The results of the worker (which arrive on
+        its handler thread) are handed over with add_callback, and everything produced within a single
+        tick is flushed together. A client that connects with /ws?batch=1 gets those as one json array
+
+        A client that offers the remsphinx.msgpack subprotocol (and the server has msgpack installed)
+        sends and receives binary frames with integer message codes instead (see the protocol module),
+        every frame it gets is a batch
+
+        While the memory is above the governor's watermark, a model request is queued ({"queued": position})
+        until there's room for another worker, and new connections are refused once the queue is full
         
 
         WebSocket states:
@@ -60,16 +126,34 @@ class ClientHandler(WebSocketHandler):
             10(2): The client has stopped speaking and reset the state back to waiting
     """
 
+    def initialize(self):
+        """Tornado superclass method that's called before the handshake (and so before select_subprotocol)"""
+        self._binary = False
+
     def __send_json(self, to_write):
         """Private method to send a json to the client
 
+        Note:
+            This must be called on the IOLoop thread, the message is sent once the current tick is over
+
         Arguments:
             to_write (dict): The serializable dictionary to be sent to the client
         """
+        self._outbox.append(to_write)
+        if len(self._outbox) == 1:
+            IOLoop.current().add_callback(self.__flush)
+
+    def __flush(self):
+        """Private method to send the messages of the tick (batched into a single frame if the client accepts it)"""
+        outbox, self._outbox = self._outbox, []
+        if len(outbox) == 0:
+            return
         try:
-            self.write_message(dumps(to_write))
+            for payload in [encode_msgpack(outbox)] if self._binary else encode_batch(outbox, self._batching):
+                self._session.usage.bytes_out += len(payload)
+                self.write_message(payload, binary=self._binary)
         except Exception as err:
-            log.error("Failed sending %s to client!" % to_write)
+            log.error("Failed sending %d messages to client! (err: %s)" % (len(outbox), str(err)))
 
     def __send_error(self, error):
         """Private wrapper method for error handling
@@ -86,34 +170,103 @@ class ClientHandler(WebSocketHandler):
             command (dict): The returned dictionary from the STT subprocess 
 
         Note:
-            This method acts a middle man between the STT multiprocessed application and the websocket client
+            This method acts a middle man between the STT multiprocessed application and the websocket client.
+            The session calls it (after publishing to the read-only subscribers) while a client is attached,
+            usually from the STT subprocess handler thread, so the result is moved over to the IOLoop thread
         """
-        self.__send_json(command) 
+        self._io_loop.add_callback(self.__send_json, command)
 
     def __handle_model(self, model_data):
-        global configs
+        global stt_pool
         """Private method to handle the STT language model loading
         
         Arguments:
-            model_data (dict): The wanted model id's to load
+            model_data (dict): The wanted model id's to load (and optionally the custom vocabulary and the decoder profile of the session)
 
         Note:
-            The model_data objects is converted into a LanguageModel later on
+            The model_data objects is converted into a LanguageModel by the stt_pool
+        """
+        log.debug("Client sent language model! %s", model_data)
+        try:
+            vocabulary = validate_vocabulary(model_data.get("vocabulary", []))
+            profile = model_data.get("profile")
+            if profile is not None:
+                profile = get_profile(str(profile))[0]
+        except ValueError as err:
+            self.__send_json({"success": False})
+            self.__send_error(str(err))
+            return
+        profile = session_registry.monitor.recommend_profile(profile) # A faster one while the cpus are saturated
+
+        reason = session_registry.admit(self._session) # Count the session against the session quotas of the client
+        if reason is not None:
+            log.info("Refused a worker to %s (%s)", self.request.remote_ip, reason)
+            self.__send_json({"success": False})
+            self.__send_error(reason)
+            return
+        if self._queued is not None:
+            memory_governor.cancel(self._queued) # Only the latest model request waits on the governor
+        self._queued = memory_governor.admit(lambda: self.__admit_model(model_data, vocabulary, profile), self.__refuse_model)
+        if self._queued is not None:
+            self.__send_json({"queued": memory_governor.get_position(self._queued)})
+
+    def __refuse_model(self, reason):
+        """Private method to tell the client that the memory governor didn't give it a worker
+
+        Arguments:
+            reason (str): The reason the worker was refused
+        """
+        self._queued = None
+        log.info("Refused a worker to %s (%s)", self.request.remote_ip, reason)
+        self.__send_json({"success": False})
+        self.__send_error(reason)
+
+    def __admit_model(self, model_data, vocabulary, profile):
+        """Private method that's called once the memory governor admitted the session
+
+        Arguments:
+            model_data (dict): The wanted model id's to load
+            vocabulary (dict): The validated custom vocabulary of the session
+            profile (str): The decoder profile name (None for the default profile)
         """
-        log.debug("Client sent language model! %s" % str(model_data))
+        try:
+            self.__load_model(model_data, vocabulary, profile)
+        finally:
+            memory_governor.settle() # The new worker (if any) is measured from here on
+
+    def __load_model(self, model_data, vocabulary, profile):
+        """Private method to load the requested language model once the session was admitted
+
+        Arguments:
+            model_data (dict): The wanted model id's to load
+            vocabulary (dict): The validated custom vocabulary of the session
+            profile (str): The decoder profile name (None for the default profile)
+        """
+        self._queued = None
+        self._session.model_requested = time()
+        self._session.usage.model_loads += 1
+
+        # Give back the previous worker before switching the language model
+        if self._session.stt is not None:
+            stt_pool.release(self._session.stt)
+            self._session.stt = None
+
+        # Get a worker that has (or will have) the requested models loaded
+        stt, warm = stt_pool.acquire(model_data["model"], model_data["accent"], vocabulary, profile)
+        if stt is None:
+            self.__send_json({"success": False})
+            self.__send_error("Failed loading language model!")
+            return
 
-        # Load new LanguageModel and NTLKModel objects based on data from the configuration file
-        print(model_data)
-        load_model = model_data["model"]
-        accent_model = model_data["accent"]
-        self._language_model = configs.get_stt_data(load_model, accent_model)
-        self._nltk_model = configs.get_nltk_data(load_model)
+        self._session.set_stt(stt) # The session forwards the subprocess responses to the local __handle_subprocess method
 
-        # Set the STT language and nltk model objects
-        self._stt.set_models(self._language_model, self._nltk_model)
+        if warm:
+            self._session.model_ready()
+            self.__send_json({"success": True, "session": self._session.id, "token": self._session.token,
+                              "chunk_ms": self._session.advertise_chunk_ms(), "profile": stt.language_model.profile}) # The worker already sent its success message to the pool
 
         # Update the local websocket state to allow the start_audio call
-        self._state = 10
+        self._session.state = 10
     
     def __handle_audio_chunk(self, audio_chunk):
         """Private method to handle a small audio chunk
@@ -127,8 +280,11 @@ class ClientHandler(WebSocketHandler):
         """
         log.debug("Client sent audio chunk!")
 
-        # Send the base64'ed audio chunk to the STT engine
-        self._stt.process_audio_chunk(audio_chunk)
+        # Send the base64'ed audio chunk to the STT engine (unless it's held back by the result cache)
+        exceeded = self._session.feed_audio(audio_chunk)
+        if exceeded is not None: # The client used up its share in the middle of the utterance
+            self.__handle_stop_audio() # The final covers the audio it sent so far
+            self.__refuse_quota(exceeded)
 
     def __handle_start_audio(self):
         """Private method to handle the start_audio client command
@@ -138,11 +294,32 @@ class ClientHandler(WebSocketHandler):
         """
         log.debug("Client started to speak!")
 
+        # Make sure the client hasn't used up its share of the decoding
+        exceeded = session_registry.check_quotas(self._session)
+        if exceeded is not None:
+            self.__refuse_quota(exceeded)
+            return
+
         # Tell the STT engine to start listening for audio chunks
-        self._stt.start_audio_proc()
+        self._session.start_utterance()
 
         # Change the websocket state to that of processing chunks
-        self._state = 20
+        self._session.state = 20
+
+    def __refuse_quota(self, exceeded):
+        """Private method to throttle (or reject) a client that used up its windowed quotas
+
+        Arguments:
+            exceeded (tuple): The reason and the seconds until the client can try again
+        """
+        reason, retry_after = exceeded
+        if QuotaManager.get_quota_configs()["action"] == "reject":
+            log.info("Rejecting %s (%s)", self.request.remote_ip, reason)
+            self.__send_json({"error": reason, "rejected": True})
+            self.close()
+            return
+        log.debug("Throttling %s (%s)", self.request.remote_ip, reason)
+        self.__send_json({"error": reason, "throttled": True, "retry_after": round(retry_after, 1)})
 
     def __handle_stop_audio(self):
         """Private method to handle the stop_audio client command
@@ -153,11 +330,11 @@ class ClientHandler(WebSocketHandler):
         """
         log.debug("Client stopped speaking!")
 
-        # Tell the STT engine to stop listening for audio chunks
-        self._stt.stop_audio_proc()
+        # Tell the STT engine to stop listening for audio chunks (or replay the cached results)
+        self._session.stop_utterance()
 
         # Change the websocket state to that of waiting for the start_audio command
-        self._state = 10
+        self._session.state = 10
 
     def __handle_keyphrases(self, keyphrases):
         """Private method to handle the setting of the keyphrase flag
@@ -167,13 +344,106 @@ class ClientHandler(WebSocketHandler):
             from the given speech
 
         """
-        log.debug("Setting the keyphrase flag to %s" % str(keyphrases))
+        log.debug("Setting the keyphrase flag to %s", keyphrases)
 
         # Tell the STT engine to process the spoken text into keyphrases
         set_keyphrases = {
             "use": keyphrases["set_keyphrases"]
         }
-        self._stt.set_keyphrases(set_keyphrases)
+        self._session.stt.set_keyphrases(set_keyphrases)
+
+    def __handle_detail(self, detail):
+        """Private method to handle the setting of the result detail level
+
+        Note:
+            Word segments and n-best alternatives are only computed for the final hypothesis,
+            and only when the client asked for them
+
+        Arguments:
+            detail (dict): The client message with the set_detail flags
+        """
+        log.debug("Setting the result detail to %s", detail)
+
+        set_detail = detail["set_detail"]
+        try:
+            set_detail = {
+                "words": bool(set_detail.get("words", False)),
+                "nbest": max(0, min(int(set_detail.get("nbest", 0)), MAX_NBEST))
+            }
+        except (AttributeError, TypeError, ValueError):
+            self.__send_error("Invalid result detail!")
+            return
+        self._session.stt.set_detail(set_detail)
+
+    def __handle_set_search(self, search_data):
+        """Private method to add a keyword spotting or grammar search to the session's decoder
+
+        Note:
+            Keyword spotting and small grammars are a lot cheaper to decode than the full
+            language model. The worker answers with "search_ready" once the search can be used
+
+        Arguments:
+            search_data (dict): The client message with the search (name, type and keyphrases or grammar)
+        """
+        try:
+            search = validate_search(search_data["set_search"])
+        except (ValueError, TypeError, IndexError) as err:
+            self.__send_error(str(err))
+            return
+        log.debug("Setting the %s search %s", search["type"], search["name"])
+        self._session.stt.set_search(search)
+
+    def __handle_use_search(self, search_data):
+        """Private method to switch the search of the next utterances
+
+        Arguments:
+            search_data (dict): The client message with the search name ("lm" for the language model)
+        """
+        name = search_data["use_search"]
+        if not isinstance(name, basestring):
+            self.__send_error("Invalid search name!")
+            return
+        self._session.stt.use_search(str(name))
+
+    def __handle_add_words(self, words_data):
+        """Private method to add custom words to the session's decoder
+
+        Note:
+            The words are added to the loaded decoder, so the language model isn't reloaded
+
+        Arguments:
+            words_data (dict): The client message with the [word, pronunciation] pairs
+        """
+        try:
+            vocabulary = validate_vocabulary(words_data["add_words"])
+        except ValueError as err:
+            self.__send_error(str(err))
+            return
+        log.debug("Adding %d custom words", len(vocabulary))
+        self._session.stt.add_words(vocabulary)
+
+    def __handle_resume(self, resume_data):
+        """Private method to take back a session that was parked when the client disconnected
+
+        Note:
+            The parked STT worker still has its decoder (and any running utterance), so
+            no language model has to be reloaded
+
+        Arguments:
+            resume_data (dict): The client message with the resume token
+        """
+        session = session_registry.resume(str(resume_data["resume"]))
+        if session is None:
+            log.debug("Client %s presented an unknown resume token", self.request.remote_ip)
+            self.__send_json({"resumed": False})
+            return
+
+        # Throw away the fresh session that was created for this connection
+        session_registry.end(self._session)
+        self._session = session
+        self.__send_json({"resumed": True, "success": True, "session": session.id, "token": session.token, "state": session.state,
+                          "chunk_ms": session.advertise_chunk_ms()})
+        session.attach(self.__handle_subprocess) # Send the results that arrived while the client was away
 
     def open(self):
         """The WebSocket wrapped constructor per individual client
@@ -181,12 +451,17 @@ class ClientHandler(WebSocketHandler):
         Note:
             A new object is created everytime a client is connected to the server
         """
-        self._language_model = None # Set the current language model to None
-        self._nltk_model = None # Set the current nltk model to None
-        self._state = 0 # Set the initial websocket state to not initialized
-        self._stt = STT() # Create the new Speech To Text object
-        self._stt.set_subprocess_callback(self.__handle_subprocess) # Attach the subprocess callback method to the local __handle_subprocess method
-        log.debug("Connected to %s" % self.request.remote_ip)
+        self._queued = None
+        self._outbox = []
+        self._batching = self.get_argument("batch", "0") in ["1", "true"]
+        self._io_loop = IOLoop.current()
+        self._session = session_registry.open(self.request.remote_ip, self.get_argument("token", None)) # Create the new session (the Speech To Text object is taken from the pool once a model is selected)
+        self._session.attach(self.__handle_subprocess)
+        log.debug("Connected to %s", self.request.remote_ip)
+        if memory_governor.is_saturated(): # There's no room for another worker and the queue is full
+            self.__send_error("The server is out of memory, try again later!")
+            self.__flush() # Before the connection is closed
+            self.close()
 
     def on_message(self, message):
         """The WebSocket superclass on_message method
@@ -195,10 +470,15 @@ class ClientHandler(WebSocketHandler):
             message (str): The full message that the client sent
         """
         
+        self._session.usage.bytes_in += len(message) if isinstance(message, bytes) else len(message.encode("utf-8")) # Text frames arrive decoded
+
         # Make sure the returned message is a json before continue
         j_obj = {}
         try:
-            j_obj = loads(message) # Decode the json into a dictionary
+            if self._binary and isinstance(message, bytes):
+                j_obj = decode_request(message) # Turn the compact request into the json one
+            else:
+                j_obj = loads(message) # Decode the json into a dictionary
         except Exception as err:
             log.debug("Failed decoding packet! (err: %s)" % str(err))
             self.__send_error(err)
@@ -206,31 +486,59 @@ class ClientHandler(WebSocketHandler):
 
 
         # Check the available states and commands to select the best one
-        if "model" in j_obj:
+        if "resume" in j_obj and self._session.state == 0:
+            self.__handle_resume(j_obj) # Take back the session of a previous connection
+        elif "model" in j_obj:
             self.__handle_model(j_obj) # Load a model anytime you want
-        elif "start_speech" in j_obj and self._state == 10: # To start speech make sure we have loaded a model
+        elif "start_speech" in j_obj and self._session.state == 10: # To start speech make sure we have loaded a model
             self.__handle_start_audio()
-        elif "start_speech" in j_obj and self._state < 10: # Send an error if the model isn't set
+        elif "start_speech" in j_obj and self._session.state < 10: # Send an error if the model isn't set
             self.__send_error("The language model is not currently set!")
-        elif "audio" in j_obj and self._state == 20: # To sent an audio chunk, make sure that the model has been loaded and that start_speech has been called
+        elif "audio" in j_obj and self._session.state == 20: # To sent an audio chunk, make sure that the model has been loaded and that start_speech has been called
             self.__handle_audio_chunk(j_obj)
-        elif "audio" in j_obj and self._state < 20: # Send an error otherwise
+        elif "audio" in j_obj and self._session.state < 20: # Send an error otherwise
             self.__send_error("The language model is not currentl set, and/or the start speech command hasn't been sent!")
-        elif "end_speech" in j_obj and self._state == 20: # Make sure that start_speech has been called before calling end_speech
+        elif "end_speech" in j_obj and self._session.state == 20: # Make sure that start_speech has been called before calling end_speech
             self.__handle_stop_audio()
-        elif "end_speech" in j_obj and self._state != 20: # Send an error indicating that an unnecessary call has been made
+        elif "end_speech" in j_obj and self._session.state != 20: # Send an error indicating that an unnecessary call has been made
             self.__send_error("Unecessary end speech has been called!")
-        elif "set_keyphrases" in j_obj:
+        elif "set_keyphrases" in j_obj and self._session.state >= 10:
             self.__handle_keyphrases(j_obj) # Set the keyphrases flag to either True or False
+        elif "set_detail" in j_obj and self._session.state >= 10:
+            self.__handle_detail(j_obj) # Set the word segment and n-best detail of the final results
+        elif "set_search" in j_obj and self._session.state >= 10:
+            self.__handle_set_search(j_obj) # Add a keyword spotting or grammar search
+        elif "use_search" in j_obj and self._session.state >= 10:
+            self.__handle_use_search(j_obj) # Switch between the language model and the added searches
+        elif "add_words" in j_obj and self._session.state >= 10:
+            self.__handle_add_words(j_obj) # Add custom words (with their pronunciations) to the decoder
 
     def on_close(self):
         """The WebSocket superclass on_close method
     
         Note:
-            This will shutdown the STT engine 
+            This will park the session, the STT engine is shutdown once the grace period is over
         """
         log.info("Closed connection to %s" % self.request.remote_ip)
-        self._stt.shutdown() # Tell the STT engine to shutdown
+        if self._queued is not None:
+            memory_governor.cancel(self._queued)
+            self._queued = None
+        sessions = Configs.get_server().get("sessions", {})
+        session_registry.park(self._session, sessions.get("resume_grace", DEFAULT_RESUME_GRACE), sessions.get("max_parked", DEFAULT_MAX_PARKED)) # Keep the STT engine around for a reconnect
+
+    def select_subprotocol(self, subprotocols):
+        """Websocket superclass method to pick the protocol the client offered in the handshake
+
+        Arguments:
+            subprotocols (list): The subprotocols the client offered
+
+        Returns: (str)
+            The msgpack subprotocol if it was offered (and msgpack is installed), otherwise None for json
+        """
+        if MSGPACK_SUBPROTOCOL in subprotocols and has_msgpack():
+            self._binary = True # Recorded here, tornado only has selected_subprotocol since 5.1
+            return MSGPACK_SUBPROTOCOL
+        return None
 
     def allow_draft76(self):
         """Websocket superclass method to allow various websocket drafts and methods
@@ -251,6 +559,360 @@ class ClientHandler(WebSocketHandler):
         """
         return True
 
+class WatchHandler(WebSocketHandler):
+    """Read-only websocket that streams the live results of another client's session
+
+    Note:
+        The watcher never sends audio, every message it sends is ignored
+    """
+
+    def open(self, session_id):
+        subscribers = Configs.get_server().get("subscribers", {})
+        self._session_id = session_id
+        self._subscriber = Subscriber(self.write_message, self.close, subscribers.get("max_buffer", DEFAULT_MAX_BUFFER))
+        if session_registry.get_session(session_id) is None: # Don't let watchers pile up on sessions that don't exist
+            self.write_message(encode_json({"error": "Unknown session!"}))
+            self.close()
+            return
+        if not session_hub.subscribe(session_id, self._subscriber, subscribers.get("max_per_session", DEFAULT_MAX_SUBSCRIBERS)):
+            self.write_message(encode_json({"error": "The session has too many subscribers!"}))
+            self.close()
+            return
+        log.debug("Watcher %s attached to %s", self.request.remote_ip, session_id)
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        session_hub.unsubscribe(self._session_id, self._subscriber)
+
+    def check_origin(self, origin):
+        return True
+
+class EventStreamHandler(RequestHandler):
+    """Server-Sent Events endpoint that streams the live results of another client's session
+
+    Note:
+        Every result is sent as a single "data:" event
+    """
+
+    @gen.coroutine
+    def get(self, session_id):
+        subscribers = Configs.get_server().get("subscribers", {})
+        self._session_id = session_id
+        self._done = Future()
+        self._subscriber = Subscriber(self.__send_event, self.__end, subscribers.get("max_buffer", DEFAULT_MAX_BUFFER))
+        if session_registry.get_session(session_id) is None:
+            self.set_status(404)
+            self.finish({"error": "Unknown session!"})
+            return
+        if not session_hub.subscribe(session_id, self._subscriber, subscribers.get("max_per_session", DEFAULT_MAX_SUBSCRIBERS)):
+            self.set_status(503)
+            self.finish({"error": "The session has too many subscribers!"})
+            return
+
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        self.flush()
+        yield self._done # Keep the stream open until the session ends or the watcher leaves
+        if not self._finished:
+            self.finish()
+
+    def __send_event(self, payload):
+        self.write("data: %s\n\n" % payload)
+        return self.flush()
+
+    def __end(self):
+        if not self._done.done():
+            self._done.set_result(None)
+
+    def on_connection_close(self):
+        session_hub.unsubscribe(self._session_id, self._subscriber)
+        self.__end()
+
+@stream_request_body
+class StreamHandler(RequestHandler):
+    """HTTP endpoint that transcribes a streamed (chunked) upload of raw PCM or WAV audio
+
+    Note:
+        POST /stream?model=0&accent=us[&format=pcm&rate=16000&channels=1&width=2][&profile=fast][&token=...]
+
+        The audio is cut into chunks and decoded while it's still being received. Every result is
+        written back as a line of json (the partial results first and the final hypothesis last).
+        Without a format argument, a wav content type is read as a wav file and anything else as
+        raw 16KHz, 16 bit mono PCM. Each upload is a single utterance of its own session, the rest of
+        the audio is dropped once the client uses up its windowed quotas in the middle of the upload
+
+        The upload is only read while the worker is less than max_in_flight chunks behind it (a chunk
+        counts as answered once its partial result is back), so a slow worker holds back the client
+        instead of the chunks piling up in the worker's pipe (and its writes blocking the IOLoop)
+    """
+
+    @gen.coroutine
+    def prepare(self):
+        self._session = None
+        self._queued = None
+        self._closed = False
+        self._format = None
+        self._failed = None
+        self._exceeded = None
+        self._buffer = bytearray()
+        self._admitted = Future()
+        self._ready = Future()
+        self._final = Future()
+        self._caught_up = None
+        stream_configs = Configs.get_server().get("stream", {})
+        self._max_in_flight = max(int(stream_configs.get("max_in_flight", DEFAULT_STREAM_IN_FLIGHT)), 1)
+        self.request.connection.set_max_body_size(int(stream_configs.get("max_mb", DEFAULT_STREAM_MAX_MB) * 1024 * 1024))
+
+        try:
+            l_id, accent = int(self.get_argument("model")), self.get_argument("accent")
+            content_type = self.request.headers.get("Content-Type", "").split(";")[0].strip()
+            audio_format = self.get_argument("format", "wav" if content_type in WAV_TYPES else "pcm")
+            if audio_format not in ["wav", "pcm"]:
+                raise ValueError("The format has to be wav or pcm!")
+            if audio_format == "pcm":
+                pcm_format = (int(self.get_argument("rate", 16000)), int(self.get_argument("channels", 1)), int(self.get_argument("width", 2)))
+            profile = self.get_argument("profile", None)
+            if profile is not None:
+                profile = get_profile(profile)[0]
+        except ValueError as err:
+            self.__fail(400, "Invalid stream arguments! (%s)" % str(err))
+            return
+
+        session = self._session = session_registry.open(self.request.remote_ip, self.get_argument("token", None))
+        reason = session_registry.admit(session)
+        exceeded = session_registry.check_quotas(session) if reason is None else None
+        if reason is not None or exceeded is not None:
+            self.__fail(429, reason if reason is not None else exceeded[0])
+            return
+
+        self._queued = memory_governor.admit(lambda: self._admitted.set_result(None), self._admitted.set_result)
+        refused = yield self._admitted # Wait until there's room for another worker (or the governor gives up)
+        self._queued = None
+        if refused is not None or self._closed:
+            if refused is None:
+                memory_governor.settle()
+            self.__fail(503, refused or "The client disconnected!")
+            return
+
+        session.model_requested = time()
+        session.usage.model_loads += 1
+        stt, warm = stt_pool.acquire(l_id, accent, profile=session_registry.monitor.recommend_profile(profile))
+        memory_governor.settle() # The new worker (if any) is measured from here on
+        if stt is None:
+            self.__fail(400, "Failed loading language model!")
+            return
+        session.attach(self.__on_result)
+        session.set_stt(stt)
+        if not warm: # Wait on the worker to load the language model before reading any audio
+            try:
+                load_timeout = Configs.get_stt().get("pool", {}).get("load_timeout", DEFAULT_LOAD_TIMEOUT)
+                loaded = yield gen.with_timeout(timedelta(seconds=load_timeout), self._ready)
+            except gen.TimeoutError:
+                loaded = False
+            if not loaded:
+                self.__fail(503, "Failed loading language model!")
+                return
+        session.model_ready()
+        session.state = 10
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        self.set_header("Cache-Control", "no-cache")
+        if audio_format == "pcm":
+            self.__start(*pcm_format)
+
+    def data_received(self, chunk):
+        if self._session is None or self._failed is not None or self._exceeded is not None:
+            return
+        self._session.usage.bytes_in += len(chunk)
+        self._buffer += chunk
+        if self._format is None: # Still reading the wav header
+            try:
+                header = read_wave_header(bytes(self._buffer))
+                if header is None:
+                    if len(self._buffer) > MAX_WAV_HEADER:
+                        raise ValueError("The wav header is too large!")
+                    return
+            except ValueError as err:
+                self._failed = str(err)
+                return
+            del self._buffer[:header[0]]
+            self.__start(*header[2:])
+        self.__send_chunks(False)
+        if self._session is not None and self._session.get_unanswered_chunks() >= self._max_in_flight:
+            self._caught_up = Future()
+            return self._caught_up # Tornado stops reading the upload until the worker catches up
+
+    @gen.coroutine
+    def post(self):
+        if self._failed is None and self._format is None:
+            self._failed = "The wav header is incomplete!"
+        if self._failed is not None:
+            self.__fail(400, self._failed)
+            return
+
+        if self._exceeded == "reject":
+            self.__end()
+            if not self._closed:
+                self.finish()
+            return
+        elif self._exceeded is None:
+            self.__send_chunks(True)
+        self._session.stop_utterance()
+        self._session.state = 10
+        try:
+            final_timeout = Configs.get_server().get("stream", {}).get("final_timeout", DEFAULT_FINAL_TIMEOUT)
+            yield gen.with_timeout(timedelta(seconds=final_timeout), self._final)
+        except gen.TimeoutError:
+            self.__write_result({"error": "Timed out waiting on the final hypothesis!"})
+        if not self._closed:
+            self.finish()
+
+    def on_finish(self):
+        self.__end()
+
+    def on_connection_close(self):
+        self._closed = True
+        if self._queued is not None:
+            memory_governor.cancel(self._queued)
+            self._queued = None
+        self.__end()
+        for future in [self._admitted, self._ready, self._final, self._caught_up]:
+            if future is not None and not future.done():
+                future.set_result(False)
+
+    def __start(self, rate, channels, width):
+        """Private method to start the utterance once the format of the audio is known"""
+        if rate <= 0 or channels not in [1, 2] or width not in [1, 2, 3, 4]:
+            self._failed = "Unsupported audio format!"
+            return
+        self._format = (rate, channels, width)
+        self._session.start_utterance()
+        self._session.state = 20
+
+    def __send_chunks(self, last):
+        """Private method to send the buffered audio to the worker in chunks of the recommended duration
+
+        Note:
+            The worker pipe only carries text, so each chunk is sent the way the websocket
+            clients send theirs (a base64 wrapped wav file), with the header added here
+
+        Arguments:
+            last (bool): If the upload is complete (the rest of the buffer is sent as well)
+        """
+        if self._format is None:
+            return
+        rate, channels, width = self._format
+        frame = channels * width
+        chunk_ms = self._session.advertise_chunk_ms() or DEFAULT_STREAM_CHUNK_MS
+        chunk_bytes = max(int(rate * chunk_ms / 1000.0) * frame, frame)
+        while len(self._buffer) >= (frame if last else chunk_bytes):
+            size = min(chunk_bytes, len(self._buffer) - len(self._buffer) % frame)
+            wav = make_wave_header(size, rate, channels, width) + bytes(self._buffer[:size])
+            del self._buffer[:size]
+            exceeded = self._session.feed_audio({"audio": b64encode(wav).decode("ascii")})
+            if exceeded is not None: # The client used up its share in the middle of the upload, the rest is dropped
+                self.__refuse_quota(exceeded)
+                return
+
+    def __refuse_quota(self, exceeded):
+        """Private method to stop decoding the upload of a client that used up its windowed quotas
+
+        Note:
+            A throttled upload still gets the final of the audio that was decoded, a rejected one doesn't
+
+        Arguments:
+            exceeded (tuple): The reason and the seconds until the client can try again
+        """
+        reason, retry_after = exceeded
+        self._exceeded = QuotaManager.get_quota_configs()["action"]
+        del self._buffer[:]
+        log.debug("Refusing the streamed upload of %s (%s)", self.request.remote_ip, reason)
+        if self._exceeded == "reject":
+            self.__write_result({"error": reason, "rejected": True})
+        else:
+            self.__write_result({"error": reason, "throttled": True, "retry_after": round(retry_after, 1)})
+
+    def __on_result(self, command):
+        """Private method that the session calls with every result (from the STT subprocess handler thread)"""
+        IOLoop.instance().add_callback(self.__handle_result, command)
+
+    def __handle_result(self, command):
+        """Private method to write a result of the session back to the client (on the IOLoop thread)"""
+        if self._caught_up is not None and not self._caught_up.done():
+            if "error" in command or self._session is None or self._session.get_unanswered_chunks() < self._max_in_flight:
+                self._caught_up.set_result(True) # Read the next part of the upload
+        if "success" in command or ("error" in command and not self._ready.done()):
+            if not self._ready.done():
+                self._ready.set_result(command.get("success", False))
+            return
+        if "decoder" in command or self._format is None:
+            return # Only the acknowledgements of the utterance start
+        self.__write_result(command)
+        if "hypothesis" in command and not command.get("segmented", False) and not self._final.done():
+            self._final.set_result(True)
+
+    def __write_result(self, command):
+        """Private method to write a single json line (and flush it right away)"""
+        if self._finished or self._closed:
+            return
+        payload = "%s\n" % encode_json(command)
+        if self._session is not None:
+            self._session.usage.bytes_out += len(payload)
+        self.write(payload)
+        self.flush()
+
+    def __fail(self, status, message):
+        """Private method to answer with an error and end the session"""
+        log.debug("Streamed upload from %s failed (%s)", self.request.remote_ip, message)
+        self.__end()
+        if not self._finished and not self._closed:
+            self.set_status(status)
+            self.finish({"error": message})
+
+    def __end(self):
+        """Private method to end the session (and give its worker back to the pool)"""
+        if self._session is not None:
+            session_registry.end(self._session)
+            self._session = None
+
+class StatsHandler(RequestHandler):
+    """Class to return the server statistics as a json
+
+    Note:
+        The statistics of the result cache, the decoding load, the rescoring pool and the memory headroom
+    """
+    def get(self):
+        self.finish({
+            "result_cache": None if result_cache is None else result_cache.get_stats(),
+            "load": session_registry.monitor.get_stats(),
+            "rescoring": None if rescorer is None else rescorer.get_stats(),
+            "memory": memory_governor.get_stats()
+        })
+
+class AdminSessionsHandler(RequestHandler):
+    """Class to return the resource usage of every live session and client as a json
+
+    Note:
+        The admin key of the server configurations has to be sent in the X-Admin-Key header,
+        without a configured key the endpoint is disabled
+    """
+    def get(self):
+        admin_key = Configs.get_server().get("admin", {}).get("key")
+        if admin_key is None:
+            self.set_status(403)
+            self.finish({"error": "The admin endpoint is disabled!"})
+            return
+        elif self.request.headers.get("X-Admin-Key") != admin_key:
+            self.set_status(403)
+            self.finish({"error": "Invalid admin key!"})
+            return
+        self.finish({
+            "sessions": [session.get_report() for session in session_registry.get_sessions()],
+            "clients": session_registry.quotas.get_stats()
+        })
+
 class IndexPageHandler(RequestHandler):
     """Class to handle the return of index.html
 
@@ -270,6 +932,11 @@ class AudioServer(Application):
         handlers = [
             (r'/', IndexPageHandler),
             (r'/ws', ClientHandler),
+            (r'/stream', StreamHandler),
+            (r'/watch/([0-9a-f]+)', WatchHandler),
+            (r'/events/([0-9a-f]+)', EventStreamHandler),
+            (r'/stats', StatsHandler),
+            (r'/admin/sessions', AdminSessionsHandler),
             (r'/js/(.*)', StaticFileHandler, {'path': js_dir}),
             (r'/css/(.*)', StaticFileHandler, {'path': css_dir}),
             (r'/fonts/(.*)', StaticFileHandler, {'path': fonts_dir}),
@@ -282,10 +949,39 @@ class AudioServer(Application):
 
         Application.__init__(self, handlers, **settings)
 
+def warm_start():
+    """Method to load everything the first clients would otherwise wait on
+
+    Note:
+        The nltk data is loaded before the pool forks its workers, so every
+        worker starts with the tokenizer and the stopwords already in memory
+    """
+    started = time()
+    TextProcessor.warm_up(list(set(Configs.get_nltk()["stopwords"].values())))
+    log.info("Loaded the nltk data in %.1f ms", (time() - started) * 1000)
+
+    if rescorer is not None:
+        rescorer.start() # Fork the second pass processes before the session workers
+
+    started = time()
+    stt_pool.start(wait=True) # Block until the configured language models are loaded
+    log.info("Preloaded the language models in %.1f ms", (time() - started) * 1000)
+
 if __name__ == "__main__":
     # Parse command line options for the tornado web server
     options.parse_command_line()
 
+    log.info("Slowest startup imports:\n%s", import_profiler.report())
+
+    # Reserve the front end's cpus before any worker is forked
+    isolate_frontend()
+
+    # Load the nltk data and the configured language models before accepting any connections
+    warm_start()
+
+    # Watch the worker memory before accepting any connections
+    memory_governor.start()
+
     # Create the AudioServer wrapped tornado application
     application = AudioServer()
 
@@ -300,7 +996,7 @@ if __name__ == "__main__":
 
     # Set the tornado server's endpoint
     server.listen(server_port)
-    log.info("Listening on port %d" % server_port)
+    log.info("Listening on port %d (ready after %.1f ms)" % (server_port, elapsed_since_start() * 1000))
     
     # Start the tornado server loop
     IOLoop.instance().start()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text session result fan-out
+
+This module lets any amount of read-only subscribers (dashboards, captioning displays) watch
+the live results of a session without running the recognition again. Every result is
+serialized once and then handed to each subscriber's bounded buffer.
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+from threading import Lock
+from collections import deque
+from protocol import encode_json
+
+log = logger("SUBHUB")
+
+DEFAULT_MAX_BUFFER = 64
+DEFAULT_MAX_SUBSCRIBERS = 16
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+int: DEFAULT_MAX_BUFFER - The default amount of results a subscriber can fall behind before it's dropped
+int: DEFAULT_MAX_SUBSCRIBERS - The default maximum amount of subscribers per session
+"""
+
+
+class Subscriber(object):
+    """A single read-only watcher of a session
+
+    Attributes:
+        _send (:obj: method): The method that writes a payload and returns a Future that resolves once it's written
+        _drop (:obj: method): The method that disconnects the watcher
+        _buffer (deque): The serialized results that haven't been written yet
+        _max_buffer (int): The amount of pending results after which the subscriber is considered too slow
+        _writing (bool): If a write is currently in flight
+
+    Note:
+        All of the methods must be called on the IOLoop thread
+    """
+
+    def __init__(self, send, drop, max_buffer=DEFAULT_MAX_BUFFER):
+        self._send = send
+        self._drop = drop
+        self._buffer = deque()
+        self._max_buffer = max_buffer
+        self._writing = False
+        self._closing = False
+        self._dropped = False
+
+    def push(self, payload):
+        """Method to queue a serialized result for the subscriber
+
+        Arguments:
+            payload (str): The serialized result
+
+        Returns: (bool)
+            False if the subscriber fell too far behind and has been dropped
+        """
+        if self._dropped:
+            return False
+        if len(self._buffer) >= self._max_buffer:
+            log.warning("Dropping a slow subscriber (%d results behind)", len(self._buffer))
+            self.drop()
+            return False
+        self._buffer.append(payload)
+        self.__flush()
+        return True
+
+    def finish(self):
+        """Method to disconnect the subscriber once its pending results have been written"""
+        self._closing = True
+        if not self._writing and len(self._buffer) == 0:
+            self.drop()
+
+    def drop(self):
+        """Method to disconnect the subscriber and forget its pending results"""
+        if self._dropped:
+            return
+        self._dropped = True
+        self._buffer.clear()
+        try:
+            self._drop()
+        except Exception as err:
+            log.debug("Failed closing a subscriber (err: %s)", err)
+
+    def __flush(self):
+        """Private method to write the next pending result (one write in flight at a time)"""
+        if self._writing or self._dropped or len(self._buffer) == 0:
+            return
+        self._writing = True
+        try:
+            future = self._send(self._buffer.popleft())
+        except Exception as err:
+            log.debug("Failed writing to a subscriber (err: %s)", err)
+            self._writing = False
+            self.drop()
+            return
+        future.add_done_callback(self.__on_written)
+
+    def __on_written(self, future):
+        """Private method that's called once the previous write has been flushed"""
+        self._writing = False
+        if future.exception() is not None:
+            self.drop()
+            return
+        if self._closing and len(self._buffer) == 0:
+            self.drop()
+            return
+        self.__flush()
+
+
+class SessionHub(object):
+    """Registry of the subscribers that watch each session
+
+    Attributes:
+        _io_loop (IOLoop): The tornado IOLoop that the subscribers live on
+        _lock (Lock): The lock that guards the subscribers dictionary
+        _subscribers (dict): The session id to a list of Subscriber objects
+    """
+
+    def __init__(self, io_loop):
+        self._io_loop = io_loop
+        self._lock = Lock()
+        self._subscribers = {}
+
+    def subscribe(self, session_id, subscriber, max_subscribers=DEFAULT_MAX_SUBSCRIBERS):
+        """Method to attach a subscriber to a session
+
+        Arguments:
+            session_id (str): The id of the session to watch
+            subscriber (Subscriber): The new subscriber
+            max_subscribers (int): The maximum amount of subscribers of a single session
+
+        Returns: (bool)
+            True if the subscriber was attached, False if the session has too many subscribers
+        """
+        with self._lock:
+            subscribers = self._subscribers.setdefault(session_id, [])
+            if len(subscribers) >= max_subscribers:
+                return False
+            subscribers.append(subscriber)
+        log.debug("Subscriber attached to %s", session_id)
+        return True
+
+    def unsubscribe(self, session_id, subscriber):
+        """Method to detach a subscriber from a session
+
+        Arguments:
+            session_id (str): The id of the watched session
+            subscriber (Subscriber): The subscriber to detach
+        """
+        with self._lock:
+            subscribers = self._subscribers.get(session_id, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+            if len(subscribers) == 0:
+                self._subscribers.pop(session_id, None)
+
+    def has_subscribers(self, session_id):
+        """Method to check if anyone is watching a session
+
+        Arguments:
+            session_id (str): The id of the session
+
+        Returns: (bool)
+            True if the session has at least one subscriber
+        """
+        return session_id in self._subscribers
+
+    def publish(self, session_id, result):
+        """Method to send a result to every subscriber of a session
+
+        Note:
+            This is safe to call from any thread. The result is only serialized
+            once (and not at all when nobody is watching)
+
+        Arguments:
+            session_id (str): The id of the session the result belongs to
+            result (dict): The result to send to the subscribers
+        """
+        if not self.has_subscribers(session_id):
+            return
+        payload = encode_json(result)
+        self._io_loop.add_callback(self.__fan_out, session_id, payload)
+
+    def close_session(self, session_id):
+        """Method to disconnect every subscriber of a session that has ended
+
+        Arguments:
+            session_id (str): The id of the ended session
+        """
+        if not self.has_subscribers(session_id):
+            return
+        self.publish(session_id, {"closed": True})
+        self._io_loop.add_callback(self.__drop_all, session_id)
+
+    def __fan_out(self, session_id, payload):
+        """Private method that hands the serialized result to each subscriber (on the IOLoop thread)"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(session_id, []))
+        for subscriber in subscribers:
+            if not subscriber.push(payload):
+                self.unsubscribe(session_id, subscriber)
+
+    def __drop_all(self, session_id):
+        """Private method that disconnects all subscribers of a session (on the IOLoop thread)"""
+        with self._lock:
+            subscribers = self._subscribers.pop(session_id, [])
+        for subscriber in subscribers:
+            subscriber.finish()
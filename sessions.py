@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text client sessions
+
+This module keeps the state of every client session apart from its websocket. When a
+websocket drops, its session (and the STT worker with the loaded decoder) is parked for a
+grace period, so a reconnecting client can present its token and continue where it left off.
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+from result_cache import CachedUtterance
+from load_monitor import LoadMonitor
+from accounting import SessionUsage, QuotaManager
+from threading import Lock
+from collections import deque
+from uuid import uuid4
+from json import dumps
+from time import time
+
+import startup
+
+log = logger("SESSNS")
+
+DEFAULT_RESUME_GRACE = 30
+DEFAULT_MAX_PARKED = 64
+MAX_PENDING_RESULTS = 32
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+int: DEFAULT_RESUME_GRACE - The default amount of seconds a dropped session is kept for a reconnect
+int: DEFAULT_MAX_PARKED - The default maximum amount of sessions that can be parked at once
+int: MAX_PENDING_RESULTS - The amount of results kept for a parked session until it's resumed
+"""
+
+
+class Session(object):
+    """A single client session
+
+    Attributes:
+        id (str): The public id of the session (used by the read-only subscribers)
+        token (str): The secret token the client presents to resume the session
+        remote_ip (str): The address of the client that opened the session
+        client_token (str): The token the client identified itself with (None if it didn't)
+        usage (SessionUsage): The resources the session used so far
+        admitted (bool): If the session is counted against the session quotas of its client
+        stt (STT): The multiprocessed Speech To Text processor of the session
+        state (int): The current state of the session (see ClientHandler)
+        language_model (LanguageModel): The currently loaded language model
+        nltk_model (NLTKModel): The currently loaded nltk model
+        model_requested (float): The time the client last asked for a language model
+        _hub (SessionHub): The hub that the results are published to
+        _cache (ResultCache): The cache of utterance results (None if it's turned off)
+        _monitor (LoadMonitor): The load monitor that gets the decode measurements of the worker
+        _rescorer (Rescorer): The second pass pool that refines the finals (None if the two pass mode is off)
+        _quotas (QuotaManager): The quotas the usage of the session is counted against
+        chunk_ms (int): The chunk duration the client was last asked to use
+        _utterance (CachedUtterance): The cache state of the current utterance
+        _number (int): The number of the current utterance (the worker tags the utterance's results with it)
+        _recording (dict): The utterance number to the utterances that were decoded and are waiting on their final result
+        _sent (int): The amount of audio chunks that were passed on to the current worker
+        _decoded (int): The amount of those chunks the worker sent a result for
+        _send (:obj: method): The method that sends a result to the attached client (None while parked)
+        _pending (deque): The results that arrived while the session was parked
+        _ordered (deque): The [result] slots of the results waiting to be delivered in the order the worker sent them
+            (a final that's being rescored keeps an empty slot, which holds back every result after it)
+        _order_lock (Lock): The lock that's held while the results are put into (or delivered from) their slots
+    """
+
+    __slots__ = ["id", "token", "remote_ip", "client_token", "usage", "admitted", "stt", "state", "language_model", "nltk_model",
+                 "model_requested", "chunk_ms", "_hub", "_cache", "_monitor", "_rescorer", "_quotas", "_utterance", "_number", "_recording",
+                 "_sent", "_decoded", "_lock", "_send", "_pending", "_ordered", "_order_lock"]
+
+    def __init__(self, remote_ip, hub, cache=None, monitor=None, rescorer=None, client_token=None, quotas=None):
+        self.id = uuid4().hex
+        self.token = uuid4().hex
+        self.remote_ip = remote_ip
+        self.client_token = client_token
+        self.usage = SessionUsage()
+        self.admitted = False
+        self.stt = None
+        self.state = 0
+        self.language_model = None
+        self.nltk_model = None
+        self.model_requested = None
+        self._hub = hub
+        self._cache = cache
+        self._monitor = monitor
+        self._rescorer = rescorer
+        self._quotas = quotas
+        self.chunk_ms = None
+        self._utterance = None
+        self._number = 0
+        self._recording = {}
+        self._sent = 0
+        self._decoded = 0
+        self._lock = Lock()
+        self._send = None
+        self._pending = deque(maxlen=MAX_PENDING_RESULTS)
+        self._ordered = deque()
+        self._order_lock = Lock()
+
+    def set_stt(self, stt):
+        """Method to give the session its STT worker
+
+        Arguments:
+            stt (STT): The STT worker (with the models loaded or loading)
+        """
+        self.stt = stt
+        self._recording.clear() # The utterances of the previous worker won't get a final anymore
+        self._sent = self._decoded = 0
+        self.language_model = stt.language_model
+        self.nltk_model = stt.nltk_model
+        stt.set_subprocess_callback(self.handle_result)
+
+    def start_utterance(self):
+        """Method to start an utterance
+
+        Note:
+            With the result cache the worker isn't started until the audio stops matching
+            a cached utterance, so a replayed utterance never reaches the worker
+        """
+        self.usage.utterances += 1
+        self._number += 1
+        if self._cache is None:
+            self.stt.start_audio_proc(self.id, self._number)
+            return
+        self._utterance = CachedUtterance(self.stt.result_context())
+
+    def feed_audio(self, audio_chunk):
+        """Method to pass an audio chunk of the current utterance on to the worker
+
+        Note:
+            The windowed quotas are checked before every chunk, so a client can't use them up
+            (and keep on decoding) within a single long utterance
+
+        Arguments:
+            audio_chunk (dict): The client message with the base64 wrapped audio chunk
+
+        Returns: (tuple)
+            None if the chunk was passed on, otherwise the reason and the seconds until the client can
+            try again (the chunk is dropped, and the caller is expected to stop the utterance)
+        """
+        if self._quotas is not None:
+            exceeded = self._quotas.check(self.get_quota_keys())
+            if exceeded is not None:
+                return exceeded
+        utterance = self._utterance
+        if utterance is not None:
+            if utterance.feed(self._cache, audio_chunk["audio"]):
+                return None # Held back, it matches a cached utterance so far
+            if utterance.holding:
+                self.__start_worker(utterance)
+        self._sent += 1
+        self.stt.process_audio_chunk(audio_chunk)
+        return None
+
+    def stop_utterance(self):
+        """Method to end the current utterance (replaying the cached results if the whole utterance matched)"""
+        utterance, self._utterance = self._utterance, None
+        if utterance is not None:
+            if utterance.holding:
+                entry = self._cache.get(utterance.chain)
+                if entry is not None:
+                    cached = dict(entry["final"])
+                    cached["cached"] = True
+                    self.handle_result(cached)
+                    return
+                self.__start_worker(utterance)
+            else:
+                self._cache.count_miss()
+            self._recording[self._number] = utterance # Cache the final result once the worker sends it
+        self.stt.stop_audio_proc()
+
+    def __start_worker(self, utterance):
+        """Private method to start the utterance on the worker and send it the audio that was held back
+
+        Arguments:
+            utterance (CachedUtterance): The utterance that no longer matches a cached one
+        """
+        self.stt.start_audio_proc(self.id, self._number)
+        for chunk in utterance.release():
+            self._sent += 1
+            self.stt.process_audio_chunk({"audio": chunk})
+
+    def get_unanswered_chunks(self):
+        """Method to get how far the worker is behind the audio it was sent
+
+        Returns: (int)
+            The amount of audio chunks the worker hasn't sent a result for yet
+        """
+        return self._sent - self._decoded
+
+    def get_quota_keys(self):
+        """Method to get the keys the usage of the session is counted against
+
+        Returns: (list)
+            The client address key and (if the client sent one) the client token key
+        """
+        keys = ["ip:%s" % self.remote_ip]
+        if self.client_token is not None:
+            keys.append("token:%s" % self.client_token)
+        return keys
+
+    def get_report(self):
+        """Method to get the resource report of the session
+
+        Returns: (dict)
+            The session id, client address, state, language model and usage of the session
+        """
+        return {
+            "session": self.id,
+            "remote_ip": self.remote_ip,
+            "identified": self.client_token is not None, # The token itself stays private
+            "state": self.state,
+            "attached": self.is_attached(),
+            "language_model": None if self.language_model is None else self.language_model.name,
+            "profile": None if self.language_model is None else self.language_model.profile,
+            "usage": self.usage.to_dict()
+        }
+
+    def advertise_chunk_ms(self):
+        """Method to get the chunk duration that the client should use
+
+        Returns: (int)
+            The recommended chunk duration in milliseconds (None without a load monitor)
+        """
+        if self._monitor is not None:
+            self.chunk_ms = self._monitor.recommend_chunk_ms()
+        return self.chunk_ms
+
+    def model_ready(self):
+        """Method that's called once the requested language model is ready to be used
+
+        Note:
+            The latency between the model request and this call is what a client waits before it can speak
+        """
+        if self.model_requested is None:
+            return
+        latency = time() - self.model_requested
+        self.model_requested = None
+        if startup.record_model_latency(latency):
+            log.info("First client model ready after %.1f ms", latency * 1000)
+        else:
+            log.debug("Session %s model ready after %.1f ms", self.id, latency * 1000)
+
+    def attach(self, send):
+        """Method to attach a client to the session and send it the results it missed
+
+        Arguments:
+            send (:obj: method): The method that sends a result dictionary to the client
+        """
+        with self._lock:
+            self._send = send
+            pending = list(self._pending)
+            self._pending.clear()
+        for result in pending:
+            send(result)
+
+    def detach(self):
+        """Method to detach the client, any new results are kept until the session is resumed"""
+        with self._lock:
+            self._send = None
+
+    def is_attached(self):
+        """Method to check if a client is currently attached
+
+        Returns: (bool)
+            True if a client is attached to the session
+        """
+        return self._send is not None
+
+    def handle_result(self, command):
+        """Method that's called with every response of the STT worker
+
+        Note:
+            This is called from the STT subprocess handler thread
+
+        Arguments:
+            command (dict): The returned dictionary from the STT subprocess
+        """
+        meta = command.pop("_meta", None)
+        if meta is not None:
+            self.__account(meta)
+        if meta is not None and self._monitor is not None:
+            self._monitor.record(meta)
+            chunk_ms = self._monitor.recommend_chunk_ms()
+            if chunk_ms != self.chunk_ms: # Only tell the client when the recommendation changes
+                command["chunk_ms"] = self.chunk_ms = chunk_ms
+
+        slot = [None]
+        with self._order_lock:
+            self._ordered.append(slot)
+        if "_rescore" in command: # The worker only did the fast first pass of this final
+            if self._rescorer is not None and self.stt is not None:
+                self._rescorer.submit(self.stt, command, lambda final: self.__release(slot, final))
+                return
+            command.pop("_rescore")
+        self.__release(slot, command)
+
+    def __release(self, slot, command):
+        """Private method to deliver a result once every result the worker sent before it has been delivered
+
+        Note:
+            This is called from the STT subprocess handler thread or (for a rescored final) the rescorer's threads
+
+        Arguments:
+            slot (list): The slot the result was given when it arrived
+            command (dict): The result to deliver
+        """
+        with self._order_lock:
+            slot[0] = command
+            while len(self._ordered) > 0 and self._ordered[0][0] is not None:
+                self.__deliver(self._ordered.popleft()[0])
+
+    def __deliver(self, command):
+        """Private method to publish, cache and send (or keep while parked) a result
+
+        Arguments:
+            command (dict): The result to deliver
+        """
+        meta = command.pop("_meta", None) # The cost of the second pass (if it was rescored)
+        if meta is not None:
+            self.__account(meta)
+
+        if "success" in command:
+            command["session"] = self.id # Tell the client which id subscribers can watch it with
+            command["token"] = self.token # And the token it can resume the session with
+            command["chunk_ms"] = self.advertise_chunk_ms()
+            command["profile"] = None if self.language_model is None else self.language_model.profile
+            self.model_ready()
+        elif "hypothesis" in command or "partial_hypothesis" in command:
+            if "hypothesis" in command and not command.get("segmented", False) and len(self._recording) > 0 and not command.get("cached", False):
+                recording = self.__take_recording(command.get("utterance"))
+                final = dict(command)
+                final.pop("utterance", None) # The numbering of this utterance doesn't apply to a replay
+                final.pop("seq", None)
+                entry = recording.to_entry(final) if recording is not None and command.get("segment", 0) == 0 else None # A split utterance's final only covers its last segment
+                if entry is not None:
+                    self._cache.put(entry)
+            self._hub.publish(self.id, command)
+
+        with self._lock:
+            send = self._send
+            if send is None:
+                self._pending.append(command)
+                return
+        send(command)
+
+    def __account(self, meta):
+        """Private method to count a worker measurement against the session and its quotas
+
+        Arguments:
+            meta (dict): The measurement (audio_ms and cpu_ms)
+        """
+        if "chunks" in meta: # Only the worker's measurements count chunks (the rescorer's run on its own threads)
+            self._decoded += meta["chunks"]
+        audio_seconds, cpu_seconds = self.usage.record(meta)
+        if self._quotas is not None:
+            self._quotas.record(self.get_quota_keys(), audio_seconds, cpu_seconds)
+
+    def __take_recording(self, number):
+        """Private method to take the recording of the utterance a final belongs to
+
+        Note:
+            The recordings of earlier utterances are dropped as well, those never got a final
+            (ex: the worker failed) and would otherwise be cached with the wrong transcript
+
+        Arguments:
+            number (int): The utterance number the final is tagged with
+
+        Returns: (CachedUtterance)
+            The recording or None if there's no recording of that utterance
+        """
+        if number is None:
+            return None
+        for stale in [r_number for r_number in list(self._recording) if r_number < number]:
+            self._recording.pop(stale, None)
+        return self._recording.pop(number, None)
+
+
+class SessionRegistry(object):
+    """Registry of the active and parked sessions
+
+    Attributes:
+        _io_loop (IOLoop): The tornado IOLoop that runs the grace period timers
+        _pool (STTPool): The pool that the STT workers are given back to
+        _hub (SessionHub): The hub that the session results are published to
+        _cache (ResultCache): The cache of utterance results shared by all sessions (None if it's turned off)
+        monitor (LoadMonitor): The load monitor that recommends the chunk duration of the sessions
+        _rescorer (Rescorer): The second pass pool shared by all sessions (None if the two pass mode is off)
+        quotas (QuotaManager): The per client usage and quotas of all sessions
+        _sessions (dict): The session id to every live (attached or parked) Session
+        _parked (dict): The resume token to a (Session, timeout handle) pair
+
+    Note:
+        All of the methods must be called on the IOLoop thread
+    """
+
+    def __init__(self, io_loop, pool, hub, cache=None, rescorer=None):
+        self._io_loop = io_loop
+        self._pool = pool
+        self._hub = hub
+        self._cache = cache
+        self._rescorer = rescorer
+        self.monitor = LoadMonitor(self.get_active_count)
+        self.quotas = QuotaManager()
+        self._sessions = {}
+        self._parked = {}
+
+    def open(self, remote_ip, client_token=None):
+        """Method to create a new session
+
+        Arguments:
+            remote_ip (str): The address of the client
+            client_token (str): The token the client identified itself with
+
+        Returns: (Session)
+            The new session
+        """
+        session = Session(remote_ip, self._hub, self._cache, self.monitor, self._rescorer, client_token, self.quotas)
+        self._sessions[session.id] = session
+        return session
+
+    def admit(self, session):
+        """Method to count a session against the session quotas of its client (once it asks for a worker)
+
+        Arguments:
+            session (Session): The session that wants a worker
+
+        Returns: (str)
+            None if the session can have a worker, otherwise the reason it can't
+        """
+        if session.admitted:
+            return None
+        reason = self.quotas.admit(session.get_quota_keys())
+        if reason is None:
+            session.admitted = True
+        return reason
+
+    def check_quotas(self, session):
+        """Method to check if the client of a session has used up its windowed quotas
+
+        Arguments:
+            session (Session): The session that wants to start an utterance
+
+        Returns: (tuple)
+            None if the session can continue, otherwise the reason and the seconds until it can try again
+        """
+        return self.quotas.check(session.get_quota_keys())
+
+    def park(self, session, grace=DEFAULT_RESUME_GRACE, max_parked=DEFAULT_MAX_PARKED):
+        """Method to keep a session (and its worker) alive after its client disconnected
+
+        Note:
+            Sessions without a worker have nothing worth keeping and are ended right away
+
+        Arguments:
+            session (Session): The session whose client disconnected
+            grace (float): The amount of seconds to wait on a resume before ending the session
+            max_parked (int): The maximum amount of parked sessions
+        """
+        session.detach()
+        if session.stt is None or grace <= 0 or len(self._parked) >= max_parked:
+            self.end(session)
+            return
+
+        timeout = self._io_loop.call_later(grace, self.__expire, session.token)
+        self._parked[session.token] = (session, timeout)
+        log.debug("Parked session %s for %d seconds", session.id, grace)
+
+    def resume(self, token):
+        """Method to take a parked session back
+
+        Arguments:
+            token (str): The resume token the client presented
+
+        Returns: (Session)
+            The parked session or None if the token is unknown or has expired
+        """
+        parked = self._parked.pop(token, None)
+        if parked is None:
+            return None
+        session, timeout = parked
+        self._io_loop.remove_timeout(timeout)
+        log.debug("Resumed session %s", session.id)
+        return session
+
+    def end(self, session, recycle=True):
+        """Method to end a session and give its worker back to the pool
+
+        Arguments:
+            session (Session): The session to end
+            recycle (bool): If the worker can be kept as a spare, otherwise it's shutdown to free its memory
+        """
+        if self._sessions.pop(session.id, None) is not None and session.usage.model_loads > 0:
+            log.info("Session %s (%s) ended: %s", session.id, session.remote_ip, dumps(session.usage.to_dict(), sort_keys=True))
+        session.detach()
+        if session.admitted:
+            self.quotas.release(session.get_quota_keys())
+            session.admitted = False
+        if session.stt is not None:
+            if recycle:
+                self._pool.release(session.stt)
+            else:
+                session.stt.shutdown()
+            session.stt = None
+        self._hub.close_session(session.id) # Disconnect anyone watching this session
+
+    def evict_parked(self):
+        """Method to end the parked session that has been waiting on a resume the longest
+
+        Returns: (bool)
+            True if a parked session was ended
+        """
+        if len(self._parked) == 0:
+            return False
+        token = min(self._parked, key=lambda p_token: self._parked[p_token][1].deadline)
+        session, timeout = self._parked.pop(token)
+        self._io_loop.remove_timeout(timeout)
+        log.info("Evicted the parked session %s", session.id)
+        self.end(session, False) # Releasing it would only turn the worker into a spare
+        return True
+
+    def get_session(self, session_id):
+        """Method to get a live session by its public id
+
+        Arguments:
+            session_id (str): The public id of the session
+
+        Returns: (Session)
+            The attached or parked session or None if there's no such session
+        """
+        return self._sessions.get(session_id)
+
+    def get_sessions(self):
+        """Method to get all of the live sessions
+
+        Returns: (list)
+            The attached and parked sessions
+        """
+        return list(self._sessions.values())
+
+    def get_active_count(self):
+        """Method to get the amount of sessions that have a worker
+
+        Returns: (int)
+            The amount of attached and parked sessions with a worker
+        """
+        return len([session for session in list(self._sessions.values()) if session.stt is not None])
+
+    def get_parked_count(self):
+        """Method to get the amount of parked sessions
+
+        Returns: (int)
+            The amount of sessions waiting on a resume
+        """
+        return len(self._parked)
+
+    def __expire(self, token):
+        """Private method that ends a parked session once its grace period is over"""
+        parked = self._parked.pop(token, None)
+        if parked is not None:
+            log.debug("The grace period of session %s expired", parked[0].id)
+            self.end(parked[0])
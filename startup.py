@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text startup profiling
+
+This module measures where the server spends its startup time: how long each import
+takes, how long it takes until the server accepts connections and how long the first
+client waits on its language model.
+
+Note:
+    This module is imported before anything else (even gevent), so it must only use the standard library
+
+Developed by: David Smerkous
+"""
+
+from time import time
+
+import sys
+
+try:
+    import __builtin__ as builtins # Python 2
+except ImportError:
+    import builtins
+
+STARTED = time()
+FIRST_REQUEST = []
+"""Global module level definitions
+float: STARTED - The time the server process started importing its modules
+list: FIRST_REQUEST - Holds the model latency of the very first client (empty until it's been served)
+"""
+
+
+class ImportProfiler(object):
+    """Times every first import of a module
+
+    Attributes:
+        _timings (dict): The module name to a [total seconds, self seconds] pair
+        _stack (list): The time spent in nested imports of the imports that are currently running
+        _original (:obj: method): The original builtin __import__ method
+    """
+
+    def __init__(self):
+        self._timings = {}
+        self._stack = []
+        self._original = None
+
+    def start(self):
+        """Method to start timing the imports"""
+        if self._original is None:
+            self._original = builtins.__import__
+            builtins.__import__ = self.__import
+
+    def stop(self):
+        """Method to stop timing the imports"""
+        if self._original is not None:
+            builtins.__import__ = self._original
+            self._original = None
+
+    def __import(self, name, *args, **kwargs):
+        if name in sys.modules: # Only the first import of a module costs anything
+            return self._original(name, *args, **kwargs)
+
+        started = time()
+        self._stack.append(0.0)
+        try:
+            return self._original(name, *args, **kwargs)
+        finally:
+            elapsed = time() - started
+            nested = self._stack.pop()
+            if len(self._stack) > 0:
+                self._stack[-1] += elapsed
+            timing = self._timings.setdefault(name, [0.0, 0.0])
+            timing[0] += elapsed
+            timing[1] += elapsed - nested
+
+    def report(self, limit=10):
+        """Method to create a readable report of the slowest imports
+
+        Arguments:
+            limit (int): The amount of imports to list
+
+        Returns: (str)
+            The report with the total and the self time (without nested imports) of the slowest imports
+        """
+        slowest = sorted(self._timings.items(), key=lambda timing: timing[1][1], reverse=True)[:limit]
+        lines = ["%-32s %9s %9s" % ("import", "total ms", "self ms")]
+        for name, timing in slowest:
+            lines.append("%-32s %9.1f %9.1f" % (name, timing[0] * 1000, timing[1] * 1000))
+        return "\n".join(lines)
+
+
+def elapsed_since_start():
+    """Method to get the amount of seconds since the server process started importing
+
+    Returns: (float)
+        The seconds since STARTED
+    """
+    return time() - STARTED
+
+
+def record_model_latency(latency):
+    """Method to remember how long the very first client waited on its language model
+
+    Arguments:
+        latency (float): The seconds between the model request and the success response
+
+    Returns: (bool)
+        True if this was the first client served since the server started
+    """
+    if len(FIRST_REQUEST) > 0:
+        return False
+    FIRST_REQUEST.append(latency)
+    return True
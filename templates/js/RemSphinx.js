@@ -26,9 +26,12 @@ var CONFIGS = {
 
 	options: {
 		progressInterval: 500, //Progress interval to send audio chunk (default: 500 millis)
+		adaptiveChunks: true, //Use the chunk duration the server recommends instead of the progressInterval
 		bufferSize: undefined, //Use the browsers default buffer size
 		mimeType: "audio/wav", //Web blob mime type
 		address: "ws://localhost:8000/ws", //The server websocket location 
+		batch: true, //Let the server send the results of a single tick together in one frame
+		protocol: "json", //"msgpack" asks for the compact binary protocol (json is used if the server doesn't offer it)
 	}
 }
 
@@ -150,8 +153,12 @@ extend(RemSphinx.prototype, {
 		});
 	},
 
-	setLanguageModel: function(newModel, newAccent) {
-		this.worker.postMessage({ command: "model", model: newModel, accent: newAccent});
+	setLanguageModel: function(newModel, newAccent, vocabulary, profile) {
+		this.worker.postMessage({ command: "model", model: newModel, accent: newAccent, vocabulary: vocabulary || [], profile: profile});
+	},
+
+	addWords: function(words) { //[[word, pronunciation], ...]
+		this.worker.postMessage({ command: "add_words", words: words });
 	},
 
 	setVolumeGain: function(gain) {
@@ -173,6 +180,28 @@ extend(RemSphinx.prototype, {
 		});
 	},
 	
+	setDetail: function(words, nbest) {
+		this.worker.postMessage({
+			command: "detail",
+			words: words,
+			nbest: nbest
+		});
+	},
+
+	setSearch: function(search) {
+		this.worker.postMessage({
+			command: "set_search",
+			search: search
+		});
+	},
+
+	useSearch: function(name) {
+		this.worker.postMessage({
+			command: "use_search",
+			name: name
+		});
+	},
+
 	setMinKeyphraseScore: function(setMinKephraseScore) {
 		this.minKeyphraseScore = setMinKephraseScore;
 	},
@@ -223,16 +252,25 @@ extend(RemSphinx.prototype, {
 						_this.onWaiting();
 						break;
 					case "loaded":
-						_this.onModelLoaded(data.success);
+						_this.onModelLoaded(data.success, data.profile);
 						_this.ready = true;
 						break;
 					case "hypothesis":
 						if(data.keyphrases) data.hyp = _this.__processKeyphrases(data.hyp);
-						_this.onHypothesis(data.hyp, data.keyphrases);
+						_this.onHypothesis(data.hyp, data.keyphrases, data.details);
 						break;
 					case "partial_hypothesis":
 						if(data.keyphrases) data.hyp = _this.__processKeyphrases(data.hyp);
-						_this.onPartialHypothesis(data.partial_hyp, data.keyphrases);
+						_this.onPartialHypothesis(data.partial_hyp, data.keyphrases, data.utterance, data.seq);
+						break;
+					case "search":
+						_this.onSearch(data.ready, data.using);
+						break;
+					case "vocabulary":
+						_this.onVocabulary(data.size, data.failed);
+						break;
+					case "queued":
+						_this.onQueued(data.position);
 						break;
 					case "nocatch":
 						_this.onNoCatch(data.silence);
@@ -257,12 +295,15 @@ extend(RemSphinx.prototype, {
 
 	onError: function(recorder, message, code) { console.log(message + "(Code: " + code + ")"); },
 	onProcessedChunk: function() { console.log("Audio chunk processed!"); },
-	onModelLoaded: function(success) { console.log("LanguageModel loading " + ((success) ? "success!" : "failure!")); },
+	onModelLoaded: function(success, profile) { console.log("LanguageModel loading " + ((success) ? "success! (profile: " + profile + ")" : "failure!")); },
 	onStartSpeech: function() { console.log("Starting to listen!"); },
 	onEndSpeech: function() { console.log("Listening stopped!"); },
-	onHypothesis: function(hypothesis, keyphrases) { console.log("Hypothesis: " + hypothesis) },
-	onPartialHypothesis: function(partial_hypothesis, keyphrases) { console.log("Partial hypothesis: " + partial_hypothesis); },
+	onHypothesis: function(hypothesis, keyphrases, details) { console.log("Hypothesis: " + hypothesis) },
+	onPartialHypothesis: function(partial_hypothesis, keyphrases, utterance, seq) { console.log("Partial hypothesis: " + partial_hypothesis); },
 	onNoCatch: function(silence) {},
+	onSearch: function(ready, using) {},
+	onVocabulary: function(size, failed) {},
+	onQueued: function(position) { console.log("Waiting on the server for the language model (position: " + position + ")"); },
 	onWaiting: function() {}
 });
 
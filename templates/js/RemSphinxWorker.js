@@ -1,14 +1,24 @@
-importScripts("WavAudioEncoder.min.js", "robust-websocket.js");
+importScripts("WavAudioEncoder.min.js", "robust-websocket.js", "msgpack.js");
 
 var sampleRate = 44100,
 	numChannels = 1,
 	options = undefined,
 	maxBuffers = undefined,
+	bufferSize = undefined,
 	encoder = undefined,
 	bufferCount = 0,
 	ws = undefined,
 	fileReader = undefined,
-	wsState = 0;
+	wsState = 0,
+	sessionToken = undefined, //The token to resume the server session with after a reconnect
+	modelData = undefined, //The last requested language model (to request it again if the session can't be resumed)
+	MSGPACK_SUBPROTOCOL = "remsphinx.msgpack",
+	REQUEST_CODES = { audio: 1, start_speech: 2, end_speech: 3, model: 4, resume: 5, set_keyphrases: 6, set_detail: 7,
+		set_search: 8, use_search: 9, add_words: 10 }, //The integer codes of the requests in the msgpack protocol
+	RESULT_FIELDS = { //The positional fields of the compact msgpack results (code 0 is a plain map)
+		1: ["utterance", "seq", "partial_hypothesis", "partial_silence", "keyphrases"],
+		2: ["utterance", "seq", "hypothesis", "silence", "keyphrases"]
+	};
 
 //Handle any error messages via the main process/script
 function error(message, code) {
@@ -16,28 +26,127 @@ function error(message, code) {
 }
 
 
+//Send a request to the server (with the integer codes if the server accepted the msgpack protocol)
+function send(request) {
+	if(ws.protocol != MSGPACK_SUBPROTOCOL) {
+		ws.send(JSON.stringify(request));
+		return;
+	}
+	for(var key in request) {
+		if(REQUEST_CODES.hasOwnProperty(key)) {
+			ws.send(MsgPack.encode((key == "model") ? [REQUEST_CODES[key], request] : [REQUEST_CODES[key], request[key]]));
+			return;
+		}
+	}
+}
+
+//Turn a compact msgpack result back into the message the json protocol would have sent
+function unpackResult(packed) {
+	if(!RESULT_FIELDS.hasOwnProperty(packed[0])) return packed[1];
+	var fields = RESULT_FIELDS[packed[0]],
+		response = (packed.length > fields.length + 1) ? packed[fields.length + 1] : {};
+	for(var i = 0; i < fields.length; i++) {
+		if(packed[i + 1] !== null || i == 2) response[fields[i]] = packed[i + 1]; //The hypothesis is kept even when it's empty
+	}
+	return response;
+}
+
 //Setup the worker properties
 function init(data) {
 	sampleRate = data.config.sampleRate;
 	numChannels = data.config.numChannels;
 	options = data.options;
 
-	ws = new RobustWebSocket(data.options.address, null, {
+	var address = data.options.address;
+	if(data.options.batch) {
+		address += ((address.indexOf("?") < 0) ? "?" : "&") + "batch=1"; //The server may then send a json array of messages in one frame
+	}
+
+	ws = new RobustWebSocket(address, (data.options.protocol == "msgpack") ? [MSGPACK_SUBPROTOCOL] : null, {
 		shouldReconnect: function(event, ws) {
-			return true;
+			return Math.min(250 * ws.attempts, 5000); //Back off a little more after every failed attempt
 		},
 		
 		automaticOpen: false
 	});
+	ws.binaryType = "arraybuffer"; //The msgpack frames
+
+	ws.onopen = function(event) {
+		//Try to take back the previous session (and its loaded language model) after a reconnect
+		if(event.reconnects > 0 && sessionToken != undefined) {
+			send({
+				resume: sessionToken
+			});
+		}
+	};
 
 	ws.onmessage = function(event) {
+		if(event.data instanceof ArrayBuffer) {
+			MsgPack.decode(event.data).forEach(function(packed) { //Every msgpack frame is a batch
+				handleResponse(unpackResult(packed));
+			});
+			return;
+		}
+
 		var response = JSON.parse(event.data);
+		if(Array.isArray(response)) {
+			response.forEach(handleResponse); //A batch of the messages the server produced together
+		} else {
+			handleResponse(response);
+		}
+	};
 
+	//Handle a single message of the server
+	function handleResponse(response) {
 		if(response.hasOwnProperty("error")) {
 			error(response.error, 1);
 			return;
 		}
 
+		if(response.hasOwnProperty("token")) {
+			sessionToken = response.token;
+		}
+
+		if(response.hasOwnProperty("chunk_ms")) {
+			setChunkDuration(response.chunk_ms); //The server recommends a chunk duration based on its load
+		}
+
+		if(response.hasOwnProperty("search_ready") || response.hasOwnProperty("search")) {
+			self.postMessage({
+				command: "search",
+				ready: response.search_ready, //The name of a search that was just added
+				using: response.search //The name of the search the next utterances will use
+			});
+			return;
+		}
+
+		if(response.hasOwnProperty("vocabulary")) {
+			self.postMessage({
+				command: "vocabulary",
+				size: response.vocabulary, //The amount of custom words the decoder has
+				failed: response.failed_words //The words that couldn't be added
+			});
+			return;
+		}
+
+		if(response.hasOwnProperty("queued")) {
+			self.postMessage({
+				command: "queued",
+				position: response.queued //The server is waiting on memory for the worker (the model request is still pending)
+			});
+			return;
+		}
+
+		if(response.hasOwnProperty("resumed")) {
+			if(response.resumed) {
+				wsState = 10; //The server still has the session, just keep going
+			} else {
+				sessionToken = undefined;
+				if(modelData != undefined) setLanguageModel(modelData); //The session expired, so load the model again
+			}
+			return;
+		}
+
 		//By default keyphrases are turned off (double check to see if the flag has been set)
 		var keyphrases = false;
 		if(response.hasOwnProperty("keyphrases")) {
@@ -50,7 +159,8 @@ function init(data) {
 					wsState = 10;
 					self.postMessage({
 						command: "loaded",
-						success: true
+						success: true,
+						profile: response.profile //The profile the server loaded (it can be a faster one while it's busy)
 					});
 
 					self.postMessage({
@@ -82,9 +192,17 @@ function init(data) {
 						self.postMessage({
 							command: "hypothesis",
 							keyphrases: keyphrases,
-							hyp: hypothesis
+							hyp: hypothesis,
+							details: {
+								words: response.words, //[word, start_frame, end_frame, confidence] (only with setDetail)
+								nbest: response.nbest, //[hypothesis, score] (only with setDetail)
+								segment: response.segment, //The segment of a long utterance the server split (the frames start over at offsetMs)
+								offsetMs: response.offset_ms,
+								utterance: response.utterance, //The utterance of the session and the hypothesis within it (stale partials are skipped)
+								seq: response.seq
+							}
 						});
-					} else {
+					} else if(!response.segmented) { //A quiet segment of a long utterance isn't a missed utterance
 						self.postMessage({
 							command: "nocatch"
 						});
@@ -95,7 +213,9 @@ function init(data) {
 							self.postMessage({
 								command: "partial_hypothesis",
 								keyphrases: keyphrases,
-								partial_hyp: response.partial_hypothesis
+								partial_hyp: response.partial_hypothesis,
+								utterance: response.utterance,
+								seq: response.seq
 							});
 						}
 					} else {
@@ -104,7 +224,7 @@ function init(data) {
 				}
 				break;
 		}
-	};
+	}
 
 	//The blob wav file handler
 	file_reader = new FileReader();
@@ -115,42 +235,87 @@ function init(data) {
 		var arr_buff = this.result.replace(/^data:audio\/(wav|mp3);base64,/, "");
 
 		//Send the audio chunk to the server
-		ws.send(JSON.stringify({
+		send({
 			audio: arr_buff //Send only the base64 audio chunk
-		}));
+		});
 	}
 
 	ws.open(); //Start the websocket client
 }
 
-function setLanguageModel(modelData) {
+function setLanguageModel(data) {
+	modelData = data;
 	wsState = 0; //Set the websocket state to listen for a model set success
-	ws.send(JSON.stringify({
-		model: modelData.model,
-		accent: modelData.accent
-	}));
+	send({
+		model: data.model,
+		accent: data.accent,
+		vocabulary: data.vocabulary,
+		profile: data.profile //The decoder profile (ex: fast, balanced or accurate), undefined for the server default
+	});
 }
 
-function start(bufferSize) {
+//Add custom words to the loaded language model (kept so an expired session gets them back)
+function addWords(words) {
+	if(modelData != undefined) modelData.vocabulary = (modelData.vocabulary || []).concat(words);
+	send({
+		add_words: words
+	});
+}
+
+function start(newBufferSize) {
 	//Set the chunking rate at which to return the encoded audio at
+	bufferSize = newBufferSize;
 	maxBuffers = Math.ceil((options.progressInterval / 1000) * sampleRate / bufferSize);
 	
 	//Create the initial encoder object
 	encoder = new WavAudioEncoder(sampleRate, numChannels);
 }
 
+//Change the duration of the audio chunks (the next chunk already uses it)
+function setChunkDuration(chunkMs) {
+	if(options.adaptiveChunks === false || chunkMs == undefined) return;
+	options.progressInterval = chunkMs;
+	if(bufferSize != undefined) {
+		maxBuffers = Math.ceil((options.progressInterval / 1000) * sampleRate / bufferSize);
+	}
+}
+
 //Tell the server to start listening
 function startSpeech() {
-	ws.send(JSON.stringify({
+	send({
 		start_speech: true
-	}));
+	});
 }
 
 //Tell the server to either stop or start processing keyphrases
 function setKeyphrases(keyphrases) {
-	ws.send(JSON.stringify({
+	send({
 		set_keyphrases: keyphrases
-	}));
+	});
+}
+
+//Tell the server which details (word segments and n-best alternatives) to add to the final hypothesis
+function setDetail(words, nbest) {
+	send({
+		set_detail: {
+			words: words,
+			nbest: nbest
+		}
+	});
+}
+
+//Add a keyword spotting (type "kws", keyphrases) or grammar (type "jsgf", grammar) search
+function setSearch(search) {
+	send({
+		set_search: search
+	});
+}
+
+//Switch the next utterances to another search ("lm" is the language model)
+function useSearch(name) {
+	send({
+		use_search: name
+	});
 }
 
 //Process an audio chunk
@@ -180,9 +345,9 @@ function finishChunk() {
 
 //Tell the server to stop listening
 function endSpeech() {
-	ws.send(JSON.stringify({
+	send({
 		end_speech: true
-	}));
+	});
 }
 
 //Cleanup all of the encoding objects and reset the buffer limit
@@ -201,6 +366,10 @@ self.onmessage = function(event) {
 		case "start": start(data.bufferSize);				break;
 		case "start_speech": startSpeech();					break;
 		case "keyphrases": setKeyphrases(data.keyphrases);	break;
+		case "detail": setDetail(data.words, data.nbest);	break;
+		case "set_search": setSearch(data.search);			break;
+		case "use_search": useSearch(data.name);			break;
+		case "add_words": addWords(data.words);				break;
 		case "chunk": chunk(data.buffer);					break;
 		case "end_speech": endSpeech();						break;
 		case "shutdown": cleanup();							break;
@@ -0,0 +1,178 @@
+//A minimal msgpack codec for the compact RemSphinx protocol (the remsphinx.msgpack websocket subprotocol)
+//It covers nil, booleans, numbers, strings, binary, arrays and maps (extension types are decoded as null)
+var MsgPack = (function() {
+	var utf8Encoder = new TextEncoder(),
+		utf8Decoder = new TextDecoder("utf-8");
+
+	//Append a big endian unsigned integer of the given size (in bytes)
+	function pushUint(bytes, value, size) {
+		for(var shift = (size - 1) * 8; shift >= 0; shift -= 8) {
+			bytes.push(Math.floor(value / Math.pow(2, shift)) & 0xff);
+		}
+	}
+
+	//Append a type byte followed by the length, picking the smallest of the 8, 16 or 32 bit forms
+	function pushLength(bytes, length, fix, fixMax, type8, type16, type32) {
+		if(length <= fixMax) {
+			bytes.push(fix | length);
+		} else if(type8 != undefined && length < 0x100) {
+			bytes.push(type8, length);
+		} else if(length < 0x10000) {
+			bytes.push(type16);
+			pushUint(bytes, length, 2);
+		} else {
+			bytes.push(type32);
+			pushUint(bytes, length, 4);
+		}
+	}
+
+	function pushNumber(bytes, value) {
+		if(Math.floor(value) === value && value >= -0x80000000 && value <= 0xffffffff) {
+			if(value >= 0) {
+				if(value < 0x80) bytes.push(value); //Positive fixint
+				else if(value < 0x100) bytes.push(0xcc, value);
+				else if(value < 0x10000) { bytes.push(0xcd); pushUint(bytes, value, 2); }
+				else { bytes.push(0xce); pushUint(bytes, value, 4); }
+			} else {
+				if(value >= -32) bytes.push(value & 0xff); //Negative fixint
+				else if(value >= -0x80) bytes.push(0xd0, value & 0xff);
+				else if(value >= -0x8000) { bytes.push(0xd1); pushUint(bytes, value + 0x10000, 2); }
+				else { bytes.push(0xd2); pushUint(bytes, value + 0x100000000, 4); }
+			}
+			return;
+		}
+		var view = new DataView(new ArrayBuffer(8));
+		view.setFloat64(0, value);
+		bytes.push(0xcb);
+		for(var i = 0; i < 8; i++) bytes.push(view.getUint8(i));
+	}
+
+	function pushValue(bytes, value) {
+		if(value === null || value === undefined) {
+			bytes.push(0xc0);
+		} else if(value === true || value === false) {
+			bytes.push(value ? 0xc3 : 0xc2);
+		} else if(typeof value === "number") {
+			pushNumber(bytes, value);
+		} else if(typeof value === "string") {
+			var encoded = utf8Encoder.encode(value);
+			pushLength(bytes, encoded.length, 0xa0, 31, 0xd9, 0xda, 0xdb);
+			for(var i = 0; i < encoded.length; i++) bytes.push(encoded[i]);
+		} else if(value instanceof Uint8Array) {
+			pushLength(bytes, value.length, 0, -1, 0xc4, 0xc5, 0xc6);
+			for(var i = 0; i < value.length; i++) bytes.push(value[i]);
+		} else if(Array.isArray(value)) {
+			pushLength(bytes, value.length, 0x90, 15, undefined, 0xdc, 0xdd);
+			for(var i = 0; i < value.length; i++) pushValue(bytes, value[i]);
+		} else {
+			var keys = Object.keys(value).filter(function(key) { return value[key] !== undefined; }); //Like JSON.stringify
+			pushLength(bytes, keys.length, 0x80, 15, undefined, 0xde, 0xdf);
+			for(var i = 0; i < keys.length; i++) {
+				pushValue(bytes, keys[i]);
+				pushValue(bytes, value[keys[i]]);
+			}
+		}
+	}
+
+	//Encode a value into a msgpack byte array
+	function encode(value) {
+		var bytes = [];
+		pushValue(bytes, value);
+		return new Uint8Array(bytes);
+	}
+
+	//Decode a msgpack byte array (or ArrayBuffer) into a value
+	function decode(buffer) {
+		var data = (buffer instanceof Uint8Array) ? buffer : new Uint8Array(buffer),
+			view = new DataView(data.buffer, data.byteOffset, data.byteLength),
+			offset = 0;
+
+		function readUint(size) {
+			var value = 0;
+			for(var i = 0; i < size; i++) value = value * 256 + data[offset++];
+			return value;
+		}
+
+		function readInt(size) {
+			var value = readUint(size), limit = Math.pow(2, size * 8);
+			return (value >= limit / 2) ? value - limit : value;
+		}
+
+		function readString(length) {
+			var value = utf8Decoder.decode(data.subarray(offset, offset + length));
+			offset += length;
+			return value;
+		}
+
+		function readBinary(length) {
+			var value = data.slice(offset, offset + length);
+			offset += length;
+			return value;
+		}
+
+		function readArray(length) {
+			var value = new Array(length);
+			for(var i = 0; i < length; i++) value[i] = readValue();
+			return value;
+		}
+
+		function readMap(length) {
+			var value = {};
+			for(var i = 0; i < length; i++) {
+				var key = readValue();
+				value[key] = readValue();
+			}
+			return value;
+		}
+
+		function readValue() {
+			var type = data[offset++];
+			if(type < 0x80) return type; //Positive fixint
+			if(type < 0x90) return readMap(type & 0x0f);
+			if(type < 0xa0) return readArray(type & 0x0f);
+			if(type < 0xc0) return readString(type & 0x1f);
+			if(type >= 0xe0) return type - 0x100; //Negative fixint
+			switch(type) {
+				case 0xc0: return null;
+				case 0xc2: return false;
+				case 0xc3: return true;
+				case 0xc4: return readBinary(readUint(1));
+				case 0xc5: return readBinary(readUint(2));
+				case 0xc6: return readBinary(readUint(4));
+				case 0xc7: offset += readUint(1) + 1; return null; //Extension types aren't used
+				case 0xc8: offset += readUint(2) + 1; return null;
+				case 0xc9: offset += readUint(4) + 1; return null;
+				case 0xca: offset += 4; return view.getFloat32(offset - 4);
+				case 0xcb: offset += 8; return view.getFloat64(offset - 8);
+				case 0xcc: return readUint(1);
+				case 0xcd: return readUint(2);
+				case 0xce: return readUint(4);
+				case 0xcf: return readUint(8);
+				case 0xd0: return readInt(1);
+				case 0xd1: return readInt(2);
+				case 0xd2: return readInt(4);
+				case 0xd3: return readInt(8);
+				case 0xd4: offset += 2; return null;
+				case 0xd5: offset += 3; return null;
+				case 0xd6: offset += 5; return null;
+				case 0xd7: offset += 9; return null;
+				case 0xd8: offset += 17; return null;
+				case 0xd9: return readString(readUint(1));
+				case 0xda: return readString(readUint(2));
+				case 0xdb: return readString(readUint(4));
+				case 0xdc: return readArray(readUint(2));
+				case 0xdd: return readArray(readUint(4));
+				case 0xde: return readMap(readUint(2));
+				case 0xdf: return readMap(readUint(4));
+			}
+			throw new Error("Invalid msgpack type 0x" + type.toString(16));
+		}
+
+		return readValue();
+	}
+
+	return {
+		encode: encode,
+		decode: decode
+	};
+})();
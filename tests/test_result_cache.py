@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx result cache tests
+
+These cover the least recently used eviction, the chained hash prefix matching of the
+utterances and the on disk tier of the result cache.
+
+Usage:
+    python3 -m unittest discover tests
+
+Developed by: David Smerkous
+"""
+
+from os.path import dirname, abspath, join, exists
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import sleep
+import sys
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__)))) # Run from the repository root or the tests directory
+
+from result_cache import ResultCache, CachedUtterance, chain_hash
+
+CONTEXT = "0:us@balanced"
+"""Global module level definitions
+str: CONTEXT - The result context the test utterances are hashed under
+"""
+
+
+def make_entry(chunks, hypothesis, context=CONTEXT):
+    """Method to create the cache entry of an utterance
+
+    Arguments:
+        chunks (list): The audio chunks of the utterance
+        hypothesis (str): The final hypothesis
+        context (str): The result context of the utterance
+
+    Returns: (dict)
+        The cache entry
+    """
+    utterance = CachedUtterance(context)
+    for chunk in chunks:
+        utterance.chain = chain_hash(utterance.chain, chunk)
+        utterance.prefixes.append(utterance.chain)
+    return utterance.to_entry({"hypothesis": hypothesis, "silence": False})
+
+
+def entry_size(entry):
+    """Method to get the size the cache accounts an entry with"""
+    cache = ResultCache(1024 * 1024)
+    cache.put(entry)
+    return cache.get_stats()["bytes"]
+
+
+class ChainHashTest(unittest.TestCase):
+
+    def test_chain_depends_on_context_and_order(self):
+        first = chain_hash(chain_hash(CONTEXT, "a"), "b")
+        self.assertEqual(first, chain_hash(chain_hash(CONTEXT, "a"), "b"))
+        self.assertNotEqual(first, chain_hash(chain_hash(CONTEXT, "b"), "a"))
+        self.assertNotEqual(first, chain_hash(chain_hash("1:de@balanced", "a"), "b"))
+
+    def test_text_and_bytes_chunks_hash_equally(self):
+        self.assertEqual(chain_hash(CONTEXT, "chunk"), chain_hash(CONTEXT, b"chunk"))
+
+
+class PrefixMatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResultCache(1024 * 1024)
+        self.cache.put(make_entry(["a", "b", "c"], "hello world"))
+
+    def test_whole_utterance_is_held_and_replayed(self):
+        utterance = CachedUtterance(CONTEXT)
+        self.assertTrue(all([utterance.feed(self.cache, chunk) for chunk in ["a", "b", "c"]]))
+        self.assertTrue(utterance.holding)
+        self.assertEqual(self.cache.get(utterance.chain)["final"]["hypothesis"], "hello world")
+        self.assertEqual(self.cache.get_stats()["hits"], 1)
+
+    def test_diverging_utterance_releases_the_held_chunks(self):
+        utterance = CachedUtterance(CONTEXT)
+        self.assertTrue(utterance.feed(self.cache, "a"))
+        self.assertFalse(utterance.feed(self.cache, "x"))
+        self.assertEqual(utterance.release(), ["a"])
+        self.assertFalse(utterance.holding)
+        self.assertFalse(utterance.feed(self.cache, "c")) # Never held again once released
+
+    def test_prefix_of_a_cached_utterance_is_a_miss(self):
+        utterance = CachedUtterance(CONTEXT)
+        utterance.feed(self.cache, "a")
+        utterance.feed(self.cache, "b")
+        self.assertTrue(self.cache.is_prefix(utterance.chain))
+        self.assertIsNone(self.cache.get(utterance.chain))
+        self.assertEqual(self.cache.get_stats()["misses"], 1)
+
+    def test_other_context_doesnt_match(self):
+        utterance = CachedUtterance("1:de@balanced")
+        self.assertFalse(utterance.feed(self.cache, "a"))
+
+    def test_empty_utterance_isnt_cached(self):
+        self.assertIsNone(CachedUtterance(CONTEXT).to_entry({"hypothesis": "nothing"}))
+
+
+class EvictionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.first = make_entry(["a1", "a2"], "first")
+        self.second = make_entry(["b1", "b2"], "second")
+        self.third = make_entry(["c1", "c2"], "third")
+        self.cache = ResultCache(entry_size(self.first) * 2 + 1) # Room for two entries
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.put(self.first)
+        self.cache.put(self.second)
+        self.assertIsNotNone(self.cache.get(self.first["prefixes"][-1])) # The first is now the most recently used
+        self.cache.put(self.third)
+
+        self.assertIsNone(self.cache.get(self.second["prefixes"][-1]))
+        self.assertIsNotNone(self.cache.get(self.first["prefixes"][-1]))
+        self.assertIsNotNone(self.cache.get(self.third["prefixes"][-1]))
+        stats = self.cache.get_stats()
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["entries"], 2)
+        self.assertLessEqual(stats["bytes"], entry_size(self.first) * 2 + 1)
+
+    def test_evicted_prefixes_are_unindexed(self):
+        for entry in [self.first, self.second, self.third]:
+            self.cache.put(entry)
+        for prefix in self.first["prefixes"]:
+            self.assertFalse(self.cache.is_prefix(prefix))
+        for prefix in self.third["prefixes"]:
+            self.assertTrue(self.cache.is_prefix(prefix))
+
+    def test_shared_prefixes_stay_indexed(self):
+        shared = make_entry(["a1", "x2"], "share") # The same size as the first
+        self.cache.put(self.first)
+        self.cache.put(shared)
+        self.cache.put(self.second) # Evicts the first, the shared entry still starts with a1
+        self.assertTrue(self.cache.is_prefix(self.first["prefixes"][0]))
+        self.assertFalse(self.cache.is_prefix(self.first["prefixes"][1]))
+
+    def test_entry_larger_than_the_cache_is_skipped(self):
+        cache = ResultCache(entry_size(self.first) - 1)
+        cache.put(self.first)
+        self.assertEqual(cache.get_stats()["entries"], 0)
+        self.assertFalse(cache.is_prefix(self.first["prefixes"][0]))
+
+
+class DiskTierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.disk_dir = mkdtemp()
+        self.first = make_entry(["a1", "a2"], "first")
+        self.second = make_entry(["b1", "b2"], "second")
+        self.third = make_entry(["c1", "c2"], "third")
+        self.size = entry_size(self.first)
+
+    def tearDown(self):
+        rmtree(self.disk_dir, True)
+
+    def make_cache(self, max_disk_bytes=1024 * 1024):
+        cache = ResultCache(self.size + 1, self.disk_dir, max_disk_bytes) # Room for a single entry in memory
+        self.wait_indexed(cache)
+        return cache
+
+    def wait_indexed(self, cache, entries=0):
+        for _ in range(100): # The disk tier is indexed in the background
+            if cache.get_stats()["disk_entries"] >= entries:
+                return
+            sleep(0.02)
+
+    def disk_path(self, entry):
+        return join(self.disk_dir, "%s.json" % entry["prefixes"][-1])
+
+    def test_evicted_entry_is_spilled_and_promoted(self):
+        cache = self.make_cache()
+        cache.put(self.first)
+        cache.put(self.second)
+        self.assertTrue(exists(self.disk_path(self.first)))
+        self.assertTrue(cache.is_prefix(self.first["prefixes"][0])) # Still cached, so still indexed
+        self.assertEqual(cache.get_stats()["disk_entries"], 1)
+
+        entry = cache.get(self.first["prefixes"][-1])
+        self.assertEqual(entry["final"]["hypothesis"], "first")
+        stats = cache.get_stats()
+        self.assertEqual(stats["disk_hits"], 1)
+        self.assertFalse(exists(self.disk_path(self.first))) # Promoted back into memory
+        self.assertTrue(exists(self.disk_path(self.second))) # Which spilled the second
+
+    def test_disk_tier_is_bounded(self):
+        cache = self.make_cache(max_disk_bytes=self.size + 1)
+        for entry in [self.first, self.second, self.third]:
+            cache.put(entry)
+        self.assertFalse(exists(self.disk_path(self.first)))
+        self.assertTrue(exists(self.disk_path(self.second)))
+        self.assertFalse(cache.is_prefix(self.first["prefixes"][0]))
+        self.assertIsNone(cache.get(self.first["prefixes"][-1]))
+
+    def test_disk_tier_survives_a_restart(self):
+        cache = self.make_cache()
+        cache.put(self.first)
+        cache.put(self.second)
+
+        restarted = ResultCache(self.size + 1, self.disk_dir, 1024 * 1024)
+        self.wait_indexed(restarted, 1)
+        self.assertTrue(restarted.is_prefix(self.first["prefixes"][0]))
+        self.assertEqual(restarted.get(self.first["prefixes"][-1])["final"]["hypothesis"], "first")
+
+    def test_corrupt_file_is_forgotten(self):
+        cache = self.make_cache()
+        cache.put(self.first)
+        cache.put(self.second)
+        with open(self.disk_path(self.first), "w") as e_f:
+            e_f.write("{not json")
+        self.assertIsNone(cache.get(self.first["prefixes"][-1]))
+        self.assertEqual(cache.get_stats()["disk_entries"], 0)
+        self.assertFalse(cache.is_prefix(self.first["prefixes"][0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,17 +9,32 @@ Developed by: David Smerkous
 
 from logger import logger
 from configs import NLTKModel, Configs
-from collections import defaultdict
+from collections import defaultdict, deque
 from itertools import chain, groupby, product
-from nltk.tokenize import wordpunct_tokenize
+from threading import Thread, Condition, Lock
 
 import string
-import nltk
+import re
 
 log = logger("TEXTPR")
 
+DECODER_TEXT_RE = re.compile(r"[^\w\s']", re.UNICODE)
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+re: DECODER_TEXT_RE - Matches anything a decoder hypothesis can't contain (punctuation other than the apostrophes
+    of dictionary words like "don't"), text without a match takes the fast path
+"""
+
 
 class TextProcessor(object):
+    """The keyphrase extraction of the hypotheses (RAKE)
+
+    Note:
+        The decoder hypotheses are space separated and free of punctuation, so they
+        skip the nltk sentence and word tokenizers and are split on their spaces (with the stopword runs
+        grouped by set lookups). Any other text goes through the full nltk tokenization
+    """
+
     def __init__(self):
         self._nltk_model = None
         self._stop_words = None
@@ -40,10 +55,32 @@ class TextProcessor(object):
             nltk_model (NLTKModel): The loaded nltk model to be processed
         """
 
+        import nltk # nltk takes a while to import, so it's only loaded once it's needed
+
         self._nltk_model = nltk_model
         self._stop_words = nltk.corpus.stopwords.words(self._nltk_model.stop_words) # Load the nltk stopwords list
         self._ignore_list = set(self._stop_words + self._punctuation)
 
+    @staticmethod
+    def warm_up(stop_words):
+        """Method to load the nltk data ahead of time
+
+        Note:
+            Call this in the server process before any workers are forked, so every
+            worker starts with the tokenizer and the stopwords already in memory
+
+        Arguments:
+            stop_words (list): The nltk stopword languages to load (ex: ["english"])
+        """
+        import nltk
+
+        nltk.tokenize.sent_tokenize("Warm up the tokenizer.") # Loads the punkt model
+        for language in stop_words:
+            try:
+                nltk.corpus.stopwords.words(language)
+            except Exception as err:
+                log.error("Failed loading the %s stopwords! (err: %s)" % (language, str(err)))
+
     def get_sentences(self, text):
         """Method to extract sentences from the text
 
@@ -51,7 +88,20 @@ class TextProcessor(object):
             text (str): The text to extract keyphrases from
 
         """
-        return nltk.tokenize.sent_tokenize(text)
+        from nltk.tokenize import sent_tokenize
+        return sent_tokenize(text)
+
+    @staticmethod
+    def is_decoder_text(text):
+        """Method to check if a text looks like a decoder hypothesis
+
+        Arguments:
+            text (str): The text to check
+
+        Returns: (bool)
+            True if the text only has words separated by white space
+        """
+        return DECODER_TEXT_RE.search(text) is None
 
     def generate_keyphrases(self, text):
         """Method to extract keyphrases from the text
@@ -59,6 +109,10 @@ class TextProcessor(object):
         Arguments:
             text (str): The text to extract keyphrases from
         """
+        if TextProcessor.is_decoder_text(text):
+            phrase_list = self.__get_phrase_list(text.lower().split()) # The hypothesis is a single run of words
+            self.__rank_phrases(None if phrase_list is None else set(phrase_list))
+            return
         sentences = self.get_sentences(text) # Get all the sentences from the text
         self.generate_keyphrases_from_sentences(sentences) # Process each sentence individually
 
@@ -68,15 +122,7 @@ class TextProcessor(object):
         Arguments:
             sentences (:obj: list - str): A list of strings that represent sentences
         """
-        phrase_list = self.__make_phrases(sentences)
-
-        if phrase_list is None:
-            log.error("The nltk model has not yet been loaded. Failed processing keyphrases!")
-            return
-
-        self.__frequency_distribution(phrase_list)
-        self.__word_co_occurance_graph(phrase_list)
-        self.__ranklist(phrase_list)
+        self.__rank_phrases(self.__make_phrases(sentences))
 
     def get_keyphrases(self):
         """Method to return the processed keyphrases and their scores
@@ -86,6 +132,20 @@ class TextProcessor(object):
         """
         return self._rank_list
 
+    def __rank_phrases(self, phrase_list):
+        """Private method to score and rank the extracted phrases
+
+        Arguments:
+            phrase_list (set): The phrases (tuples of words) or None if the nltk model isn't loaded
+        """
+        if phrase_list is None:
+            log.error("The nltk model has not yet been loaded. Failed processing keyphrases!")
+            return
+
+        self.__frequency_distribution(phrase_list)
+        self.__word_co_occurance_graph(phrase_list)
+        self.__ranklist(phrase_list)
+
     def __frequency_distribution(self, phrase_list):
         """Builds a frequency distribution of the words inside the phrase list
 
@@ -144,6 +204,8 @@ class TextProcessor(object):
         Returns (set):
             A set of string tuples where each tuple is a subgrouped phrase
         """
+        from nltk.tokenize import wordpunct_tokenize
+
         phrase_list = set()
 
         for sentence in sentences:
@@ -169,3 +231,96 @@ class TextProcessor(object):
             if not group[0]:
                 phrase_list.append(tuple(group[1]))
         return phrase_list
+
+
+class TextStage(object):
+    """The text processing stage of a worker, the hypotheses are processed (and sent) on its own thread
+
+    Attributes:
+        _handler (method): The method that processes and sends a hypothesis (text, is_final, results)
+        _condition (Condition): The condition that guards the waiting hypotheses and wakes the stage up
+        _busy (Lock): Held while a hypothesis is being processed
+        _finals (deque): The final hypotheses waiting to be processed (in order)
+        _partial (tuple): The latest partial hypothesis waiting to be processed (None if there's none)
+        dropped (int): The amount of stale partial hypotheses that were never processed
+
+    Note:
+        The decoding hands the hypotheses over and carries on with the next chunk right away, so it
+        never waits on the keyphrase extraction. A partial hypothesis that's still waiting when a newer
+        hypothesis arrives is stale and dropped, the cost measurement (_meta) it carried is added to
+        the one of the hypothesis that replaced it
+    """
+
+    def __init__(self, handler):
+        self._handler = handler
+        self._condition = Condition()
+        self._busy = Lock()
+        self._finals = deque()
+        self._partial = None
+        self.dropped = 0
+        stage_t = Thread(target=self.__run)
+        stage_t.setDaemon(True)
+        stage_t.start()
+
+    def submit(self, text, is_final, results):
+        """Method to queue a hypothesis for processing
+
+        Arguments:
+            text (str): The hypothesis text (None for silence, it's sent as is)
+            is_final (bool): If it's the final hypothesis of an utterance (or a segment of it)
+            results (dict): The results to send with the processed text (copied, so the caller can reuse it)
+        """
+        results = dict(results)
+        if "_meta" in results:
+            results["_meta"] = dict(results["_meta"])
+        with self._condition:
+            if self._partial is not None: # A newer hypothesis makes the waiting partial stale
+                TextStage.merge_meta(self._partial[2], results)
+                self._partial = None
+                self.dropped += 1
+            if is_final:
+                self._finals.append((text, True, results))
+            else:
+                self._partial = (text, False, results)
+            self._condition.notify()
+
+    def clear(self):
+        """Method to drop every waiting hypothesis (once the one that's being processed is sent)"""
+        with self._condition:
+            self._finals.clear()
+            self._partial = None
+        with self._busy:
+            pass
+
+    @staticmethod
+    def merge_meta(stale, results):
+        """Method to add the cost measurement of a dropped hypothesis to the one that replaced it
+
+        Arguments:
+            stale (dict): The results of the dropped hypothesis
+            results (dict): The results of the newer hypothesis
+        """
+        meta = stale.get("_meta")
+        if meta is None:
+            return
+        merged = results.setdefault("_meta", {})
+        for key, value in meta.items():
+            merged[key] = merged.get(key, 0) + value
+
+    def __run(self):
+        """Private method that processes the waiting hypotheses (finals first, they're older than the waiting partial)"""
+        while True:
+            with self._condition:
+                while len(self._finals) == 0 and self._partial is None:
+                    self._condition.wait()
+                if len(self._finals) > 0:
+                    hypothesis = self._finals.popleft()
+                else:
+                    hypothesis, self._partial = self._partial, None
+                self._busy.acquire()
+            try:
+                self._handler(*hypothesis)
+            except Exception as err:
+                log.error("Failed processing a hypothesis! (err: %s)" % str(err))
+            finally:
+                self._busy.release()
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+"""RemSphinx speech to text worker pool
+
+This module keeps preloaded (warm) STT workers around so that a new session doesn't have to
+wait on a full language model load. It also listens for configuration reloads, preloads any
+new or changed language models in the background, and only then switches new sessions over to them.
+
+Developed by: David Smerkous
+"""
+
+from logger import logger
+from configs import Configs
+from audio_processor import STT
+from decoders import vocabulary_hash, get_profile
+from threading import Thread, Lock
+from time import time
+
+log = logger("WPOOL")
+
+DEFAULT_WARM_WORKERS = 1
+DEFAULT_LOAD_TIMEOUT = 120
+DEFAULT_MAX_UTTERANCES = 1000
+DEFAULT_MAX_VOCABULARY_IDLE = 4
+DEFAULT_TRACKED_IDLE = 600
+"""Global module level definitions
+logger: log - The module log object so that printed calls can be backtraced to this file
+int: DEFAULT_WARM_WORKERS - The default amount of preloaded workers to keep per language model
+int: DEFAULT_LOAD_TIMEOUT - The default amount of seconds to wait on a worker to load its models
+int: DEFAULT_MAX_UTTERANCES - The default amount of utterances after which a worker is recycled instead of reused
+int: DEFAULT_MAX_VOCABULARY_IDLE - The default maximum amount of idle workers that have a custom vocabulary loaded
+int: DEFAULT_TRACKED_IDLE - The default amount of seconds a requested (not preloaded) language model is kept warm after its last request
+"""
+
+
+class STTPool(object):
+    """Pool of preloaded STT workers keyed by their language model
+
+    Attributes:
+        _configs (Configs): The globally loaded configuration object
+        _lock (Lock): The lock that guards the spares and the fingerprints
+        _spares (dict): The (model key, vocabulary hash) spare key to a list of loaded and unused STT workers
+        _fingerprints (dict): The model key to the fingerprint of the models currently handed to new sessions
+        _tracked (dict): The model key to the (model id, accent, profile) that should be kept warm
+        _requested (dict): The model key to the time it was last requested (the preloaded keys aren't in it, they never go idle)
+        _refilling (set): The model keys that currently have a refill running
+        _paused (bool): Set while the memory governor doesn't want new spares to be loaded
+
+    Note:
+        Sessions that are already running keep the STT worker they were given. When the
+        models change, only the spares get replaced, so old decoders drain as their sessions end.
+        Workers with a custom vocabulary are kept apart (by the hash of the vocabulary) so that
+        sessions asking for the same words get a decoder that already has them. The decoder
+        profile is part of the model key, since the profiles are set when a decoder is created
+    """
+
+    def __init__(self, configs):
+        self._configs = configs
+        self._lock = Lock()
+        self._spares = {}
+        self._fingerprints = {}
+        self._tracked = {}
+        self._requested = {}
+        self._refilling = set()
+        self._paused = False
+        configs.add_reload_listener(self.__on_reload)
+
+    @staticmethod
+    def model_key(l_id, accent, profile=None):
+        """Method to create the unique key of a language model
+
+        Arguments:
+            l_id (int): The language model id
+            accent (str): The language model accent
+            profile (str): The decoder profile name (None without profiles)
+
+        Returns: (str)
+            The language model key
+        """
+        if profile is None:
+            return "%s:%s" % (str(l_id), str(accent))
+        return "%s:%s@%s" % (str(l_id), str(accent), str(profile))
+
+    @staticmethod
+    def spare_key(stt):
+        """Method to create the key of the spares an STT worker belongs to
+
+        Arguments:
+            stt (STT): The STT worker
+
+        Returns: (tuple)
+            The model key and the vocabulary hash (None if the worker doesn't have custom words)
+        """
+        return stt.model_key, stt.vocabulary_key
+
+    @staticmethod
+    def describe_spare_key(spare_key):
+        """Method to format a spare key for the logs
+
+        Arguments:
+            spare_key (tuple): The model key and the vocabulary hash
+
+        Returns: (str)
+            The model key, followed by the vocabulary hash if there's one
+        """
+        if spare_key[1] is None:
+            return spare_key[0]
+        return "%s (vocabulary %s)" % spare_key
+
+    @staticmethod
+    def get_pool_configs(snapshot=None):
+        """Method to get the pool section of the stt configurations
+
+        Arguments:
+            snapshot (dict): The configuration snapshot to read from (defaults to the current one)
+
+        Returns: (dict)
+            The pool configurations (empty if the section is missing)
+        """
+        return Configs.get_stt(snapshot).get("pool", {})
+
+    def start(self, wait=False):
+        """Method to start preloading the models listed in the pool configurations
+
+        Arguments:
+            wait (bool): If the method should block until every preloaded worker is ready
+                         (used for the warm start), otherwise the preloading happens in the background
+        """
+        refills = []
+        for model in STTPool.get_pool_configs().get("preload", []):
+            try:
+                profile = get_profile(model.get("profile"))[0]
+            except ValueError as err:
+                log.error("Can't preload %s (err: %s)" % (str(model), str(err)))
+                continue
+            self.__track(model["model"], model["accent"], profile, False)
+            refills.append(self.__refill_async(STTPool.model_key(model["model"], model["accent"], profile)))
+
+        if wait:
+            for refill_t in refills:
+                if refill_t is not None:
+                    refill_t.join()
+
+    def acquire(self, l_id, accent, vocabulary=None, profile=None):
+        """Method to get an STT worker for the requested language model
+
+        Note:
+            A warm worker that already has the custom vocabulary is preferred, then a warm worker
+            of the plain model (the words are added to its decoder without a reload). Only if
+            there's neither, a new one is created, which has to load the language model first
+
+        Arguments:
+            l_id (int): The language model id
+            accent (str): The language model accent
+            vocabulary (dict): The normalized custom words of the session
+            profile (str): The (existing) decoder profile name, or None for the default profile
+
+        Returns: (tuple)
+            The STT worker and True if it was already loaded, or (None, False) if the model is invalid
+        """
+
+        try:
+            profile = get_profile(profile)[0]
+        except ValueError as err:
+            log.error("Can't hand out a worker (err: %s)" % str(err))
+            return None, False
+        key = STTPool.model_key(l_id, accent, profile)
+        vocabulary_key = vocabulary_hash(vocabulary)
+        language_model = self._configs.get_stt_data(l_id, accent, profile=profile)
+        nltk_model = self._configs.get_nltk_data(l_id)
+        if language_model is None or nltk_model is None:
+            return None, False # Only valid models are kept warm
+        self.__forget_idle()
+        self.__track(l_id, accent, profile)
+
+        stt = None
+        if vocabulary_key is not None:
+            stt = self.__take_spare((key, vocabulary_key))
+        if stt is None:
+            stt = self.__take_spare((key, None))
+            if stt is not None:
+                self.__refill_async(key) # Replace the worker that was just handed out
+                if vocabulary_key is not None:
+                    stt.add_words(vocabulary)
+
+        if stt is not None:
+            log.debug("Handing out a warm worker for %s" % key)
+            return stt, True
+
+        self.__refill_async(key)
+
+        # There's no warm worker, so load the model on demand
+        log.debug("Creating a cold worker for %s" % key)
+        stt = STT()
+        stt.model_key = key
+        stt.set_models(language_model, nltk_model, vocabulary)
+        return stt, False
+
+    def release(self, stt):
+        """Method to give back an STT worker once its session has ended
+
+        Note:
+            The worker is reset and kept as a spare if its models are still current, it hasn't reached
+            the max_utterances limit and there's room for it. Otherwise it's shutdown, so the amount of
+            worker processes follows the amount of live sessions. A spare can be handed out before it
+            acknowledged the reset, it drops the responses of the previous session until then
+
+        Arguments:
+            stt (STT): The STT worker that's no longer in use
+        """
+
+        pool_configs = STTPool.get_pool_configs()
+        key = stt.model_key
+        reusable = pool_configs.get("recycle", True) and key is not None and stt.is_alive() and stt.is_loaded() \
+            and stt.utterances < pool_configs.get("max_utterances", DEFAULT_MAX_UTTERANCES)
+
+        if reusable:
+            max_idle = pool_configs.get("max_idle", pool_configs.get("warm_workers", DEFAULT_WARM_WORKERS))
+            spare_key = STTPool.spare_key(stt)
+            with self._lock:
+                if spare_key[1] is not None: # The words can't be removed from a decoder, so it's kept apart
+                    vocabulary_idle = sum([len(spares) for s_key, spares in self._spares.items() if s_key[1] is not None])
+                    max_idle = max_idle if vocabulary_idle < pool_configs.get("max_vocabulary_idle", DEFAULT_MAX_VOCABULARY_IDLE) else 0
+                spares = self._spares.setdefault(spare_key, [])
+                if self._fingerprints.get(key, stt.model_fingerprint) == stt.model_fingerprint and len(spares) < max_idle:
+                    stt.reset() # Keep the decoder but clear the session state
+                    spares.append(stt)
+                    log.debug("Returned a worker of %s to the pool", STTPool.describe_spare_key(spare_key))
+                    return
+
+        stt.shutdown()
+
+    def get_spares(self):
+        """Method to get all of the idle warm workers
+
+        Returns: (list)
+            The spare STT workers of every key
+        """
+        with self._lock:
+            return [stt for spares in self._spares.values() for stt in spares]
+
+    def evict_spare(self):
+        """Method to shutdown an idle warm worker to free its memory
+
+        Note:
+            A worker with custom words is evicted first (it's the least likely to be asked for again),
+            then one of the model with the most spares
+
+        Returns: (bool)
+            True if a worker was shutdown, False if there are no spares
+        """
+        with self._lock:
+            keys = sorted([s_key for s_key, spares in self._spares.items() if len(spares) > 0],
+                          key=lambda s_key: (s_key[1] is not None, len(self._spares[s_key])), reverse=True)
+            if len(keys) == 0:
+                return False
+            stt = self._spares[keys[0]].pop()
+        log.info("Evicting an idle worker of %s", STTPool.describe_spare_key(keys[0]))
+        stt.shutdown()
+        return True
+
+    def pause_refills(self, paused):
+        """Method to stop (or resume) loading new spares while the memory is low
+
+        Arguments:
+            paused (bool): True to stop the refills
+        """
+        if paused != self._paused:
+            log.info("%s the spare refills", "Pausing" if paused else "Resuming")
+        self._paused = paused
+
+    def __take_spare(self, spare_key):
+        """Private method to take a loaded worker out of the spares
+
+        Arguments:
+            spare_key (tuple): The key of the spares
+
+        Returns: (STT)
+            The loaded STT worker or None if there's no spare
+        """
+        with self._lock:
+            spares = self._spares.get(spare_key, [])
+            while len(spares) > 0:
+                stt = spares.pop(0)
+                if stt.is_loaded() and stt.is_alive():
+                    return stt
+                stt.shutdown() # The worker failed to load the model (or died)
+        return None
+
+    def __track(self, l_id, accent, profile=None, requested=True):
+        """Private method to remember a language model that should be kept warm
+
+        Arguments:
+            l_id (int): The language model id
+            accent (str): The language model accent
+            profile (str): The decoder profile name
+            requested (bool): If a session asked for it (it goes idle), otherwise it's preloaded (always kept warm)
+        """
+        key = STTPool.model_key(l_id, accent, profile)
+        with self._lock:
+            self._tracked[key] = (l_id, accent, profile)
+            if requested:
+                self._requested[key] = time()
+            else:
+                self._requested.pop(key, None)
+
+    def __forget_idle(self):
+        """Private method to stop keeping the requested language models warm once nobody asked for them in a while"""
+        tracked_idle = STTPool.get_pool_configs().get("tracked_idle", DEFAULT_TRACKED_IDLE)
+        stale = []
+        with self._lock:
+            now = time()
+            for key in [r_key for r_key, requested in self._requested.items() if now - requested > tracked_idle]:
+                del self._requested[key]
+                self._tracked.pop(key, None)
+                stale += self._spares.pop((key, None), [])
+                log.debug("Stopped keeping %s warm", key)
+        for stt in stale:
+            stt.shutdown()
+
+    def __load_spares(self, key, snapshot, count):
+        """Private method to create and wait on fully loaded STT workers
+
+        Arguments:
+            key (str): The language model key
+            snapshot (dict): The configuration snapshot to load the models from
+            count (int): The amount of workers to load
+
+        Returns: (tuple)
+            The list of loaded STT workers and the fingerprint of their models
+        """
+
+        tracked = self._tracked.get(key)
+        if tracked is None:
+            return [], None # It went idle
+        l_id, accent, profile = tracked
+        language_model = self._configs.get_stt_data(l_id, accent, snapshot, profile)
+        nltk_model = self._configs.get_nltk_data(l_id)
+        if language_model is None or nltk_model is None:
+            log.error("Can't preload the invalid language model %s" % key)
+            return [], None
+
+        timeout = STTPool.get_pool_configs(snapshot).get("load_timeout", DEFAULT_LOAD_TIMEOUT)
+        loaded = []
+        for _ in range(count):
+            stt = STT()
+            stt.model_key = key
+            stt.set_models(language_model, nltk_model)
+            if stt.wait_loaded(timeout):
+                loaded.append(stt)
+            else:
+                log.error("Failed preloading a worker for %s" % key)
+                stt.shutdown()
+        return loaded, language_model.fingerprint()
+
+    def __refill(self, key):
+        """Private method to top up the warm workers of a language model
+
+        Arguments:
+            key (str): The language model key
+        """
+
+        try:
+            warm_workers = STTPool.get_pool_configs().get("warm_workers", DEFAULT_WARM_WORKERS)
+            with self._lock:
+                missing = warm_workers - len(self._spares.get((key, None), []))
+            if missing <= 0:
+                return
+
+            loaded, fingerprint = self.__load_spares(key, Configs.get_snapshot(), missing)
+
+            with self._lock:
+                if key not in self._tracked or self._fingerprints.get(key, fingerprint) != fingerprint:
+                    stale = loaded # The models were swapped (or went idle) while these were loading
+                else:
+                    self._fingerprints[key] = fingerprint
+                    self._spares.setdefault((key, None), []).extend(loaded)
+                    stale = []
+            for stt in stale:
+                stt.shutdown()
+        finally:
+            with self._lock:
+                self._refilling.discard(key)
+
+    def __refill_async(self, key):
+        """Private method to top up the warm workers of a language model in the background
+
+        Arguments:
+            key (str): The language model key
+
+        Returns: (Thread)
+            The refill thread or None if a refill of the key is already running (or the refills are paused)
+        """
+        with self._lock:
+            if key in self._refilling or self._paused:
+                return None
+            self._refilling.add(key)
+
+        refill_t = Thread(target=self.__refill, args=(key,))
+        refill_t.setDaemon(True)
+        refill_t.start()
+        return refill_t
+
+    def __swap(self, key, snapshot):
+        """Private method to preload the new models of a key and then atomically switch over to them
+
+        Arguments:
+            key (str): The language model key
+            snapshot (dict): The freshly reloaded configuration snapshot
+        """
+
+        try:
+            tracked = self._tracked.get(key)
+            if tracked is None:
+                return
+            l_id, accent, profile = tracked
+            language_model = self._configs.get_stt_data(l_id, accent, snapshot, profile)
+            fingerprint = None if language_model is None else language_model.fingerprint()
+            with self._lock:
+                if fingerprint is None or self._fingerprints.get(key) == fingerprint:
+                    return # The model is either broken or hasn't changed
+
+            warm_workers = STTPool.get_pool_configs(snapshot).get("warm_workers", DEFAULT_WARM_WORKERS)
+            loaded, fingerprint = self.__load_spares(key, snapshot, max(warm_workers, 1))
+            if len(loaded) == 0:
+                log.error("Keeping the previous models for %s" % key)
+                return
+
+            with self._lock:
+                stale = list(self._spares.get((key, None), []))
+                self._spares[(key, None)] = loaded
+                self._fingerprints[key] = fingerprint
+                for spare_key in [s_key for s_key in self._spares.keys() if s_key[0] == key and s_key[1] is not None]:
+                    stale += self._spares.pop(spare_key) # The workers with custom words have the old models too
+            log.info("Switched new sessions of %s over to the reloaded models" % key)
+
+            # Drain the workers that still have the old models loaded
+            for stt in stale:
+                stt.shutdown()
+        except Exception as err:
+            log.error("Failed swapping the models of %s! (err: %s)" % (key, str(err)))
+
+    def __on_reload(self, old_configs, new_configs):
+        """Private method that's called by the Configs object after every reload
+
+        Arguments:
+            old_configs (dict): The previous configuration snapshot
+            new_configs (dict): The new configuration snapshot
+        """
+
+        preloaded = set()
+        for model in STTPool.get_pool_configs(new_configs).get("preload", []):
+            try:
+                profile = get_profile(model.get("profile"), new_configs)[0]
+                self.__track(model["model"], model["accent"], profile, False)
+                preloaded.add(STTPool.model_key(model["model"], model["accent"], profile))
+            except ValueError as err:
+                log.error("Can't preload %s (err: %s)" % (str(model), str(err)))
+
+        with self._lock:
+            for key in self._tracked.keys():
+                if key not in preloaded and key not in self._requested:
+                    self._requested[key] = time() # No longer preloaded, so it can go idle now
+        self.__forget_idle()
+
+        with self._lock:
+            keys = list(self._tracked.keys())
+
+        for key in keys:
+            swap_t = Thread(target=self.__swap, args=(key, new_configs))
+            swap_t.setDaemon(True)
+            swap_t.start()